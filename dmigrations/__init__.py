@@ -1,2 +1,42 @@
 # Version 0.3.1
 VERSION = (0, 3, 1)
+
+# MigrationDb objects kept by is_up_to_date, by directory
+_migration_dbs = {}
+
+def is_up_to_date(migrations_dir=None, dev=False):
+    """
+    Return True if all migrations in migrations_dir (DMIGRATIONS_DIR by
+    default) are applied. Cheap enough for app startup and health checks:
+    usually it's one stat of the directory and one indexed query. It only
+    reads from the database, high water is recorded by dmigrate runs.
+    """
+    import os
+    from django.conf import settings
+    from django.db import DatabaseError
+    from dmigrations.migration_db import MigrationDb
+    from dmigrations.migration_cache import cache_from_settings
+    from dmigrations.migration_state import MigrationState, table_present
+    
+    if migrations_dir is None:
+        migrations_dir = settings.DMIGRATIONS_DIR
+    
+    mtime = os.stat(migrations_dir).st_mtime
+    if migrations_dir in _migration_dbs and \
+        _migration_dbs[migrations_dir][0] == mtime:
+        migration_db = _migration_dbs[migrations_dir][1]
+    else:
+        migration_db = MigrationDb(directory=migrations_dir,
+            cache=cache_from_settings(migrations_dir))
+        migration_db.index # Scan directory while mtime is still current
+        _migration_dbs[migrations_dir] = (mtime, migration_db)
+    
+    migration_state = MigrationState(migration_db=migration_db, dev=dev)
+    try:
+        return migration_state.is_up_to_date()
+    except DatabaseError:
+        # Tables are missing, so migration system isn't even initialized
+        if not table_present('dmigrations') or \
+            not table_present('dmigrations_meta'):
+            return False
+        raise
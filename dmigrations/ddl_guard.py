@@ -0,0 +1,243 @@
+"""
+Guard for DDL statements against metadata lock pileups.
+
+A DDL statement waiting for a metadata lock held by a long transaction
+blocks every query on its table queued after it. Guarded statements
+give up waiting after a short lock_wait_timeout instead, and are retried
+with jittered backoff until a deadline, so queries queued behind them
+get through in between. Long transactions holding or waiting for metadata
+locks of the statement's tables are waited for before each attempt.
+"""
+from exceptions import *
+
+import random
+import re
+import sys
+import time
+
+# Defaults, overridden by DMIGRATIONS_DDL_LOCK_WAIT_TIMEOUT (0 turns the
+# guard off), DMIGRATIONS_DDL_DEADLINE and DMIGRATIONS_DDL_LONG_TRANSACTION
+# settings, all in seconds
+DEFAULT_LOCK_WAIT_TIMEOUT = 5
+DEFAULT_DEADLINE = 600
+DEFAULT_LONG_TRANSACTION = 10
+
+# Seconds between attempts grow from MIN_BACKOFF up to MAX_BACKOFF
+MIN_BACKOFF = 1
+MAX_BACKOFF = 30
+
+# ER_LOCK_WAIT_TIMEOUT, also raised when a metadata lock wait times out
+LOCK_WAIT_TIMEOUT_ERROR = 1205
+
+ddl_re = re.compile(r'^\s*(ALTER|CREATE|DROP|RENAME|TRUNCATE|OPTIMIZE)\b', re.I)
+
+# Table name, maybe quoted and qualified with database name
+_name = r'(?:`[^`]+`|[\w$]+)(?:\.(?:`[^`]+`|[\w$]+))?'
+_names = r'%s(?:\s*,\s*%s)*' % (_name, _name)
+_renames = r'%s\s+TO\s+%s(?:\s*,\s*%s\s+TO\s+%s)*' % ((_name,) * 4)
+ddl_tables_res = [re.compile(r'^\s*' + pattern, re.I) for pattern in [
+    r'ALTER\s+(?:ONLINE\s+|IGNORE\s+)*TABLE\s+(%s)' % _name,
+    r'(?:CREATE|DROP)\s+(?:\w+\s+)?INDEX\s+%s\s+ON\s+(%s)' % (_name, _name),
+    r'CREATE\s+(?:TEMPORARY\s+)?TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?(%s)' % _name,
+    r'DROP\s+(?:TEMPORARY\s+)?TABLES?\s+(?:IF\s+EXISTS\s+)?(%s)' % _names,
+    r'RENAME\s+TABLES?\s+(%s)' % _renames,
+    r'TRUNCATE\s+(?:TABLE\s+)?(%s)' % _name,
+    r'OPTIMIZE\s+(?:NO_WRITE_TO_BINLOG\s+|LOCAL\s+)?TABLES?\s+(%s)' % _names,
+]]
+
+# Metadata locks are only listed in performance_schema with this
+# instrument enabled, as it is by default since MySQL 8.0
+MDL_INSTRUMENT_SQL = """
+    SELECT ENABLED FROM performance_schema.setup_instruments
+    WHERE NAME = 'wait/lock/metadata/sql/mdl'
+"""
+
+# Long transactions of sessions holding or waiting for metadata locks of
+# tables, whose names replace the second %s as parameters
+TABLE_LONG_TRANSACTIONS_SQL = """
+    SELECT t.trx_mysql_thread_id,
+        TIMESTAMPDIFF(SECOND, t.trx_started, NOW()), p.USER, p.HOST
+    FROM information_schema.INNODB_TRX t
+    JOIN information_schema.PROCESSLIST p ON p.ID = t.trx_mysql_thread_id
+    WHERE t.trx_started < NOW() - INTERVAL %d SECOND
+    AND t.trx_mysql_thread_id != CONNECTION_ID()
+    AND t.trx_mysql_thread_id IN (
+        SELECT th.PROCESSLIST_ID
+        FROM performance_schema.metadata_locks l
+        JOIN performance_schema.threads th
+            ON th.THREAD_ID = l.OWNER_THREAD_ID
+        WHERE l.OBJECT_TYPE = 'TABLE' AND l.OBJECT_SCHEMA = DATABASE()
+        AND l.OBJECT_NAME IN (%s)
+    )
+    ORDER BY t.trx_started
+"""
+
+# Without metadata locks in performance_schema there's no telling which
+# tables a transaction used, so every long transaction on the database
+# counts, idle ones included
+LONG_TRANSACTIONS_SQL = """
+    SELECT t.trx_mysql_thread_id,
+        TIMESTAMPDIFF(SECOND, t.trx_started, NOW()), p.USER, p.HOST
+    FROM information_schema.INNODB_TRX t
+    JOIN information_schema.PROCESSLIST p ON p.ID = t.trx_mysql_thread_id
+    WHERE t.trx_started < NOW() - INTERVAL %d SECOND
+    AND t.trx_mysql_thread_id != CONNECTION_ID()
+    AND (p.DB IS NULL OR p.DB = DATABASE())
+    ORDER BY t.trx_started
+"""
+
+def is_ddl(statement):
+    return bool(ddl_re.match(statement))
+
+def ddl_tables(statement):
+    """
+    Return list of names of tables DDL statement locks, or None if it
+    can't be told.
+    """
+    for ddl_tables_re in ddl_tables_res:
+        match = ddl_tables_re.match(statement)
+        if match:
+            names = re.findall(_name, match.group(1))
+            return [
+                name.split('.')[-1].strip('`') for name in names
+                if name.upper() != 'TO'
+            ]
+    return None
+
+def _lock_wait_timeout(e):
+    args = getattr(e, 'args', ())
+    return bool(args) and args[0] == LOCK_WAIT_TIMEOUT_ERROR
+
+class DDLGuard(object):
+    """
+    Runs DDL statements with lock_wait_timeout seconds of waiting for
+    metadata locks at a time, giving up deadline seconds after the
+    first attempt. Transactions running longer than long_transaction
+    seconds are waited for, or with abort_on_long_transactions, make
+    the statement fail right away.
+    """
+
+    def __init__(self, lock_wait_timeout=DEFAULT_LOCK_WAIT_TIMEOUT,
+                 deadline=DEFAULT_DEADLINE,
+                 long_transaction=DEFAULT_LONG_TRANSACTION,
+                 abort_on_long_transactions=False,
+                 sleep=time.sleep, now=time.time):
+        self.lock_wait_timeout = lock_wait_timeout
+        self.deadline = deadline
+        self.long_transaction = long_transaction
+        self.abort_on_long_transactions = abort_on_long_transactions
+        self.sleep = sleep
+        self.now = now
+
+    @classmethod
+    def from_settings(cls):
+        from django.conf import settings
+        return cls(
+            lock_wait_timeout = getattr(settings,
+                'DMIGRATIONS_DDL_LOCK_WAIT_TIMEOUT', DEFAULT_LOCK_WAIT_TIMEOUT),
+            deadline = getattr(settings,
+                'DMIGRATIONS_DDL_DEADLINE', DEFAULT_DEADLINE),
+            long_transaction = getattr(settings,
+                'DMIGRATIONS_DDL_LONG_TRANSACTION', DEFAULT_LONG_TRANSACTION),
+            abort_on_long_transactions = getattr(settings,
+                'DMIGRATIONS_DDL_ABORT_ON_LONG_TRANSACTIONS', False),
+        )
+
+    def run(self, cursor, execute, tables=None):
+        """
+        Call execute(), which runs a DDL statement on the connection of
+        cursor, retrying it on metadata lock timeouts. The session
+        lock_wait_timeout is restored afterwards.
+
+        tables are names of tables the statement locks, as returned by
+        ddl_tables. If they're not known, all long transactions on the
+        database are waited for.
+        """
+        if not self.lock_wait_timeout:
+            return execute()
+        if tables and not self.metadata_locks_available(cursor):
+            tables = None
+        cursor.execute("SELECT @@SESSION.lock_wait_timeout")
+        saved = cursor.fetchone()[0]
+        cursor.execute(
+            "SET SESSION lock_wait_timeout = %d" % self.lock_wait_timeout
+        )
+        try:
+            return self.retry(cursor, execute, tables)
+        finally:
+            cursor.execute("SET SESSION lock_wait_timeout = %d" % saved)
+
+    def retry(self, cursor, execute, tables=None):
+        deadline = self.now() + self.deadline
+        attempt = 0
+        while True:
+            self.wait_for_long_transactions(cursor, deadline, tables)
+            try:
+                return execute()
+            except Exception, e:
+                if not _lock_wait_timeout(e):
+                    raise
+            attempt += 1
+            delay = self.backoff(attempt)
+            if self.now() + delay >= deadline:
+                raise DDLLockTimeoutError(
+                    u"Gave up waiting for metadata lock after %d attempts"
+                    % attempt
+                )
+            print >>sys.stderr, u"Waiting for metadata lock timed out, " \
+                "retrying in %.1f seconds" % delay
+            self.sleep(delay)
+
+    def backoff(self, attempt):
+        # Jitter keeps several migrating hosts from retrying in lockstep
+        limit = min(MAX_BACKOFF, MIN_BACKOFF * 2 ** attempt)
+        return random.uniform(MIN_BACKOFF, limit)
+
+    def metadata_locks_available(self, cursor):
+        try:
+            cursor.execute(MDL_INSTRUMENT_SQL)
+            row = cursor.fetchone()
+        except Exception:
+            # No performance_schema
+            return False
+        return row is not None and row[0] == 'YES'
+
+    def long_transactions(self, cursor, tables=None):
+        """
+        Return list of (thread id, seconds, user, host) of transactions
+        running longer than long_transaction seconds, only of those
+        holding or waiting for metadata locks of tables if given.
+        """
+        try:
+            if tables:
+                cursor.execute(TABLE_LONG_TRANSACTIONS_SQL % (
+                    self.long_transaction, ", ".join(["%s"] * len(tables))
+                ), tables)
+            else:
+                cursor.execute(LONG_TRANSACTIONS_SQL % self.long_transaction)
+        except Exception, e:
+            # INNODB_TRX needs the PROCESS privilege
+            print >>sys.stderr, u"Can't check for long transactions: %s" % e
+            return []
+        return list(cursor.fetchall())
+
+    def wait_for_long_transactions(self, cursor, deadline, tables=None):
+        attempt = 0
+        while True:
+            transactions = self.long_transactions(cursor, tables)
+            if not transactions:
+                return
+            description = u", ".join([
+                u"thread %s of %s@%s (%d seconds)" % (thread, user, host, age)
+                for (thread, age, user, host) in transactions
+            ])
+            attempt += 1
+            delay = self.backoff(attempt)
+            if self.abort_on_long_transactions or \
+                self.now() + delay >= deadline:
+                raise DDLLockTimeoutError(
+                    u"Long transactions would block DDL: %s" % description
+                )
+            print >>sys.stderr, u"Waiting for long transactions: %s" % \
+                description
+            self.sleep(delay)
@@ -20,3 +20,9 @@ class InconsistentStateError(MigrationError):
 
 class DevFlagRequiredError(MigrationError):
     pass
+
+class LockTimeoutError(MigrationError):
+    pass
+
+class DDLLockTimeoutError(LockTimeoutError):
+    pass
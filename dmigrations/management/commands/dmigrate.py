@@ -1,4 +1,6 @@
 import os, sys
+import datetime
+import shutil
 import time
 from django.core.management.base import BaseCommand, CommandError
 from optparse import make_option
@@ -6,29 +8,59 @@ from django.conf import settings
 from StringIO import StringIO
 
 from dmigrations.migration_state import MigrationState, table_present
+from dmigrations.migration_lock import acquire_lock, release_lock, \
+    acquire_soft_lock, DEFAULT_LOCK_TIMEOUT
 from dmigrations.migration_db import MigrationDb
+from dmigrations.migrations import SQL_UP_SUFFIX, SQL_DOWN_SUFFIX
+from dmigrations.migration_cache import cache_from_settings
+from dmigrations.state_file import StateFile, open_state_file
+from dmigrations.scheduler import ParallelScheduler
+from dmigrations.progress_monitor import print_progress
+from dmigrations.soft_worker import SoftMigrationWorker, WorkerStatus, \
+    run_in_background
 from dmigrations.exceptions import *
 
 class Command(BaseCommand):
     help = """Commands:
 %(name)s dmigrate apply M1 M1 - Apply specified migrations
 %(name)s dmigrate unapply M1 M2 - Unapply specified migration
+%(name)s dmigrate apply M1 --resume - Record progress of M1, and continue from where
+    an earlier --resume run failed
 %(name)s dmigrate mark_as_applied M1 M2 - Mark specified migrations as applied without running them
 %(name)s dmigrate mark_as_unapplied M1 M2 - Unapply specified migration as unapplied without running them
+    Both mark_as_* commands also accept --upto M and --file FILE
 %(name)s dmigrate cat M1 M2 - Print specified migrations
 
 %(name)s dmigrate all      - Run all migrations
 %(name)s dmigrate all_hard - Run all hard migrations (those that require the site to be down)
+%(name)s dmigrate all_soft - Run all soft migrations (those that don't)
+%(name)s dmigrate all_soft --background - Run soft migrations in a background worker,
+    up to --jobs N at a time
+%(name)s dmigrate pause_soft  - Pause the background worker after its running migrations
+%(name)s dmigrate resume_soft - Resume the paused background worker
+%(name)s dmigrate soft_status - Print progress of the background worker
 %(name)s dmigrate up       - Apply oldest unapplied migration
 %(name)s dmigrate down     - Unapply newest applied migration
 
+%(name)s dmigrate all --lock-timeout S - Wait up to S seconds for another host running migrations
+%(name)s dmigrate all --jobs N - Run all migrations, up to N at a time on different tables
+%(name)s dmigrate all --coalesce-alters - Run adjacent ALTERs of the same table as one ALTER
+%(name)s dmigrate all --progress - Print progress of long ALTERs while they run
+
 %(name)s dmigrate to M     - Apply all migrations up to M, upapply all migrations newer than M
 %(name)s dmigrate upto M   - Apply all migrations up to M
 %(name)s dmigrate downto M - Upapply all migrations newer than M
 
 %(name)s dmigrate init     - Ensure migration system is initialized
 
+%(name)s dmigrate export_state FILE - Save applied migrations (and log with --with-log) to FILE
+%(name)s dmigrate import_state FILE - Load applied migrations (and log with --with-log) from FILE
+    import_state accepts --replace to forget migrations not in FILE,
+    and --force to accept migrations that cannot be found
+
 %(name)s dmigrate list     - List all migrations and their state
+%(name)s dmigrate log [M]  - Print migration log (of M only, if given)
+%(name)s dmigrate log --archive-before DATE - Move older log entries to dmigrations_log_archive
 %(name)s dmigrate help     - Display this message
 """ % {'name': sys.argv[0]}
     args = '[command] [arguments]'
@@ -45,8 +77,40 @@ class Command(BaseCommand):
             help='Only print plan'),
         make_option('--print-time', action='store_true', dest='print_time',
             help='Time the migration and print the time in seconds to stdout.'),
+        make_option('--jobs', dest='jobs', type='int',
+            help='Run up to this many migrations touching different tables at the same time'),
+        make_option('--coalesce-alters', action='store_true', dest='coalesce_alters',
+            help='Run adjacent ALTER TABLE migrations on the same table as a single ALTER'),
+        make_option('--progress', action='store_true', dest='progress',
+            help='Print progress and estimated time left of DDL statements '
+                 'while they run (needs performance_schema stage events)'),
+        make_option('--resume', action='store_true', dest='resume',
+            help='Record finished steps of migrations, and continue ones interrupted '
+                 'by an error in an earlier --resume run from their first unfinished step'),
+        make_option('--archive-before', dest='archive_before',
+            help='With log, move entries older than this date (YYYY-MM-DD) to dmigrations_log_archive'),
+        make_option('--lock-timeout', dest='lock_timeout', type='int',
+            help='Seconds to wait for another host running migrations '
+                 '(default DMIGRATIONS_LOCK_TIMEOUT setting, or %d)' % DEFAULT_LOCK_TIMEOUT),
+        make_option('--background', action='store_true', dest='background',
+            help='With all_soft, apply soft migrations in a background worker'),
+        make_option('--upto', dest='upto',
+            help='With mark_as_applied/mark_as_unapplied, also mark all migrations up to this one'),
+        make_option('--file', dest='names_file',
+            help='With mark_as_applied/mark_as_unapplied, also mark migrations listed in this file, one per line'),
+        make_option('--state-file', dest='state_file',
+            help='Read migration state from this file (written by export_state or '
+                 'DMIGRATIONS_STATE_FILE) instead of the database. '
+                 'Only list and --print-plan work offline.'),
+        make_option('--with-log', action='store_true', dest='with_log',
+            help='With export_state/import_state, include migration log'),
+        make_option('--replace', action='store_true', dest='replace',
+            help='With import_state, unmark migrations not in the state file'),
+        make_option('--force', action='store_true', dest='force',
+            help='With import_state, accept migrations that cannot be found'),
     )
     requires_model_validation = False
+    plan_actions = 'all all_hard all_soft up down upto downto to apply unapply'.split()
     
     def handle(self, *args, **options):
         try:
@@ -54,57 +118,137 @@ class Command(BaseCommand):
         except AttributeError:
             print "You need to add DMIGRATIONS_DIR to your settings"
             return
-        migration_db = MigrationDb(directory = migrations_dir)
+        migration_db = MigrationDb(directory = migrations_dir,
+            cache = cache_from_settings(migrations_dir))
         migration_state = MigrationState(
-            migration_db = migration_db, dev = options.get('dev')
+            migration_db = migration_db, dev = options.get('dev'),
+            state_file = options.get('state_file'),
+            resume = options.get('resume'),
+            progress_callback = options.get('progress') and print_progress or None,
         )
         verbosity = int(options.get('verbosity', 1))
         
+        if migration_state.is_offline() and args and not (args[0] == 'list' or
+            options.get('print_plan') and args[0] in self.plan_actions):
+            raise CommandError(
+                '--state-file can only be used with list and --print-plan'
+            )
+        
         if not args or args[0] == 'help':
             self.print_help(sys.argv[0], 'dmigrate')
             return
         
-        elif args[0] in 'all all_hard up down upto downto to apply unapply'.split():
-            migration_state.init()
-            for (migration_name, action) in migration_state.plan(*args):
-                migration = migration_db.load_migration_object(migration_name)
-                start_time = time.time()
-                if action == 'up':
-                    if verbosity >= 1:
-                        print "Applying migration %s" % migration.name
-                    if not options.get('print_plan'):
-                        migration_state.apply(migration_name)
-                else:
-                    if verbosity >= 1:
-                        print "Unapplying migration %s" % migration.name
-                    if not options.get('print_plan'):
-                        migration_state.unapply(migration_name)
-                if options.get('print_time'):
-                    print "Migration %s ran %.1f seconds" % (migration.name, time.time() - start_time)
+        elif args[0] in self.plan_actions:
+            if options.get('resume') and (options.get('background') or
+                int(options.get('jobs') or 1) > 1):
+                raise CommandError(
+                    '--resume cannot be used together with --jobs or '
+                    '--background'
+                )
+            if options.get('background'):
+                if args[0] != 'all_soft' or options.get('print_plan'):
+                    raise CommandError('--background only works with all_soft')
+                migration_state.init()
+                worker = SoftMigrationWorker(migration_state,
+                    jobs = int(options.get('jobs') or 1),
+                    lock_timeout = self.lock_timeout(options),
+                    verbosity = verbosity,
+                )
+                if verbosity >= 1:
+                    print "Applying soft migrations in the background, " \
+                        "see dmigrate soft_status"
+                run_in_background(worker,
+                    getattr(settings, 'DMIGRATIONS_WORKER_LOG', None))
+                return
+            
+            if options.get('print_plan'):
+                migration_state.init()
+                self.run_plan(migration_db, migration_state,
+                    migration_state.plan(*args), options, verbosity)
+                return
+            
+            # all_hard never runs soft migrations, so it doesn't wait for
+            # the soft migrations worker. The soft lock comes first, as
+            # the worker takes the migration lock while holding it.
+            soft_lock = None
+            if args[0] != 'all_hard':
+                soft_lock = acquire_soft_lock(self.lock_timeout(options))
+            try:
+                acquire_lock(self.lock_timeout(options))
+                try:
+                    migration_state.init()
+                    # Planned only once the lock is held, so hosts which
+                    # waited for it don't repeat migrations run by others
+                    # meanwhile
+                    plan = migration_state.plan(*args)
+                    if plan:
+                        self.run_plan(migration_db, migration_state, plan,
+                            options, verbosity)
+                    elif verbosity >= 1:
+                        print "No migrations to run"
+                    # Even with nothing to run, high water may be missing
+                    # for migrations applied by older dmigrate versions
+                    migration_state.record_state()
+                    if not plan:
+                        return
+                finally:
+                    release_lock()
+            finally:
+                if soft_lock is not None:
+                    soft_lock.release()
+            self.create_permissions(verbosity)
+            return
+        
+        elif args[0] in ('pause_soft', 'resume_soft'):
+            if not WorkerStatus().set_paused(args[0] == 'pause_soft'):
+                raise CommandError('No soft migrations worker has run yet')
+            if verbosity >= 1 and args[0] == 'pause_soft':
+                print "Soft migrations worker will pause once its running " \
+                    "migrations finish"
+            return
+        
+        elif args[0] == 'soft_status':
+            status = WorkerStatus()
+            status.init()
+            fields = status.get()
+            if fields is None:
+                print "No soft migrations worker has run yet"
+                return
+            state = fields['state']
+            if fields['paused'] and state == 'running':
+                state = 'pausing'
+            print "%s: %d of %d soft migrations applied (pid %s on %s, " \
+                "updated %s)" % (state, fields['done'], fields['total'],
+                fields['pid'], fields['host'], fields['updated_at'])
+            if fields['running']:
+                print "Running: %s" % fields['running']
+            if fields['error']:
+                print "Error: %s" % fields['error']
+            return
         
         elif args[0] == 'mark_as_applied':
             migration_state.init()
-            for name in args[1:]:
-                resolved_name = migration_state.resolve_name(name)
-                if resolved_name == None:
-                    raise NoSuchMigrationError(name)
-                migration_state.mark_as_applied(resolved_name)
+            migration_state.mark_many_as_applied(
+                self.names_to_mark(migration_state, args[1:], options)
+            )
         
         elif args[0] == 'mark_as_unapplied':
             migration_state.init()
-            for name in args[1:]:
-                resolved_name = migration_state.resolve_name(name)
-                if resolved_name == None:
-                    raise NoSuchMigrationError(name)
-                migration_state.mark_as_unapplied(resolved_name)
+            migration_state.mark_many_as_unapplied(
+                self.names_to_mark(migration_state, args[1:], options)
+            )
         
         elif args[0] == 'list':
             migration_state.init()
             for migration_name in migration_db.list():
+                if verbosity >= 2:
+                    description = self.describe(migration_db, migration_name)
+                else:
+                    description = migration_name
                 if migration_state.is_applied(migration_name, use_cache=True):
-                   print "* [+] %s" % migration_name
+                   print "* [+] %s" % description
                 else:
-                   print "* [ ] %s" % migration_name
+                   print "* [ ] %s" % description
             migrations_not_in_db = migration_state.applied_but_not_in_db()
             if migrations_not_in_db:
                 print "These migrations are marked as applied but cannot " \
@@ -116,20 +260,157 @@ class Command(BaseCommand):
         elif args[0] == 'init':
             migration_state.init()
         
+        elif args[0] == 'export_state':
+            if len(args) != 2:
+                raise CommandError('export_state requires exactly 1 argument')
+            migration_state.init()
+            state = migration_state.export_state(
+                include_log = options.get('with_log')
+            )
+            if args[1] == '-':
+                state.write(sys.stdout)
+            else:
+                output = open_state_file(args[1], 'w')
+                try:
+                    state.write(output)
+                finally:
+                    output.close()
+            return
+        
+        elif args[0] == 'import_state':
+            if len(args) != 2:
+                raise CommandError('import_state requires exactly 1 argument')
+            migration_state.init()
+            if args[1] == '-':
+                state = StateFile.read(sys.stdin)
+            else:
+                input = open_state_file(args[1])
+                try:
+                    state = StateFile.read(input)
+                finally:
+                    input.close()
+            migration_state.import_state(state,
+                include_log = options.get('with_log'),
+                replace = options.get('replace'),
+                force = options.get('force'),
+            )
+            if verbosity >= 1:
+                print "Imported %d applied migrations" % len(state.applied)
+        
+        elif args[0] == 'log':
+            if len(args) > 2:
+                raise CommandError('log accepts at most 1 argument')
+            migration_state.init()
+            from dmigrations.migration_log import iter_log, archive_log
+            if options.get('archive_before'):
+                before = self.parse_datetime(options['archive_before'])
+                moved = archive_log(before)
+                if verbosity >= 1:
+                    print "Archived %d log entries" % moved
+                return
+            migration = None
+            if len(args) == 2:
+                # Log may mention migrations which no longer exist
+                migration = migration_state.resolve_name(args[1]) or args[1]
+            for (action, migration_name, status, when) in iter_log(
+                migration = migration,
+            ):
+                print "%s %s %s %s" % (when, action, migration_name, status)
+            return
+        
         elif args[0] == 'cat':
             for name in args[1:]:
-                print open(
-                    migration_db.resolve_migration_path(name), 'r'
-                ).read()
+                path = migration_db.resolve_migration_path(name)
+                paths = [path]
+                if path.endswith(SQL_UP_SUFFIX):
+                    down_path = path[:-len(SQL_UP_SUFFIX)] + SQL_DOWN_SUFFIX
+                    if os.path.exists(down_path):
+                        paths.append(down_path)
+                for path in paths:
+                    source = open(path, 'r')
+                    try:
+                        shutil.copyfileobj(source, sys.stdout)
+                    finally:
+                        source.close()
+                    print
             return
         
         else:
             raise CommandError(
-                'Argument should be one of: list, help, up, down, all, all_hard, init, '
+                'Argument should be one of: list, help, up, down, all, all_hard, all_soft, init, '
                 'apply, unapply, to, downto, upto, mark_as_applied, '
-                'mark_as_unapplied'
+                'mark_as_unapplied, export_state, import_state, log, cat, '
+                'pause_soft, resume_soft, soft_status'
             )
         
+        if options.get('print_plan'):
+            return
+        
+        migration_state.record_state()
+        self.create_permissions(verbosity)
+    
+    def lock_timeout(self, options):
+        if options.get('lock_timeout') is not None:
+            return options['lock_timeout']
+        return getattr(settings, 'DMIGRATIONS_LOCK_TIMEOUT',
+            DEFAULT_LOCK_TIMEOUT)
+    
+    def run_plan(self, migration_db, migration_state, plan, options,
+                 verbosity):
+        jobs = int(options.get('jobs') or 1)
+        if jobs > 1 and options.get('coalesce_alters'):
+            raise CommandError(
+                '--coalesce-alters cannot be used together with --jobs'
+            )
+        if jobs > 1 and not options.get('print_plan'):
+            ParallelScheduler(migration_state, jobs,
+                verbosity = verbosity,
+                print_time = options.get('print_time'),
+            ).run(plan)
+            plan = []
+        if options.get('coalesce_alters'):
+            from dmigrations.mysql.migrations import coalesce_alters, \
+                CoalescedAlterTable
+            steps = coalesce_alters(plan, migration_db)
+        else:
+            steps = [[entry] for entry in plan]
+        for step in steps:
+            start_time = time.time()
+            if len(step) > 1:
+                names = [migration_name for (migration_name, _) in step]
+                if verbosity >= 1:
+                    print "Applying migrations %s as a single ALTER TABLE" \
+                        % ", ".join(names)
+                if not options.get('print_plan'):
+                    migration_state.apply_coalesced(names,
+                        CoalescedAlterTable([
+                            migration_db.load_migration_object(name)
+                            for name in names
+                        ])
+                    )
+                if options.get('print_time'):
+                    print "Migrations %s ran %.1f seconds" % (", ".join(names), time.time() - start_time)
+                continue
+            
+            (migration_name, action) = step[0]
+            if options.get('print_plan') or verbosity >= 2:
+                description = self.describe(migration_db, migration_name)
+            else:
+                description = migration_name
+            if action == 'up':
+                if verbosity >= 1:
+                    print "Applying migration %s" % description
+                if not options.get('print_plan'):
+                    migration_state.apply(migration_name)
+            else:
+                if verbosity >= 1:
+                    print "Unapplying migration %s" % description
+                if not options.get('print_plan'):
+                    migration_state.unapply(migration_name)
+            if options.get('print_time'):
+                print "Migration %s ran %.1f seconds" % (migration_name, time.time() - start_time)
+    
+    def create_permissions(self, verbosity):
         # Ensure Django permissions and content_types have been created
         # NOTE: Don't run if django_content_type doesn't exist yet.
         if table_present('django_content_type'):
@@ -140,3 +421,45 @@ class Command(BaseCommand):
                     create_permissions(app, set(), 2)
                 else:
                     create_permissions(app, set(), 1)
+    
+    def names_to_mark(self, migration_state, names, options):
+        """
+        Return resolved migration names given as arguments, in the file
+        given with --file and up to migration given with --upto.
+        """
+        names = list(names)
+        if options.get('names_file'):
+            for line in open(options['names_file']):
+                line = line.split('#')[0].strip()
+                if line:
+                    names.append(line)
+        
+        resolved_names = []
+        for name in names:
+            resolved_name = migration_state.resolve_name(name)
+            if resolved_name == None:
+                raise NoSuchMigrationError(name)
+            resolved_names.append(resolved_name)
+        
+        if options.get('upto'):
+            resolved_names += migration_state.list_upto(options['upto'])
+        return resolved_names
+    
+    def parse_datetime(self, value):
+        for format in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d'):
+            try:
+                return datetime.datetime.strptime(value, format)
+            except ValueError:
+                pass
+        raise CommandError(
+            'Bad date %r, expected YYYY-MM-DD or YYYY-MM-DD HH:MM:SS' % value
+        )
+    
+    def describe(self, migration_db, migration_name):
+        """
+        Return migration name with summary of its header, if it has one.
+        """
+        header = migration_db.migration_header(migration_name)
+        if header.is_empty():
+            return migration_name
+        return "%s (%s)" % (migration_name, header.summary())
@@ -0,0 +1,200 @@
+"""
+Persistent on-disk cache for migrations directory.
+
+Keeps compiled code objects of migration modules, so they don't have to be
+parsed and compiled on every run, and a manifest of the directory, so it
+doesn't have to be listed and its names parsed when nothing changed.
+"""
+from migration_header import MigrationHeader, read_migration_header
+
+import cPickle as pickle
+import hashlib
+import imp
+import marshal
+import os
+import time
+
+# Name of cache directory kept next to the migrations directory, so
+# deploys shipping the migrations directory don't ship or clobber it
+CACHE_DIR_NAME = '.%s.dmigrations_cache'
+
+# Version of manifest entries, manifests of other versions are ignored.
+# Version 2 soft flags take migration headers into account.
+MANIFEST_VERSION = 2
+
+def default_cache_dir(migrations_dir):
+    parent, name = os.path.split(os.path.abspath(migrations_dir))
+    return os.path.join(parent, CACHE_DIR_NAME % name)
+
+def cache_from_settings(migrations_dir):
+    """
+    Return cache of migrations_dir in DMIGRATIONS_CACHE_DIR, by default
+    next to migrations_dir, or None if DMIGRATIONS_CACHE_DIR is None.
+    """
+    from django.conf import settings
+    cache_dir = getattr(settings, 'DMIGRATIONS_CACHE_DIR',
+        default_cache_dir(migrations_dir))
+    if not cache_dir:
+        return None
+    return MigrationCache(cache_dir)
+
+def _sha1_of(source):
+    return hashlib.sha1(source).hexdigest()
+
+def _stat_matches(entry, stat):
+    """
+    Return True if file with stat is unchanged since entry was saved.
+    Changes made within the same second as the entry was saved don't have
+    to change mtime, so such entries can't be trusted.
+    """
+    return (entry['mtime'], entry['size']) == (stat.st_mtime, stat.st_size) \
+        and stat.st_mtime < entry.get('saved_at', 0) - 1
+
+class MigrationCache(object):
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    @classmethod
+    def for_migrations_dir(cls, migrations_dir):
+        """
+        Return cache kept in a hidden directory next to migrations_dir.
+        """
+        return cls(default_cache_dir(migrations_dir))
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _load(self, name):
+        """
+        Return unpickled cache entry, or None if missing or unreadable.
+        """
+        try:
+            entry_file = open(self._path(name), 'rb')
+        except IOError:
+            return None
+        try:
+            try:
+                return pickle.load(entry_file)
+            except Exception:
+                return None
+        finally:
+            entry_file.close()
+
+    def _save(self, name, entry):
+        """
+        Atomically save cache entry. Failures (like read-only filesystem)
+        are ignored, the cache is only an optimization.
+        """
+        path = self._path(name)
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        try:
+            self._ensure_directory()
+            entry_file = open(tmp_path, 'wb')
+            try:
+                pickle.dump(entry, entry_file, pickle.HIGHEST_PROTOCOL)
+            finally:
+                entry_file.close()
+            os.rename(tmp_path, path)
+        except (IOError, OSError):
+            pass
+
+    def _ensure_directory(self):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def code_for(self, file_path):
+        """
+        Return code object for a migration source file.
+
+        Cache entries are keyed by file mtime and size. If only mtime
+        changed, the source hash decides if the cached code is still valid.
+        """
+        saved_at = time.time()
+        stat = os.stat(file_path)
+        name = os.path.basename(file_path) + '.code'
+        entry = self._load(name)
+
+        if entry is not None and entry['magic'] == imp.get_magic():
+            if _stat_matches(entry, stat):
+                return marshal.loads(entry['code'])
+
+        source = open(file_path, 'rU').read()
+        sha1 = _sha1_of(source)
+
+        if entry is not None and entry['magic'] == imp.get_magic() \
+            and entry['sha1'] == sha1:
+            code = marshal.loads(entry['code'])
+        else:
+            code = compile(source, file_path, 'exec')
+
+        self._save(name, {
+            'magic': imp.get_magic(),
+            'mtime': stat.st_mtime,
+            'size': stat.st_size,
+            'saved_at': saved_at,
+            'sha1': sha1,
+            'code': marshal.dumps(code),
+        })
+        return code
+
+    def header_for(self, file_path):
+        """
+        Return MigrationHeader of a migration source file, keyed by file
+        mtime and size like code_for.
+        """
+        saved_at = time.time()
+        stat = os.stat(file_path)
+        name = os.path.basename(file_path) + '.header'
+        entry = self._load(name)
+
+        if entry is not None and _stat_matches(entry, stat):
+            return MigrationHeader(**entry['header'])
+
+        header = read_migration_header(file_path)
+        self._save(name, {
+            'mtime': stat.st_mtime,
+            'size': stat.st_size,
+            'saved_at': saved_at,
+            'header': header.__dict__,
+        })
+        return header
+
+    def directory_stamp(self, migrations_dir):
+        """
+        Return (mtime, time) stamp of migrations_dir, to be taken just
+        before it's listed and passed to save_manifest.
+        """
+        # Creating a cache directory inside migrations_dir would change its
+        # mtime
+        try:
+            self._ensure_directory()
+        except OSError:
+            pass
+        return (os.stat(migrations_dir).st_mtime, time.time())
+
+    def load_manifest(self, migrations_dir):
+        """
+        Return cached manifest of migrations_dir, or None if it's missing
+        or the directory might have changed since it was scanned.
+        """
+        entry = self._load('manifest')
+        if entry is None or entry.get('version') != MANIFEST_VERSION or \
+            entry['directory'] != migrations_dir:
+            return None
+
+        mtime, scanned_at = entry['stamp']
+        # Changes made within the same second as the scan don't have to
+        # change mtime, so such manifests can't be trusted.
+        if os.stat(migrations_dir).st_mtime != mtime or mtime >= scanned_at - 1:
+            return None
+
+        return entry['manifest']
+
+    def save_manifest(self, migrations_dir, stamp, manifest):
+        self._save('manifest', {
+            'version': MANIFEST_VERSION,
+            'directory': migrations_dir,
+            'stamp': stamp,
+            'manifest': manifest,
+        })
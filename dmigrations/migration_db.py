@@ -1,14 +1,209 @@
 from migration_loader import load_migration_from_path
+from migration_header import MigrationHeader, read_migration_header
+from migrations import SQL_UP_SUFFIX
 from exceptions import *
 
 import os, sys
 import re
+import hashlib
+from bisect import bisect_right
+
+def migration_number(migration):
+    """
+    Return migration number based on migration name like <int>_<anything>
+    """
+    m = re.search(r'(\d+)_', migration)
+    if m:
+        return int(m.group(1))
+    else:
+        raise Exception(u"%s is not a valid migration name" % migration)
+
+class MigrationIndex(object):
+    """
+    Immutable index of migration names, built once per directory scan.
+    
+    Names are kept sorted by number first, then by ascii, with numbers
+    and DEV/SOFT flags precomputed so lookups don't run any regexes.
+    """
+    
+    def __init__(self, migrations, soft_header=None):
+        """
+        soft_header, if given, is called with a migration name and returns
+        the soft flag of its header, or None if the header doesn't set one.
+        It's called for all migrations the first time soft ones are needed.
+        """
+        self._build(
+            sorted((migration_number(m), m) for m in migrations),
+            [m for m in migrations if '_DEV_' in m],
+            None,
+        )
+        self._soft_header = soft_header
+    
+    @classmethod
+    def from_manifest(cls, manifest):
+        """
+        Build index from entries returned by to_manifest(), without
+        parsing any names.
+        """
+        index = cls.__new__(cls)
+        index._soft_header = None
+        index._build(
+            [(number, name) for (name, number, dev, soft) in manifest],
+            [name for (name, number, dev, soft) in manifest if dev],
+            [name for (name, number, dev, soft) in manifest if soft],
+        )
+        return index
+    
+    def to_manifest(self):
+        """
+        Return plain (name, number, dev, soft) tuples describing the index.
+        """
+        return [
+            (name, number, name in self.dev, name in self.soft)
+            for (name, number) in zip(self.names, self.numbers)
+        ]
+    
+    def _build(self, keyed, dev, soft):
+        keyed = sorted(keyed)
+        self.names = tuple([name for (number, name) in keyed])
+        self.numbers = tuple([number for (number, name) in keyed])
+        self.positions = dict((name, i) for (i, name) in enumerate(self.names))
+        
+        by_number = {}
+        for (number, name) in keyed:
+            by_number.setdefault(number, []).append(name)
+        self.by_number = dict(
+            (number, tuple(names)) for (number, names) in by_number.items()
+        )
+        
+        self.dev = frozenset(dev)
+        if soft is not None:
+            soft = frozenset(soft)
+        self._soft = soft
+        self._digests = {}
+    
+    @property
+    def soft(self):
+        """
+        Set of SOFT migrations: those with "_SOFT_" in their name, unless
+        their header says otherwise.
+        """
+        if self._soft is None:
+            soft = []
+            for name in self.names:
+                flag = None
+                if self._soft_header is not None:
+                    flag = self._soft_header(name)
+                if flag is None:
+                    flag = '_SOFT_' in name
+                if flag:
+                    soft.append(name)
+            self._soft = frozenset(soft)
+        return self._soft
+    
+    def __contains__(self, name):
+        return name in self.positions
+    
+    def __len__(self):
+        return len(self.names)
+    
+    def number_of(self, name):
+        return self.numbers[self.positions[name]]
+    
+    def with_number(self, number):
+        """
+        Return tuple of migrations with given number.
+        """
+        return self.by_number.get(number, ())
+    
+    def count_upto(self, number):
+        """
+        Return number of migrations numbered less than or equal to number.
+        """
+        return bisect_right(self.numbers, number)
+    
+    def max_number(self):
+        if self.numbers:
+            return self.numbers[-1]
+        return 0
+    
+    def digest(self, dev=False):
+        """
+        Return SHA-1 hex digest of migration names, excluding DEV ones
+        unless dev is set.
+        """
+        if dev not in self._digests:
+            names = self.names
+            if not dev:
+                names = [m for m in names if m not in self.dev]
+            self._digests[dev] = hashlib.sha1("\n".join(names)).hexdigest()
+        return self._digests[dev]
+
+class MigrationRegistry(object):
+    """
+    Bounded per-process registry of loaded migration objects, so each
+    migration module is imported only once per run.
+    
+    Memory used by a migration is estimated by size of its source file.
+    Least recently used migrations are evicted when total size exceeds
+    max_size.
+    """
+    
+    def __init__(self, max_size=64 * 1024 * 1024):
+        self.max_size = max_size
+        self.size = 0
+        self._entries = {}
+        self._order = []
+    
+    def __contains__(self, name):
+        return name in self._entries
+    
+    def get(self, name):
+        """
+        Return registered migration, or None if it's not registered.
+        """
+        if name not in self._entries:
+            return None
+        self._order.remove(name)
+        self._order.append(name)
+        return self._entries[name][0]
+    
+    def add(self, name, migration, size=0):
+        """
+        Register migration, evicting old ones if necessary.
+        Migrations bigger than the whole registry are not kept.
+        """
+        self.remove(name)
+        if size > self.max_size:
+            return
+        self._entries[name] = (migration, size)
+        self._order.append(name)
+        self.size += size
+        while self.size > self.max_size:
+            self.remove(self._order[0])
+    
+    def remove(self, name):
+        if name in self._entries:
+            self.size -= self._entries.pop(name)[1]
+            self._order.remove(name)
+    
+    def clear(self):
+        self._entries = {}
+        self._order = []
+        self.size = 0
 
 class MigrationDb(object):
     
-    def __init__(self, directory=None, migrations=None):
+    def __init__(self, directory=None, migrations=None, registry=None,
+                 cache=None):
         self.directory = directory
+        self.cache = cache
+        self._headers = {}
         self._migrations = migrations
+        self._index = None
+        if registry is None:
+            registry = MigrationRegistry()
+        self.registry = registry
     
     @property
     def migrations(self):
@@ -20,27 +215,54 @@ class MigrationDb(object):
         
         return self._migrations
     
+    @property
+    def index(self):
+        """
+        Lazy MigrationIndex of migrations.
+        """
+        # Populating from the cached manifest builds the index too
+        migrations = self.migrations
+        if self._index is None:
+            self._index = MigrationIndex(migrations,
+                lambda name: self.migration_header(name).soft
+            )
+        return self._index
+    
     def populate_migrations_from_ls(self, ls):
         """
-        Populate a list of migrations based on directory listing.
+        Populate a list of migrations based on directory listing, from
+        NNN_name.py and NNN_name.up.sql files.
         Separate from populate_migrations_from_directory for easier testing.
         """
-        self._migrations = [
-            re.sub(r'\.py$', '', file_name) 
-            for file_name in ls 
+        py_migrations = set([
+            re.sub(r'\.py$', '', file_name)
+            for file_name in ls
             if re.search(r'^\d+_.*\.py$', file_name)
-        ]
+        ])
+        sql_migrations = set([
+            file_name[:-len(SQL_UP_SUFFIX)]
+            for file_name in ls
+            if re.search(r'^\d+_.*\.up\.sql$', file_name)
+        ])
+        for name in sorted(py_migrations & sql_migrations):
+            self.warn(
+                u"Migration %s has both .py and %s files, using .py" % (
+                    name, SQL_UP_SUFFIX
+                )
+            )
+        self._migrations = list(py_migrations | sql_migrations)
+        self._index = None
+        self._headers = {}
+        self.registry.clear()
         self.warn_if_duplicate_migration_numbers()
     
     def migration_number(self, migration):
         """
         Return migration number based on migration name like <int>_<anything>
         """
-        m = re.search(r'(\d+)_', migration)
-        if m:
-            return int(m.group(1))
-        else:
-            raise Exception(u"%s is not a valid migration name" % migration)
+        if migration in self.index:
+            return self.index.number_of(migration)
+        return migration_number(migration)
     
     def migration_sort_key(self, migration):
         """
@@ -60,20 +282,13 @@ class MigrationDb(object):
         This situation is explicitly SUPPORTED, so it's not an error,
         but more likely than not it's not what you want to do.
         """
-        by_number = {}
-        
-        for migration_name in self.migrations:
-            i = self.migration_number(migration_name)
-            by_number.setdefault(i, [])
-            by_number[i].append(migration_name)
+        by_number = self.index.by_number
         
         for number in sorted(by_number.keys()):
             if len(by_number[number]) > 1:
                 self.warn(
                     u"There are multiple migrations with the same number "
-                     "%d: %s" % (number, ", ".join(
-                        sorted(by_number[number])
-                    ))
+                     "%d: %s" % (number, ", ".join(by_number[number]))
                 )
     
     def warn(self, warning):
@@ -89,32 +304,72 @@ class MigrationDb(object):
         """
         if self.directory == None:
             self.populate_migrations_from_ls([])
+        elif self.cache is None:
+            self.populate_migrations_from_ls(os.listdir(self.directory))
         else:
+            self.populate_migrations_from_cache()
+    
+    def populate_migrations_from_cache(self):
+        """
+        Populate list of migrations from cached manifest of self.directory,
+        scanning the directory only if it changed since manifest was saved.
+        """
+        manifest = self.cache.load_manifest(self.directory)
+        if manifest is None:
+            stamp = self.cache.directory_stamp(self.directory)
             self.populate_migrations_from_ls(os.listdir(self.directory))
+            self.cache.save_manifest(
+                self.directory, stamp, self.index.to_manifest()
+            )
+        else:
+            self._index = MigrationIndex.from_manifest(manifest)
+            self._migrations = list(self._index.names)
+            self._headers = {}
+            self.registry.clear()
+            self.warn_if_duplicate_migration_numbers()
     
     def list(self):
         """
         Return ordered list of migrations in the database.
         """
-        return self.sort_migrations(self.migrations)
+        return list(self.index.names)
     
     def is_dev_migration(self, name):
         """
         Migration is a DEV migration if it has string "_DEV_" in its name.
         """
-        return bool(re.search(r'_DEV_', name))
+        if name in self.index:
+            return name in self.index.dev
+        return '_DEV_' in name
     
     def is_soft_migration(self, name):
         """
-        Migration is a SOFT migration if it has string "_SOFT_" in its name.
+        Migration is a SOFT migration if it has string "_SOFT_" in its name,
+        unless its header says otherwise. Flags of all migrations are kept
+        in the index (and the cached manifest), so headers are read at
+        most once per directory scan.
+        """
+        if name in self.index:
+            return name in self.index.soft
+        return '_SOFT_' in name
+    
+    def migration_header(self, name):
+        """
+        Return MigrationHeader of migration, read without importing it.
+        Migrations not loaded from a directory have empty headers.
         """
-        return bool(re.search(r'_SOFT_', name))
+        if self.directory is None:
+            return MigrationHeader()
+        if name not in self._headers:
+            full_path = self.resolve_migration_path(name)
+            if self.cache is None:
+                self._headers[name] = read_migration_header(full_path)
+            else:
+                self._headers[name] = self.cache.header_for(full_path)
+        return self._headers[name]
 
     def find_unique_migration_by_number(self, number):
-        matching_migrations = [
-            name for name in self.migrations 
-            if self.migration_number(name) == number
-        ]
+        matching_migrations = self.index.with_number(number)
         
         if len(matching_migrations) == 0:
             return None
@@ -128,7 +383,7 @@ class MigrationDb(object):
         Take either full name or a number, and return full name for an 
         existing migration.
         """
-        if name in self.migrations:
+        if name in self.index:
             return name
         elif re.search(r'^\d+$', str(name)):
             resolved_migration_name = self.find_unique_migration_by_number(
@@ -143,28 +398,62 @@ class MigrationDb(object):
     
     def resolve_migration_path(self, name):
         """
-        Return path for existing migration name.
+        Return path for existing migration name, its .py file or, if
+        there's none, its .up.sql file.
         """
         name = self.force_resolve_migration_name(name)
-        return os.path.join(self.directory, name + ".py")
+        path = os.path.join(self.directory, name + ".py")
+        if not os.path.exists(path):
+            sql_path = os.path.join(self.directory, name + SQL_UP_SUFFIX)
+            if os.path.exists(sql_path):
+                return sql_path
+        return path
     
     def migration_path(self, name):
         """
         Return path for new migration name.
         """
-        number = 1 + max([0] + [
-            self.migration_number(migration) for migration in self.migrations
-        ])
+        number = 1 + self.index.max_number()
         
         return u"%s/%04d_%s.py" % (self.directory, number, name)
     
+    def migration_content_hash(self, name):
+        """
+        Return SHA-1 hex digest of migration source, or None if migrations
+        don't come from a directory.
+        """
+        if self.directory is None:
+            return None
+        sha1 = hashlib.sha1()
+        source = open(self.resolve_migration_path(name), 'rb')
+        try:
+            # .sql migrations can be huge, so don't read them in one go
+            for chunk in iter(lambda: source.read(1024 * 1024), ''):
+                sha1.update(chunk)
+        finally:
+            source.close()
+        return sha1.hexdigest()
+    
     def load_migration_object(self, name):
         """
         Get migration with given name or number.
+        Migrations are loaded once and then returned from the registry.
         """
         
         name = self.force_resolve_migration_name(name)
+        migration = self.registry.get(name)
+        if migration is not None:
+            return migration
+        
         full_path = self.resolve_migration_path(name)
         dev = self.is_dev_migration(name)
         
-        return load_migration_from_path(full_path, dev=dev)
+        migration = load_migration_from_path(full_path, dev=dev,
+                                             cache=self.cache)
+        if full_path.endswith(SQL_UP_SUFFIX):
+            # Statements aren't kept in memory, only file names
+            size = 0
+        else:
+            size = os.path.getsize(full_path)
+        self.registry.add(name, migration, size)
+        return migration
@@ -0,0 +1,111 @@
+"""
+Declarative migration headers, which can be read without importing
+the migration. A header is a block of comments at the top of the file:
+
+    # dmigrations: tables = blog_entry, blog_category
+    # dmigrations: soft = yes
+    # dmigrations: cost = 600
+    # dmigrations: reversible = no
+
+All fields are optional. cost is an estimate of running time in seconds.
+"""
+from exceptions import *
+
+import re
+
+header_line_re = re.compile(r'^(?:#|--)\s*dmigrations:\s*(\w+)\s*=\s*(.*?)\s*$')
+comment_line_re = re.compile(r'^(?:#|--)|^\s*$')
+
+def _parse_bool(value):
+    value = value.lower()
+    if value in ('yes', 'true', '1'):
+        return True
+    if value in ('no', 'false', '0'):
+        return False
+    raise ValueError(value)
+
+def _parse_tables(value):
+    return tuple([t.strip().strip('`') for t in value.split(',') if t.strip()])
+
+class MigrationHeader(object):
+    fields = {
+        'tables': _parse_tables,
+        'soft': _parse_bool,
+        'cost': int,
+        'reversible': _parse_bool,
+    }
+
+    def __init__(self, tables=None, soft=None, cost=None, reversible=None):
+        self.tables = tables
+        self.soft = soft
+        self.cost = cost
+        self.reversible = reversible
+
+    def is_empty(self):
+        return self.tables is None and self.soft is None and \
+            self.cost is None and self.reversible is None
+
+    def summary(self):
+        """
+        Return short human-readable description, like
+        "tables: blog_entry; soft; cost: 600s; irreversible"
+        """
+        parts = []
+        if self.tables is not None:
+            parts.append("tables: %s" % ", ".join(self.tables))
+        if self.soft:
+            parts.append("soft")
+        if self.cost is not None:
+            parts.append("cost: %ds" % self.cost)
+        if self.reversible is False:
+            parts.append("irreversible")
+        return "; ".join(parts)
+
+    def __eq__(self, other):
+        return isinstance(other, MigrationHeader) and \
+            self.__dict__ == other.__dict__
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "MigrationHeader(%s)" % ", ".join(
+            "%s=%r" % (k, v) for (k, v) in sorted(self.__dict__.items())
+        )
+
+def parse_migration_header(lines, file_path='<string>'):
+    """
+    Parse header from lines of migration source. Only the leading block
+    of comments and blank lines is looked at.
+    """
+    values = {}
+    for line in lines:
+        if not comment_line_re.search(line):
+            break
+        m = header_line_re.search(line)
+        if not m:
+            continue
+        key, value = m.group(1), m.group(2)
+        if key not in MigrationHeader.fields:
+            raise BadMigrationError(
+                u"Unknown header field %s in %s" % (key, file_path)
+            )
+        try:
+            values[key] = MigrationHeader.fields[key](value)
+        except ValueError:
+            raise BadMigrationError(
+                u"Bad value %r of header field %s in %s" % (
+                    value, key, file_path
+                )
+            )
+    return MigrationHeader(**values)
+
+def read_migration_header(file_path):
+    """
+    Read header of migration file, without importing it.
+    """
+    source = open(file_path, 'rU')
+    try:
+        return parse_migration_header(source, file_path)
+    finally:
+        source.close()
@@ -0,0 +1,122 @@
+"""
+Journal of steps finished by migrations while they run, so a migration
+that failed half way can be resumed instead of run from the start.
+
+Steps are statements of a Migration, or child migrations of a Compound.
+Each child has a journal of its own, keyed "<parent key>/<position>".
+"""
+from migration_state import _execute, _execute_in_transaction, table_present
+
+import sys
+
+JOURNAL_TABLE_SQL = """
+    CREATE TABLE `dmigrations_journal` (
+     `migration` VARCHAR(255) NOT NULL,
+     `direction` VARCHAR(4) NOT NULL,
+     `steps_done` int(11) NOT NULL,
+      PRIMARY KEY (`migration`, `direction`)
+    ) ENGINE=InnoDB DEFAULT CHARSET=utf8
+"""
+
+def init():
+    """
+    Create migration journal if it doesn't exist
+    """
+    if not table_present('dmigrations_journal'):
+        _execute(JOURNAL_TABLE_SQL)
+
+def _key_condition(key):
+    """
+    Return (sql, params) condition matching journal of key and all its
+    children.
+    """
+    escaped = key.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return ("(migration = %s OR migration LIKE %s)", [key, escaped + '/%'])
+
+class StepJournal(object):
+
+    def __init__(self, key, direction, steps_done=0):
+        self.key = key
+        self.direction = direction
+        self.steps_done = steps_done
+
+    @classmethod
+    def load(cls, key, direction):
+        row = _execute("""
+            SELECT steps_done FROM dmigrations_journal
+            WHERE migration = %s AND direction = %s
+        """, [key, direction]).fetchone()
+        if row is None:
+            return cls(key, direction)
+        return cls(key, direction, row[0])
+
+    @classmethod
+    def start(cls, name, direction):
+        """
+        Return journal for migration about to run with --resume.
+        """
+        journal = cls.load(name, direction)
+        if journal.steps_done:
+            print u"Resuming migration %s after %d finished steps" % (
+                name, journal.steps_done
+            )
+        return journal
+
+    @classmethod
+    def discard(cls, name):
+        """
+        Forget progress of migration about to run without --resume.
+        """
+        print >>sys.stderr, u"Migration %s was interrupted before, " \
+            "running it from the start (use --resume to continue " \
+            "instead)" % name
+        cls(name, None).clear()
+
+    @classmethod
+    def interrupted_migrations(cls):
+        """
+        Return set of names of migrations with progress recorded.
+        """
+        cursor = _execute("SELECT DISTINCT migration FROM dmigrations_journal")
+        # Child journals are keyed "<parent key>/<position>"
+        return set([row[0].split('/')[0] for row in cursor.fetchall()])
+
+    @classmethod
+    def interrupted(cls, name):
+        """
+        Return True if journal has any progress recorded for migration.
+        """
+        condition, params = _key_condition(name)
+        return bool(_execute(
+            "SELECT COUNT(*) FROM dmigrations_journal WHERE " + condition,
+            params
+        ).fetchone()[0])
+
+    def child(self, i):
+        """
+        Return journal of i-th child migration.
+        """
+        return self.load('%s/%d' % (self.key, i), self.direction)
+
+    def record(self, steps_done):
+        """
+        Record progress on the migration's own connection, without BEGIN
+        or COMMIT, so a transaction the migration has open isn't committed
+        early. The row is committed together with the migration's work.
+        """
+        self.steps_done = steps_done
+        _execute("""
+            INSERT INTO dmigrations_journal (migration, direction, steps_done)
+            VALUES (%s, %s, %s)
+            ON DUPLICATE KEY UPDATE steps_done = VALUES(steps_done)
+        """, [self.key, self.direction, steps_done])
+
+    def clear(self):
+        """
+        Forget progress of migration and its children, in both directions.
+        """
+        condition, params = _key_condition(self.key)
+        _execute_in_transaction(
+            "DELETE FROM dmigrations_journal WHERE " + condition, params
+        )
+        self.steps_done = 0
@@ -1,28 +1,33 @@
-from migrations import BaseMigration
+from migrations import BaseMigration, SqlFileMigration, \
+    SQL_UP_SUFFIX, SQL_DOWN_SUFFIX
 from exceptions import *
 
 import imp
-import os
+import os, sys
 
-def load_migration_from_path(file_path, dev=False):
+def load_migration_from_path(file_path, dev=False, cache=None):
     """
     Given a file_path to a 001_blah.py file, returns the migration object
-    contained in that file. The file should have a "migration" symbol which
-    is an instance of a BaseMigration subclass. Raise an error otherwise.
-    """
-    dir_name, file_name = os.path.split(file_path)
+    contained in that file. For a 001_blah.up.sql file, returns
+    SqlFileMigration running it (and 001_blah.down.sql, if present).
     
-    mod_name = file_name.replace('.py', '')
-    dot_py_suffix = ('.py', 'U', 1) # From imp.get_suffixes()[2]
+    A .py file should have a "migration" symbol which is an instance
+    of a BaseMigration subclass. Raise an error otherwise.
     
-    mod = imp.load_module(mod_name, open(file_path), file_path, dot_py_suffix)
+    If cache (a MigrationCache) is given, compiled code is taken from it
+    instead of compiling the source again.
+    """
+    dir_name, file_name = os.path.split(file_path)
     
-    try:
-        migration = mod.migration
-    except AttributeError:
-        raise BadMigrationError(
-            u'Module %s has no migration instance' % file_path
-        )
+    if file_name.endswith(SQL_UP_SUFFIX):
+        mod_name = file_name[:-len(SQL_UP_SUFFIX)]
+        down_path = os.path.join(dir_name, mod_name + SQL_DOWN_SUFFIX)
+        if not os.path.exists(down_path):
+            down_path = None
+        migration = SqlFileMigration(file_path, down_path)
+    else:
+        mod_name = file_name.replace('.py', '')
+        migration = load_migration_module(file_path, mod_name, cache)
     
     if not isinstance(migration, BaseMigration):
         raise BadMigrationError(
@@ -35,3 +40,26 @@ def load_migration_from_path(file_path, dev=False):
     migration.dev = dev
     
     return migration
+
+def load_migration_module(file_path, mod_name, cache=None):
+    """
+    Import migration module and return its migration instance.
+    """
+    if cache is None:
+        dot_py_suffix = ('.py', 'U', 1) # From imp.get_suffixes()[2]
+        mod = imp.load_module(
+            mod_name, open(file_path), file_path, dot_py_suffix
+        )
+    else:
+        code = cache.code_for(file_path)
+        mod = imp.new_module(mod_name)
+        mod.__file__ = file_path
+        sys.modules[mod_name] = mod
+        exec code in mod.__dict__
+    
+    try:
+        return mod.migration
+    except AttributeError:
+        raise BadMigrationError(
+            u'Module %s has no migration instance' % file_path
+        )
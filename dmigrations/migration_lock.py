@@ -0,0 +1,97 @@
+"""
+Advisory lock held while migrating, so when several hosts run dmigrate
+against the same database at once, only one of them migrates at a time.
+
+Soft migrations can run for hours, so the background worker applying
+them only holds that lock while planning. It holds the separate soft
+lock instead, which dmigrate runs that may apply soft migrations wait
+for too. The soft lock is held on a connection of its own, as before
+MySQL 5.7.5 taking a lock releases the one the connection already holds.
+"""
+from migration_state import _execute
+from exceptions import *
+
+import threading
+
+# Seconds to wait for the lock, DMIGRATIONS_LOCK_TIMEOUT setting overrides it
+DEFAULT_LOCK_TIMEOUT = 600
+
+# MySQL locks are per server, so the name includes the database. Lock names
+# can be at most 64 characters long.
+LOCK_NAME_SQL = "LEFT(CONCAT('dmigrations.', DATABASE()), 64)"
+SOFT_LOCK_NAME_SQL = "LEFT(CONCAT('dmigrations_soft.', DATABASE()), 64)"
+
+def _get_lock(name_sql, timeout):
+    row = _execute(
+        "SELECT GET_LOCK(%s, %%s)" % name_sql, [timeout]
+    ).fetchone()
+    # GET_LOCK returns 1 if locked, 0 on timeout and NULL on error
+    return row[0] == 1
+
+def acquire_lock(timeout=DEFAULT_LOCK_TIMEOUT):
+    """
+    Wait up to timeout seconds for the migration lock. The lock is held by
+    the database connection, so it's released when the connection closes.
+    """
+    if not _get_lock(LOCK_NAME_SQL, timeout):
+        raise LockTimeoutError(
+            u"Another dmigrate is still running after waiting %d seconds "
+            "for it" % timeout
+        )
+
+def release_lock():
+    _execute("SELECT RELEASE_LOCK(%s)" % LOCK_NAME_SQL)
+
+class SoftLock(threading.Thread):
+    """
+    Thread holding the soft migrations lock on its own database connection
+    until released.
+    """
+
+    def __init__(self, timeout):
+        super(SoftLock, self).__init__()
+        self.daemon = True
+        self.timeout = timeout
+        self.error = None
+        self.ready = threading.Event()
+        self.released = threading.Event()
+
+    def run(self):
+        from django.db import connection
+        try:
+            try:
+                if not _get_lock(SOFT_LOCK_NAME_SQL, self.timeout):
+                    raise LockTimeoutError(
+                        u"Soft migrations are still being applied after "
+                        "waiting %d seconds for them, see dmigrate "
+                        "soft_status" % self.timeout
+                    )
+            except Exception, e:
+                self.error = e
+                return
+            self.ready.set()
+            self.released.wait()
+            _execute("SELECT RELEASE_LOCK(%s)" % SOFT_LOCK_NAME_SQL)
+        finally:
+            self.ready.set()
+            connection.close()
+
+    def release(self):
+        self.released.set()
+        self.join()
+
+def acquire_soft_lock(timeout=DEFAULT_LOCK_TIMEOUT):
+    """
+    Wait up to timeout seconds for the soft migrations lock, and return
+    SoftLock holding it until its release() is called. When both locks are
+    needed, this one must be taken first.
+    """
+    lock = SoftLock(timeout)
+    lock.start()
+    # Waiting with a timeout, so KeyboardInterrupt isn't held up
+    while not lock.ready.isSet():
+        lock.ready.wait(1)
+    if lock.error is not None:
+        lock.join()
+        raise lock.error
+    return lock
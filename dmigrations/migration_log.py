@@ -1,5 +1,9 @@
 import datetime
-from migration_state import _execute, _execute_in_transaction, table_present
+from migration_state import _execute, _execute_in_transaction, \
+    _execute_statements_in_transaction, _chunks, table_present, table_version
+
+# Version of the dmigrations_log table layout, kept in the table comment
+MIGRATION_LOG_VERSION = 2
 
 MIGRATION_LOG_SQL = """
     CREATE TABLE `dmigrations_log` (
@@ -8,23 +12,142 @@ MIGRATION_LOG_SQL = """
     `migration` VARCHAR(255) NOT NULL,
     `status` VARCHAR(255) NOT NULL,
     `datetime` DATETIME NOT NULL,
-     PRIMARY KEY  (`id`)
+     PRIMARY KEY  (`id`),
+     KEY `migration_datetime` (`migration`, `datetime`),
+     KEY `datetime` (`datetime`)
     ) ENGINE=InnoDB AUTO_INCREMENT=2 DEFAULT CHARSET=utf8
+      COMMENT='dmigrations_log schema %d'
+""" % MIGRATION_LOG_VERSION
+
+# Statements upgrading the table from version (key - 1) to version key
+MIGRATION_LOG_UPGRADES = {
+    2: [
+        """
+            ALTER TABLE `dmigrations_log`
+             ADD KEY `migration_datetime` (`migration`, `datetime`),
+             ADD KEY `datetime` (`datetime`),
+             COMMENT='dmigrations_log schema 2'
+        """,
+    ],
+}
+
+MIGRATION_LOG_ARCHIVE_SQL = """
+    CREATE TABLE IF NOT EXISTS `dmigrations_log_archive` LIKE `dmigrations_log`
 """
 
+LOG_COLUMNS = "id, action, migration, status, datetime"
+
 def init():
     """
-    Create migration log if it doesn't exist
+    Create migration log if it doesn't exist, or upgrade it to the current
+    version
     """
     if not table_present('dmigrations_log'):
       _execute(MIGRATION_LOG_SQL)
-  
+    else:
+      version = table_version('dmigrations_log', 'dmigrations_log schema')
+      while version < MIGRATION_LOG_VERSION:
+        version += 1
+        for sql in MIGRATION_LOG_UPGRADES[version]:
+          _execute(sql)
+
+def iter_log(since=None, until=None, migration=None, status=None,
+             chunk_size=1000):
+    """
+    Yield (action, migration, status, datetime) log entries ordered by
+    datetime, optionally only from since (inclusive) until (exclusive),
+    of given migration or with given status.
+    
+    Entries are fetched chunk_size at a time, each chunk starting after
+    the last entry of the previous one, so the whole log is never loaded
+    into memory and late chunks are as cheap as early ones.
+    """
+    conditions, params = [], []
+    if since is not None:
+        conditions.append("datetime >= %s")
+        params.append(since)
+    if until is not None:
+        conditions.append("datetime < %s")
+        params.append(until)
+    if migration is not None:
+        conditions.append("migration = %s")
+        params.append(migration)
+    if status is not None:
+        conditions.append("status = %s")
+        params.append(status)
+    
+    last = None
+    while True:
+        page_conditions, page_params = list(conditions), list(params)
+        if last is not None:
+            page_conditions.append(
+                "(datetime > %s OR (datetime = %s AND id > %s))"
+            )
+            page_params += [last[0], last[0], last[1]]
+        sql = "SELECT %s FROM dmigrations_log" % LOG_COLUMNS
+        if page_conditions:
+            sql += " WHERE " + " AND ".join(page_conditions)
+        sql += " ORDER BY datetime, id LIMIT %d" % chunk_size
+        
+        rows = _execute(sql, page_params).fetchall()
+        for row in rows:
+            yield tuple(row[1:])
+        if len(rows) < chunk_size:
+            return
+        last = (rows[-1][4], rows[-1][0])
+
 def get_log():
-    return list(_execute("""
-        SELECT action, migration, status, datetime 
-        FROM dmigrations_log 
-        ORDER BY datetime, id"""
-    ).fetchall())
+    return list(iter_log())
+
+def archive_log(before, chunk_size=1000):
+    """
+    Move log entries older than before to dmigrations_log_archive,
+    chunk_size entries per transaction. Return number of entries moved.
+    """
+    _execute(MIGRATION_LOG_ARCHIVE_SQL)
+    moved = 0
+    while True:
+        ids = [row[0] for row in _execute("""
+            SELECT id FROM dmigrations_log WHERE datetime < %%s
+            ORDER BY datetime, id LIMIT %d
+        """ % chunk_size, [before]).fetchall()]
+        if not ids:
+            return moved
+        in_ids = ", ".join(["%s"] * len(ids))
+        _execute_statements_in_transaction([
+            ("""
+                INSERT INTO dmigrations_log_archive (%s)
+                SELECT %s FROM dmigrations_log WHERE id IN (%s)
+            """ % (LOG_COLUMNS, LOG_COLUMNS, in_ids), ids),
+            ("DELETE FROM dmigrations_log WHERE id IN (%s)" % in_ids, ids),
+        ])
+        moved += len(ids)
+
+def log_actions_statements(entries, when=None):
+    """
+    Return list of (sql, params) multi-row statements logging entries,
+    which are (action, migration, status) tuples.
+    """
+    if when == None:
+        when = datetime.datetime.now()
+    statements = []
+    for chunk in _chunks(entries):
+        params = []
+        for (action, migration, status) in chunk:
+            params += [action, migration, status, when]
+        statements.append(("""
+            INSERT INTO dmigrations_log(action, migration, status, datetime) 
+            VALUES %s
+        """ % ", ".join(["(%s, %s, %s, %s)"] * len(chunk)), params))
+    return statements
+
+def log_actions(entries, when=None):
+    """
+    Log many (action, migration, status) entries in a single transaction.
+    """
+    statements = log_actions_statements(entries, when)
+    if statements:
+        _execute_statements_in_transaction(statements)
 
 def log_action(action, migration, status, when=None):
     if when == None:
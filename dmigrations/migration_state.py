@@ -1,6 +1,43 @@
 from django.db import connection
 from exceptions import *
+import os, sys
 import re
+import time
+
+# Version of the dmigrations table layout, kept in the table comment.
+# Version 1 is the original table without a comment.
+MIGRATION_TABLE_VERSION = 2
+
+MIGRATION_TABLE_SQL = """
+    CREATE TABLE `dmigrations` (
+     `id` int(11) NOT NULL auto_increment,
+     `migration` VARCHAR(255) NOT NULL,
+     `applied_at` DATETIME NULL,
+     `duration_ms` int(11) NULL,
+     `content_hash` CHAR(40) NULL,
+      PRIMARY KEY (`id`),
+      UNIQUE KEY `migration` (`migration`)
+    ) ENGINE=InnoDB DEFAULT CHARSET=utf8 COMMENT='dmigrations schema %d'
+""" % MIGRATION_TABLE_VERSION
+
+# Statements upgrading the table from version (key - 1) to version key
+MIGRATION_TABLE_UPGRADES = {
+    2: [
+        # The unique index can't be added while duplicates are present
+        """
+            DELETE d1 FROM `dmigrations` d1, `dmigrations` d2
+            WHERE d1.migration = d2.migration AND d1.id > d2.id
+        """,
+        """
+            ALTER TABLE `dmigrations`
+             ADD COLUMN `applied_at` DATETIME NULL,
+             ADD COLUMN `duration_ms` int(11) NULL,
+             ADD COLUMN `content_hash` CHAR(40) NULL,
+             ADD UNIQUE KEY `migration` (`migration`),
+             COMMENT='dmigrations schema 2'
+        """,
+    ],
+}
 
 def _execute(*sql):
     cursor = connection.cursor()
@@ -13,117 +50,680 @@ def _execute_in_transaction(*sql):
     cursor.execute(*sql)
     cursor.execute("COMMIT")
 
+def _execute_statements_in_transaction(statements):
+    """
+    Execute a list of (sql, params) pairs in a single transaction.
+    """
+    cursor = connection.cursor()
+    cursor.execute("BEGIN")
+    try:
+        for statement in statements:
+            cursor.execute(*statement)
+    except:
+        cursor.execute("ROLLBACK")
+        raise
+    cursor.execute("COMMIT")
+
+# Maximum number of rows written by a single multi-row statement
+BULK_ROWS = 500
+
+def _chunks(items, size=BULK_ROWS):
+    for i in range(0, len(items), size):
+        yield items[i:i+size]
+
+META_TABLE_SQL = """
+    CREATE TABLE `dmigrations_meta` (
+     `name` VARCHAR(64) NOT NULL,
+     `value` VARCHAR(255) NOT NULL,
+      PRIMARY KEY (`name`)
+    ) ENGINE=InnoDB DEFAULT CHARSET=utf8
+"""
+
+FORGET_HIGH_WATER = (
+    "DELETE FROM dmigrations_meta WHERE name LIKE 'high_water%%'", []
+)
+
+def _high_water_key(dev):
+    if dev:
+        return 'high_water_dev'
+    return 'high_water'
+
+# Names of session variables can't be passed as parameters
+variable_name_re = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+def set_session_variables(variables):
+    """
+    Set session variables from dict of names and values. Return dict of
+    their previous values.
+    """
+    names = sorted(variables)
+    if not names:
+        return {}
+    for name in names:
+        if not variable_name_re.match(name):
+            raise MigrationError(u"Bad session variable name: %r" % name)
+    saved = _execute(
+        "SELECT %s" % ", ".join(["@@SESSION.%s" % name for name in names])
+    ).fetchone()
+    _execute(
+        "SET %s" % ", ".join(["SESSION %s = %%s" % name for name in names]),
+        [variables[name] for name in names]
+    )
+    return dict(zip(names, saved))
+
 def table_present(table_name):
     cursor = _execute("SHOW TABLES LIKE %s", [table_name])
     return bool(cursor.fetchone())
 
+def table_comment(table_name):
+    """
+    Return comment of an existing table, or None if there's no such table.
+    """
+    cursor = _execute("SHOW TABLE STATUS LIKE %s", [table_name])
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    columns = [d[0].lower() for d in cursor.description]
+    return row[columns.index('comment')]
+
+def table_version(table_name, prefix):
+    """
+    Return schema version recorded as "<prefix> <version>" in table comment.
+    Tables without such comment are version 1.
+    """
+    m = re.search(r'%s (\d+)' % re.escape(prefix), table_comment(table_name) or '')
+    if m:
+        return int(m.group(1))
+    return 1
+
 def _up(migrations):
     return [(m, 'up') for m in migrations]
 
 def _down(migrations):
     return [(m, 'down') for m in migrations]
 
+class StateSnapshot(object):
+    """
+    In-memory copy of the set of applied migrations.
+    
+    It is loaded with a single query and then kept up to date by
+    MigrationState as it writes to the dmigrations table, so planning
+    never needs a query per migration.
+    """
+    
+    def __init__(self, applied=()):
+        self.applied = set(applied)
+    
+    @classmethod
+    def load(cls):
+        """
+        Load snapshot of the dmigrations table.
+        """
+        cursor = _execute("SELECT migration FROM dmigrations")
+        return cls(row[0] for row in cursor.fetchall())
+    
+    def is_applied(self, name):
+        return name in self.applied
+    
+    def mark_as_applied(self, name):
+        self.applied.add(name)
+    
+    def mark_as_unapplied(self, name):
+        self.applied.discard(name)
+    
+    @classmethod
+    def from_state_file(cls, path):
+        """
+        Load snapshot from a file written by MigrationState.save_state_file
+        or dmigrate export_state.
+        """
+        from state_file import StateFile, open_state_file
+        input = open_state_file(path)
+        try:
+            return cls(StateFile.read(input).applied_names())
+        finally:
+            input.close()
+
 class MigrationState(object):
     
-    def __init__(self, dev=None, migration_db=None):
+    def __init__(self, dev=None, migration_db=None, state_file=None,
+                 resume=False, progress_callback=None):
+        """
+        If state_file is given, state is read from it instead of the
+        database. Such offline state can only be used for planning.
+        
+        If resume is set, migrations record their finished steps, and
+        ones interrupted by an earlier resume run continue from their
+        first unfinished step. Otherwise failed Compound migrations roll
+        back their finished children.
+        
+        progress_callback is given to migrations, which report progress
+        of their DDL statements to it.
+        """
         self.migration_db = migration_db
         self.dev = dev
-        self._applied_cache = None
+        self.state_file = state_file
+        self.resume = resume
+        self.progress_callback = progress_callback
+        self._snapshot = None
+        # Names of migrations with journals, loaded once unless resuming
+        self._interrupted = None
+    
+    def is_offline(self):
+        return self.state_file is not None
+    
+    def _check_online(self):
+        if self.is_offline():
+            raise MigrationError(
+                u"Migration state read from %s can only be used for planning"
+                % self.state_file
+            )
     
     def migration_table_present(self):
         return table_present('dmigrations')
     
+    @property
+    def snapshot(self):
+        """
+        Lazily loaded StateSnapshot of applied migrations.
+        """
+        if self._snapshot is None:
+            if self.is_offline():
+                self._snapshot = StateSnapshot.from_state_file(self.state_file)
+            else:
+                self._snapshot = StateSnapshot.load()
+        return self._snapshot
+    
+    def commit(self):
+        """
+        Commit the transaction left open by reads like planning, as
+        MySQLdb doesn't autocommit.
+        """
+        _execute("COMMIT")
+    
+    def invalidate_snapshot(self):
+        """
+        Forget the snapshot, so it's reloaded from the database on next use.
+        """
+        self._snapshot = None
+    
     def log(self, action, migration_name, status='success'):
         from migration_log import log_action
         log_action(action, migration_name, status)
     
     def applied_but_not_in_db(self):
-        migrations_in_db = set(self.migration_db.list())
-        applied_migrations = [
-            m[0] for m in _execute(
-                "SELECT migration FROM dmigrations"
-            ).fetchall()
-        ]
+        migrations_in_db = self.migration_db.index
         return self.migration_db.sort_migrations(
-            [m for m in applied_migrations if m not in migrations_in_db]
+            [m for m in self.snapshot.applied if m not in migrations_in_db]
         )
       
+    def run_migration(self, migration, direction, journal=None):
+        """
+        Run migration in given direction ('up' or 'down'), without recording
+        anything. Return running time in milliseconds.
+        
+        If journal (a StepJournal) is given, migration records its
+        finished steps there.
+        """
+        saved_variables = set_session_variables(
+            self.session_settings(migration)
+        )
+        start_time = time.time()
+        migration.journal = journal
+        migration.progress_callback = self.progress_callback
+        try:
+            getattr(migration, direction)()
+        finally:
+            migration.journal = None
+            migration.progress_callback = None
+            set_session_variables(saved_variables)
+        return int((time.time() - start_time) * 1000)
+    
+    def session_settings(self, migration):
+        """
+        Return session variables to set while migration runs: the
+        DMIGRATIONS_SESSION_SETTINGS setting, updated with session_settings
+        of migration.
+        """
+        from django.conf import settings
+        variables = dict(getattr(settings, 'DMIGRATIONS_SESSION_SETTINGS', {}))
+        variables.update(getattr(migration, 'session_settings', {}))
+        return variables
+    
+    def start_journal(self, name, direction):
+        """
+        Return StepJournal for migration about to run if resuming,
+        None otherwise. Progress left by an interrupted run is discarded
+        unless resuming, so a later resume doesn't skip steps.
+        """
+        from migration_journal import StepJournal
+        if self.resume:
+            return StepJournal.start(name, direction)
+        # Journals are rare, so without resuming there's a single query
+        # for all migrations run, instead of queries for each of them
+        if self._interrupted is None:
+            self._interrupted = StepJournal.interrupted_migrations()
+        if name in self._interrupted:
+            StepJournal.discard(name)
+            self._interrupted.discard(name)
+        return None
+    
+    def record_result(self, name, direction, duration_ms=None, error=None):
+        """
+        Record result of running migration in given direction: mark it
+        and log success, or only log the error.
+        """
+        self._check_online()
+        action = {'up': 'apply', 'down': 'unapply'}[direction]
+        if error is not None:
+            self.log(action, name, str(error))
+            return
+        if direction == 'up':
+            self.mark_as_applied(name, log=False,
+                duration_ms = duration_ms,
+                content_hash = self.migration_db.migration_content_hash(name),
+            )
+        else:
+            self.mark_as_unapplied(name, log=False)
+        self.log(action, name)
+    
     def apply(self, name):
+        self._check_online()
         try:
             migration = self.migration_db.load_migration_object(name)
-            migration.up()
-            self.mark_as_applied(name, log=False)
-            self.log('apply', name)
+            if not getattr(migration, 'atomic', False):
+                journal = self.start_journal(name, 'up')
+                duration_ms = self.run_migration(migration, 'up', journal)
+                self.record_result(name, 'up', duration_ms)
+                if journal is not None:
+                    journal.clear()
+                return
         except Exception, e:
             self.log('apply', name, str(e))
             raise
+        self.run_atomic(name, migration, 'up')
     
     def unapply(self, name):
+        self._check_online()
         try:
             migration = self.migration_db.load_migration_object(name)
-            migration.down()
-            self.mark_as_unapplied(name, log=False)
-            self.log('unapply', name)
+            if not getattr(migration, 'atomic', False):
+                journal = self.start_journal(name, 'down')
+                self.run_migration(migration, 'down', journal)
+                self.record_result(name, 'down')
+                if journal is not None:
+                    journal.clear()
+                return
         except Exception, e:
             self.log('unapply', name, str(e))
             raise
+        self.run_atomic(name, migration, 'down')
+    
+    def run_atomic(self, name, migration, direction):
+        """
+        Run migration, mark it and log the result in a single transaction.
+        Only for migrations that change data, not schema, as DDL
+        statements commit implicitly.
+        
+        If migration fails, its changes are rolled back to a savepoint and
+        the failure is logged in the same transaction. Without savepoint
+        support, the whole transaction is rolled back and failure is
+        logged separately.
+        """
+        from migration_log import log_actions_statements
+        self._check_online()
+        action = {'up': 'apply', 'down': 'unapply'}[direction]
+        cursor = connection.cursor()
+        cursor.execute("BEGIN")
+        try:
+            cursor.execute("SAVEPOINT dmigrations_migration")
+            savepoint = True
+        except Exception:
+            savepoint = False
+        
+        try:
+            migration.in_transaction = True
+            try:
+                duration_ms = self.run_migration(migration, direction)
+            finally:
+                migration.in_transaction = False
+        except Exception, e:
+            exc_info = sys.exc_info()
+            if savepoint:
+                cursor.execute("ROLLBACK TO SAVEPOINT dmigrations_migration")
+                for statement in log_actions_statements([(action, name, str(e))]):
+                    cursor.execute(*statement)
+                cursor.execute("COMMIT")
+            else:
+                cursor.execute("ROLLBACK")
+                self.log(action, name, str(e))
+            raise exc_info[0], exc_info[1], exc_info[2]
+        
+        if direction == 'up':
+            statements = [("""
+                INSERT IGNORE INTO dmigrations
+                    (migration, applied_at, duration_ms, content_hash)
+                VALUES (%s, NOW(), %s, %s)
+            """, [
+                name, duration_ms,
+                self.migration_db.migration_content_hash(name),
+            ])]
+        else:
+            statements = [
+                ("DELETE FROM dmigrations WHERE migration = %s", [name]),
+                FORGET_HIGH_WATER,
+            ]
+        statements += log_actions_statements([(action, name, 'success')])
+        try:
+            for statement in statements:
+                cursor.execute(*statement)
+        except:
+            cursor.execute("ROLLBACK")
+            raise
+        cursor.execute("COMMIT")
+        
+        if self._snapshot is not None:
+            if direction == 'up':
+                self._snapshot.mark_as_applied(name)
+            else:
+                self._snapshot.mark_as_unapplied(name)
     
-    def mark_as_applied(self, name, log=True):
+    def apply_coalesced(self, names, migration):
+        """
+        Apply migrations with given names by running a single migration
+        that does the work of all of them, like CoalescedAlterTable,
+        and record each of them separately. If it fails, apply them
+        one by one instead.
+        """
+        self._check_online()
+        try:
+            duration_ms = self.run_migration(migration, 'up')
+        except Exception, e:
+            print >>sys.stderr, u"Running %s together failed (%s), " \
+                "applying them one by one" % (", ".join(names), e)
+            for name in names:
+                self.apply(name)
+            return
+        for name in names:
+            self.record_result(name, 'up', duration_ms / len(names))
+    
+    def mark_as_applied(self, name, log=True, duration_ms=None,
+                        content_hash=None):
+        self._check_online()
         if not self.is_applied(name):
-            _execute_in_transaction(
-                "INSERT INTO dmigrations (migration) VALUES (%s)", [name]
-            )
+            _execute_in_transaction("""
+                INSERT INTO dmigrations
+                    (migration, applied_at, duration_ms, content_hash)
+                VALUES (%s, NOW(), %s, %s)
+            """, [name, duration_ms, content_hash])
+        if self._snapshot is not None:
+            self._snapshot.mark_as_applied(name)
         if log:
             self.log('mark_as_applied', name)
     
     def mark_as_unapplied(self, name, log=True):
+        self._check_online()
         if self.is_applied(name):
-            _execute_in_transaction(
-                "DELETE FROM dmigrations WHERE migration = %s", [name]
-            )
+            _execute_statements_in_transaction([
+                ("DELETE FROM dmigrations WHERE migration = %s", [name]),
+                FORGET_HIGH_WATER,
+            ])
+        if self._snapshot is not None:
+            self._snapshot.mark_as_unapplied(name)
         if log:
             self.log('mark_as_unapplied', name)
       
-    def applied_migrations(self):
+    def mark_many_as_applied(self, names, log=True):
+        """
+        Mark all names as applied, using multi-row statements in a single
+        transaction. Names already marked as applied are skipped.
+        """
+        self._check_online()
+        names = self._unique(names)
+        statements = []
+        for chunk in _chunks(names):
+            statements.append(("""
+                INSERT IGNORE INTO dmigrations (migration, applied_at)
+                VALUES %s
+            """ % ", ".join(["(%s, NOW())"] * len(chunk)), chunk))
+        if log:
+            from migration_log import log_actions_statements
+            statements += log_actions_statements(
+                [('mark_as_applied', name, 'success') for name in names]
+            )
+        if statements:
+            _execute_statements_in_transaction(statements)
+        if self._snapshot is not None:
+            for name in names:
+                self._snapshot.mark_as_applied(name)
+    
+    def mark_many_as_unapplied(self, names, log=True):
+        """
+        Mark all names as unapplied, using multi-row statements in a single
+        transaction.
+        """
+        self._check_online()
+        names = self._unique(names)
+        statements = [FORGET_HIGH_WATER]
+        for chunk in _chunks(names):
+            statements.append((
+                "DELETE FROM dmigrations WHERE migration IN (%s)" %
+                    ", ".join(["%s"] * len(chunk)),
+                chunk
+            ))
+        if log:
+            from migration_log import log_actions_statements
+            statements += log_actions_statements(
+                [('mark_as_unapplied', name, 'success') for name in names]
+            )
+        _execute_statements_in_transaction(statements)
+        if self._snapshot is not None:
+            for name in names:
+                self._snapshot.mark_as_unapplied(name)
+    
+    def export_state(self, include_log=False):
+        """
+        Return StateFile snapshot of the dmigrations table, and of
+        dmigrations_log if include_log is set.
+        """
+        self._check_online()
+        from state_file import StateFile
+        cursor = _execute("""
+            SELECT migration, applied_at, duration_ms, content_hash
+            FROM dmigrations ORDER BY id
+        """)
+        state = StateFile(applied=list(cursor.fetchall()))
+        if include_log:
+            from migration_log import iter_log
+            # Written out as it's read
+            state.log = iter_log()
+        return state
+    
+    def import_state(self, state, include_log=False, replace=False,
+                     force=False):
+        """
+        Load StateFile snapshot into the dmigrations table (and log, if
+        include_log is set) in a single transaction, using multi-row
+        statements. If replace is set, the table is emptied first,
+        otherwise migrations already marked as applied are kept.
+        
+        Raises InconsistentStateError if snapshot has migrations that
+        are not in MigrationDb, unless force is set.
+        """
+        self._check_online()
+        if not force:
+            unknown = [
+                name for name in state.applied_names()
+                if name not in self.migration_db.index
+            ]
+            if unknown:
+                raise InconsistentStateError(
+                    u"Migrations in state snapshot cannot be found: %s" %
+                        ", ".join(unknown)
+                )
+        
+        statements = []
+        if replace:
+            statements.append(("DELETE FROM dmigrations", []))
+            statements.append(FORGET_HIGH_WATER)
+        for chunk in _chunks(state.applied):
+            params = []
+            for row in chunk:
+                params += list(row)
+            statements.append(("""
+                INSERT IGNORE INTO dmigrations
+                    (migration, applied_at, duration_ms, content_hash)
+                VALUES %s
+            """ % ", ".join(["(%s, %s, %s, %s)"] * len(chunk)), params))
+        if include_log:
+            for chunk in _chunks(state.log):
+                params = []
+                for row in chunk:
+                    params += list(row)
+                statements.append(("""
+                    INSERT INTO dmigrations_log
+                        (action, migration, status, datetime)
+                    VALUES %s
+                """ % ", ".join(["(%s, %s, %s, %s)"] * len(chunk)), params))
+        _execute_statements_in_transaction(statements)
+        self.invalidate_snapshot()
+    
+    def record_high_water(self):
+        """
+        Store digests of MigrationDb contents for which all migrations
+        are applied, so is_up_to_date() can later check state with a
+        single query. Digests that no longer hold are removed.
+        """
+        self._check_online()
+        statements = []
+        for dev in (False, True):
+            key = _high_water_key(dev)
+            names = self.migration_db.index.names
+            if not dev:
+                names = [m for m in names if m not in self.migration_db.index.dev]
+            if self.unapplied_only(names):
+                statements.append((
+                    "DELETE FROM dmigrations_meta WHERE name = %s", [key]
+                ))
+            else:
+                statements.append((
+                    "REPLACE INTO dmigrations_meta (name, value) VALUES (%s, %s)",
+                    [key, self.migration_db.index.digest(dev)]
+                ))
+        _execute_statements_in_transaction(statements)
+    
+    def high_water(self):
+        """
+        Return digest stored by record_high_water for current dev flag,
+        or None if there is none.
+        """
+        self._check_online()
         cursor = _execute(
-            "SELECT migration FROM dmigrations"
+            "SELECT value FROM dmigrations_meta WHERE name = %s",
+            [_high_water_key(self.dev)]
         )
-        return set(x[0] for x in cursor.fetchall())
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        return row[0]
+    
+    def is_up_to_date(self):
+        """
+        Return True if there are no migrations to apply. In the common case
+        it only compares digest of MigrationDb with high water digest
+        stored in the database, otherwise it plans. It never writes, high
+        water is only recorded by dmigrate runs.
+        """
+        if self.is_offline():
+            return not self.plan('all')
+        if self.high_water() == self.migration_db.index.digest(bool(self.dev)):
+            return True
+        return not self.plan('all')
+    
+    def record_state(self):
+        """
+        Record state after migrating: high water, which lets
+        dmigrations.is_up_to_date() answer with a single query, and the
+        DMIGRATIONS_STATE_FILE for offline planning with --state-file.
+        """
+        from django.conf import settings
+        self.record_high_water()
+        state_file = getattr(settings, 'DMIGRATIONS_STATE_FILE', None)
+        if state_file:
+            self.save_state_file(state_file)
+    
+    def save_state_file(self, path):
+        """
+        Atomically write state of the database to path, for later use
+        as offline state.
+        """
+        from state_file import open_state_file
+        state = self.export_state()
+        # Keep the suffix, so the temporary file is gzipped like path
+        dir_name, file_name = os.path.split(path)
+        tmp_path = os.path.join(dir_name, '.%d.%s' % (os.getpid(), file_name))
+        output = open_state_file(tmp_path, 'w')
+        try:
+            state.write(output)
+        finally:
+            output.close()
+        os.rename(tmp_path, path)
+    
+    def _unique(self, names):
+        seen = set()
+        unique_names = []
+        for name in names:
+            if name not in seen:
+                seen.add(name)
+                unique_names.append(name)
+        return unique_names
+    
+    def applied_migrations(self):
+        return set(self.snapshot.applied)
 
     def is_applied(self, name, use_cache=False):
-        if use_cache:
-            if self._applied_cache is None:
-                self._applied_cache = self.applied_migrations()
-
-            return name in self._applied_cache
+        if use_cache or self.is_offline():
+            return self.snapshot.is_applied(name)
 
         cursor = _execute(
-            "SELECT * FROM dmigrations WHERE migration = %s", [name]
+            "SELECT 1 FROM dmigrations WHERE migration = %s", [name]
         )
         return bool(cursor.fetchone())
     
     def all_migrations_applied(self):
-        cursor = _execute("SELECT migration FROM dmigrations")
-        return self.migration_db.sort_migrations(
-            [row[0] for row in cursor.fetchall()]
-        )
+        return self.migration_db.sort_migrations(self.snapshot.applied)
     
     def create_migration_table(self):
-        create_new = """
-            CREATE TABLE `dmigrations` (
-             `id` int(11) NOT NULL auto_increment,
-             `migration` VARCHAR(255) NOT NULL,
-              PRIMARY KEY (`id`)
-            ) ENGINE=InnoDB DEFAULT CHARSET=utf8
+        _execute_in_transaction(MIGRATION_TABLE_SQL)
+    
+    def migration_table_version(self):
+        return table_version('dmigrations', 'dmigrations schema')
+    
+    def upgrade_migration_table(self):
+        """
+        Upgrade existing dmigrations table in place to the current version.
         """
-        _execute_in_transaction(create_new)
+        version = self.migration_table_version()
+        while version < MIGRATION_TABLE_VERSION:
+            version += 1
+            for sql in MIGRATION_TABLE_UPGRADES[version]:
+                _execute(sql)
     
     def init(self):
-        "Create the dmigration table, if necessary"
+        "Create or upgrade the dmigration table, if necessary"
+        if self.is_offline():
+            return
         if not self.migration_table_present():
             self.create_migration_table()
+        else:
+            self.upgrade_migration_table()
+        if not table_present('dmigrations_meta'):
+            _execute(META_TABLE_SQL)
+        self.invalidate_snapshot()
         from migration_log import init as log_init
         log_init()
+        from migration_journal import init as journal_init
+        journal_init()
     
     def resolve_name(self, name):
         """
@@ -146,60 +746,86 @@ class MigrationState(object):
         Raises exception if ambiguous or not found.
         """
         resolved_name = self.resolve_name(name)
-        if resolved_name not in self.migration_db.list():
+        if resolved_name not in self.migration_db.index:
             raise NoSuchMigrationError(name)
         return resolved_name
     
+    def considering_dev(self, migrations):
+        """
+        Filter migrations considering value of dev flag.
+        """
+        if self.dev:
+            return list(migrations)
+        dev_migrations = self.migration_db.index.dev
+        return [m for m in migrations if m not in dev_migrations]
+    
     def list_considering_dev(self):
         """
         Return list of migrations considering value of dev flag.
         """
-        return [
-            m for m in self.migration_db.list() 
-            if self.dev or not self.migration_db.is_dev_migration(m)
-        ]
+        return self.considering_dev(self.migration_db.index.names)
     
-    def plan_to(self, point):
+    def point_position(self, point):
         """
-        Point can be a migration name or a number.
-        Number can resolve to an unique migration name,
-        or to a point between migrations,
-        but it cannot resolve to an ambiguous migration.
-        
-        Return plan to migrate to such point.
+        Return number of migrations (in MigrationDb.index) up to and
+        including point, which is a migration name or a number, like
+        for plan_to.
         """
-        migrations = self.list_considering_dev()
+        index = self.migration_db.index
         point = str(point)
-        if point in migrations:
-            i = migrations.index(point) + 1
+        if point in index and (self.dev or point not in index.dev):
+            return index.positions[point] + 1
         elif re.search(r'^\d+$', point):
             point = int(point)
             # NOTE: It only checks that the point is not a duplicate
             self.migration_db.find_unique_migration_by_number(point)
-            i = 0
-            while i < len(migrations) and \
-                self.migration_db.migration_number(migrations[i]) <= point:
-                i += 1
+            return index.count_upto(point)
         else:
             raise NoSuchMigrationError(point)
+    
+    def list_upto(self, point):
+        """
+        Return list of migrations up to and including point,
+        considering dev flag.
+        """
+        return self.considering_dev(
+            self.migration_db.index.names[:self.point_position(point)]
+        )
+    
+    def plan_to(self, point):
+        """
+        Point can be a migration name or a number.
+        Number can resolve to an unique migration name,
+        or to a point between migrations,
+        but it cannot resolve to an ambiguous migration.
+        
+        Return plan to migrate to such point.
+        """
+        index = self.migration_db.index
+        i = self.point_position(point)
         
         return _down(
-            self.applied_only(reversed(migrations[i:]))
+            self.applied_only(reversed(self.considering_dev(index.names[i:])))
         ) + _up(
-            self.unapplied_only(migrations[:i])
+            self.unapplied_only(self.considering_dev(index.names[:i]))
         )
     
     def applied_only(self, migrations):
-        return [m for m in migrations if self.is_applied(m)]
+        snapshot = self.snapshot
+        return [m for m in migrations if snapshot.is_applied(m)]
     
     def unapplied_only(self, migrations):
-        return [m for m in migrations if not self.is_applied(m)]
+        snapshot = self.snapshot
+        return [m for m in migrations if not snapshot.is_applied(m)]
     
     def hard_only(self, migrations):
         return [m for m in migrations if not self.migration_db.is_soft_migration(m)]
 
+    def soft_only(self, migrations):
+        return [m for m in migrations if self.migration_db.is_soft_migration(m)]
+
     def plan(self, action, *args):
-        if action in ['all', 'all_hard', 'up', 'down'] and len(args) > 0:
+        if action in ['all', 'all_hard', 'all_soft', 'up', 'down'] and len(args) > 0:
             raise Exception(u"Too many arguments")
         
         if action in ['upto', 'downto', 'to'] and len(args) != 1:
@@ -221,6 +847,9 @@ class MigrationState(object):
         if action == 'all_hard':
             return _up(self.unapplied_only(self.hard_only(self.list_considering_dev())))
 
+        if action == 'all_soft':
+            return _up(self.unapplied_only(self.soft_only(self.list_considering_dev())))
+
         if action == 'up':
             return _up(self.unapplied_only(self.list_considering_dev()))[:1]
         
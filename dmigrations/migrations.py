@@ -1,42 +1,230 @@
-import re
+from sql_statements import iter_statements
+from ddl_guard import DDLGuard, is_ddl, ddl_tables
+from progress_monitor import ProgressMonitor
+from exceptions import *
+
+import itertools
+import sys
+
+# Statements are sent one by one unless DMIGRATIONS_BATCH_SIZE setting
+# turns batching on, with a limit of joined size of statements sent in one
+# round trip. SUGGESTED_BATCH_SIZE works well for most migrations.
+DEFAULT_BATCH_SIZE = 0
+SUGGESTED_BATCH_SIZE = 64 * 1024
+
+SQL_UP_SUFFIX = '.up.sql'
+SQL_DOWN_SUFFIX = '.down.sql'
+
+# Newline first, so a trailing -- comment can't swallow the semicolon
+BATCH_SEPARATOR = '\n;\n'
+
+def statement_batches(statements, max_size):
+    """
+    Group statements into lists whose joined size is at most max_size.
+    A statement longer than max_size gets a batch of its own, and so
+    does every DDL statement, so it can be guarded.
+    """
+    batch, size = [], 0
+    for statement in statements:
+        if is_ddl(statement):
+            if batch:
+                yield batch
+            yield [statement]
+            batch, size = [], 0
+            continue
+        if batch and size + len(statement) > max_size:
+            yield batch
+            batch, size = [], 0
+        batch.append(statement)
+        size += len(statement) + len(BATCH_SEPARATOR)
+    if batch:
+        yield batch
+
+def enable_multi_statements(connection):
+    """
+    Turn multi-statement support of the MySQLdb connection on. Return False
+    if the driver doesn't support it.
+
+    MySQLdb connects with multi-statements on, and sql_up of existing
+    migrations may rely on it, so it's never turned off again.
+    """
+    # MYSQL_OPTION_MULTI_STATEMENTS_ON is 0
+    try:
+        connection.connection.set_server_option(0)
+    except Exception:
+        return False
+    return True
 
 class BaseMigration(object):
+    # Set to False if statements of this migration must be sent one by one
+    batch_statements = True
+
+    # Set to True if the migration only changes data, so it can run in the
+    # same transaction which records it as applied
+    atomic = False
+
+    # True while an atomic migration runs in a transaction, so it must
+    # not begin or commit one itself
+    in_transaction = False
+
+    # StepJournal of the run in progress, if it's journaled
+    journal = None
+
+    # Called with (stage, percent, eta) while DDL statements run, see
+    # dmigrations.progress_monitor
+    progress_callback = None
+
+    # Session variables set while the migration runs, for example
+    # {'sort_buffer_size': 64 * 1024 * 1024, 'unique_checks': 0}. They
+    # override the DMIGRATIONS_SESSION_SETTINGS setting.
+    session_settings = {}
+
     def up(self):
         raise NotImplementedError
     
     def down(self):
         raise NotImplementedError
 
+    def touched_tables(self):
+        """
+        Return list of tables this migration touches, or None if unknown.
+        Migrations touching different tables may run at the same time.
+        """
+        return None
+
     def execute_sql(self, sql, return_rows=False):
-        "Executes sql, which can be a string or a list of strings"
-        if isinstance(sql, basestring):
-            # Split string in to multiple statements
-            statements_re = re.compile(r";[ \t]*$", re.M)
-            statements = [s for s in statements_re.split(sql) if s.strip()]
-        else:
-            try:
-                # Assume each item in the iterable is already an individual statement
-                statements = iter(sql)
-            except TypeError:
-                assert False, 'sql argument must be string or iterable'
+        """
+        Executes sql, which can be a string or a file-like object with
+        statements separated by delimiters, or a list of statements
+        """
+        return self.run_statements(self.split_sql(sql), return_rows)
 
-        return self.run_statements(statements, return_rows)
+    def split_sql(self, sql):
+        "Return iterator of statements of sql, as accepted by execute_sql"
+        if isinstance(sql, basestring) or hasattr(sql, 'read'):
+            # Split in to statements as they are run
+            return iter_statements(sql)
+        try:
+            # Assume each item in the iterable is already an individual statement
+            return iter(sql)
+        except TypeError:
+            assert False, 'sql argument must be string, file or iterable'
 
-    def run_statements(self, statements, return_rows=False):
+    def execute_journaled(self, sql):
+        """
+        Executes sql like execute_sql, recording finished statements in
+        the journal, and skipping statements an interrupted run finished.
+        Atomic migrations are rolled back on failure, so they don't need
+        a journal.
+        """
+        journal = self.journal
+        if journal is None or self.atomic or self.in_transaction:
+            return self.execute_sql(sql)
+        skipped = journal.steps_done
+        statements = itertools.islice(self.split_sql(sql), skipped, None)
+        self.run_statements(statements,
+            progress = lambda done: journal.record(skipped + done)
+        )
+
+    def run_statements(self, statements, return_rows=False, progress=None):
+        """
+        Run statements. If progress is given, it's called with number of
+        finished statements whenever some of them finish, even when
+        a later one fails.
+        """
         from django.db import connection
         cursor = connection.cursor()
 
-        for statement in statements:
-            # Escape % due to format strings
-            try:
-                cursor.execute(statement.replace('%', '%%'))
-            except:
-                print "Exception running %r" % statement
-                raise
+        batch_size = self.batch_size()
+        if return_rows or not batch_size or \
+            not enable_multi_statements(connection):
+            for (i, statement) in enumerate(statements):
+                self.execute_statement(cursor, statement)
+                if progress is not None:
+                    progress(i + 1)
+        else:
+            done = 0
+            for batch in statement_batches(statements, batch_size):
+                if progress is None:
+                    self.execute_batch(cursor, batch)
+                else:
+                    self.execute_batch(cursor, batch,
+                        lambda n: progress(done + n)
+                    )
+                done += len(batch)
 
         if return_rows:
             return cursor.fetchall()
 
+    def batch_size(self):
+        "Return size limit of statement batches, or 0 if not batching"
+        if not self.batch_statements:
+            return 0
+        from django.conf import settings
+        return getattr(settings, 'DMIGRATIONS_BATCH_SIZE', DEFAULT_BATCH_SIZE)
+
+    def execute_statement(self, cursor, statement):
+        # Escape % due to format strings
+        execute = lambda: cursor.execute(statement.replace('%', '%%'))
+        try:
+            if is_ddl(statement):
+                monitor = self.start_progress_monitor(cursor)
+                try:
+                    DDLGuard.from_settings().run(cursor, execute,
+                        ddl_tables(statement)
+                    )
+                finally:
+                    if monitor is not None:
+                        monitor.stop()
+            else:
+                execute()
+        except:
+            print "Exception running %r" % statement
+            raise
+
+    def start_progress_monitor(self, cursor):
+        """
+        Start monitoring progress of the next statement run on cursor,
+        if there's progress_callback. Return the ProgressMonitor thread.
+        """
+        if self.progress_callback is None:
+            return None
+        cursor.execute("SELECT CONNECTION_ID()")
+        monitor = ProgressMonitor(cursor.fetchone()[0], self.progress_callback)
+        monitor.start()
+        return monitor
+
+    def execute_batch(self, cursor, batch, progress=None):
+        """
+        Send statements in one round trip, with multi-statement support
+        already turned on. Errors are reported for the statement that
+        caused them, and the rest of the batch isn't run. progress is
+        called like in run_statements.
+        """
+        if len(batch) == 1:
+            self.execute_statement(cursor, batch[0])
+            if progress is not None:
+                progress(1)
+            return
+
+        sql = BATCH_SEPARATOR.join([s.strip().rstrip(';') for s in batch])
+        i = 0
+        try:
+            cursor.execute(sql.replace('%', '%%'))
+            # Results of following statements, and their errors, come
+            # with each nextset()
+            for i in range(1, len(batch)):
+                cursor.nextset()
+        except:
+            exc_info = sys.exc_info()
+            print "Exception running %r" % batch[i]
+            # Statements before the failing one are done
+            if progress is not None and i:
+                progress(i)
+            raise exc_info[0], exc_info[1], exc_info[2]
+        if progress is not None:
+            progress(len(batch))
+
     @classmethod
     def _digest(cls, *args):
         "Generate a 32 bit digest of a set of arguments that can be used to shorten identifying names"
@@ -45,3 +233,34 @@ class BaseMigration(object):
     @classmethod
     def fk_name(cls, col, remote_col, table, remote_table):
         return '%s_refs_%s_%s' % (remote_col, col, cls._digest(remote_table, table))
+
+class SqlFileMigration(BaseMigration):
+    """
+    Migration made of NNN_name.up.sql and optional NNN_name.down.sql
+    files. Files are read in chunks while their statements are run, so
+    they are never loaded into memory as a whole.
+    """
+
+    def __init__(self, up_path, down_path=None):
+        self.up_path = up_path
+        self.down_path = down_path
+
+    def up(self):
+        self.execute_file(self.up_path)
+
+    def down(self):
+        if self.down_path is None:
+            raise BadMigrationError(
+                u'Migration %s has no %s file' % (self.up_path, SQL_DOWN_SUFFIX)
+            )
+        self.execute_file(self.down_path)
+
+    def execute_file(self, path):
+        sql_file = open(path, 'rb')
+        try:
+            self.execute_sql(sql_file)
+        finally:
+            sql_file.close()
+
+    def __repr__(self):
+        return 'SqlFileMigration(%r, %r)' % (self.up_path, self.down_path)
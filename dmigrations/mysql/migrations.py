@@ -23,11 +23,11 @@ class Migration(BaseMigration):
         self.sql_down = sql_down
     
     def up(self):
-        self.execute_sql(self.sql_up)
+        self.execute_journaled(self.sql_up)
     
     def down(self):
         if self.sql_down:
-            self.execute_sql(self.sql_down)
+            self.execute_journaled(self.sql_down)
         else:
             raise IrreversibleMigrationError, 'No sql_down provided'
 
@@ -43,12 +43,36 @@ class Compound(BaseMigration):
         super(Compound, self).__init__()
 
     def run(self, direction, migs):
+        journal = self.journal
+        for migration in self.migrations:
+            migration.progress_callback = self.progress_callback
         successful = []
         try:
-            for migration in migs:
-                getattr(migration, direction)()
+            for (i, migration) in enumerate(migs):
+                if journal is None:
+                    getattr(migration, direction)()
+                    successful.append(migration)
+                    continue
+                # Skip children finished by an interrupted run
+                if i < journal.steps_done:
+                    continue
+                migration.journal = journal.child(i)
+                try:
+                    getattr(migration, direction)()
+                finally:
+                    migration.journal = None
                 successful.append(migration)
+                journal.record(i + 1)
         except:
+            if journal is not None:
+                # Finished children stay, so the run can be resumed
+                print >> sys.stderr, termcolors.colorize(
+                    'Got exception, keeping %d finished migrations, '
+                    'use --resume to continue' % journal.steps_done,
+                    fg='red'
+                )
+                raise
+
             rollback_dir = {
                 'up': 'down',
                 'down': 'up',
@@ -72,6 +96,15 @@ class Compound(BaseMigration):
     def down(self):
         self.run('down', reversed(self.migrations))
 
+    def touched_tables(self):
+        tables = []
+        for migration in self.migrations:
+            migration_tables = migration.touched_tables()
+            if migration_tables is None:
+                return None
+            tables += migration_tables
+        return tables
+
     def __str__(self):
         return 'Compound Migration: %s' % self.migrations
 
@@ -92,10 +125,99 @@ class TableAlteration(object):
         c.clause_up, c.clause_down = self.clause_down, self.clause_up
         return c
 
-class AlterTable(BaseMigration):
-    reverse = False
+# ALTER TABLE algorithms, cheapest first
+ALTER_ALGORITHMS = ['INSTANT', 'INPLACE', 'COPY']
+
+# MySQL errors meaning the requested algorithm or lock can't be used:
+# unknown algorithm (INSTANT before MySQL 8.0), and operation not
+# supported, without and with a reason
+ALGORITHM_NOT_SUPPORTED_ERRORS = (1800, 1845, 1846)
+
+def _algorithm_not_supported(e):
+    args = getattr(e, 'args', ())
+    return bool(args) and args[0] in ALGORITHM_NOT_SUPPORTED_ERRORS
+
+class AlterMigration(BaseMigration):
+    """
+    Base of migrations running ALTER TABLE, which can ask MySQL for an
+    ALGORITHM and LOCK. algorithm is the slowest algorithm allowed:
+    cheaper ones are tried first, and each one MySQL refuses falls back
+    to the next. So ALGORITHM=INSTANT never turns into a table copy,
+    while INPLACE tries INSTANT first. lock is requested for INPLACE and
+    COPY. The algorithm that worked is kept in algorithm_used.
+
+    With neither set, MySQL picks the algorithm and lock itself.
+    """
+    algorithm = None
+    lock = None
+    algorithm_used = None
+
+    def set_alter_options(self, algorithm, lock):
+        if algorithm is not None:
+            self.algorithm = algorithm.upper()
+        if lock is not None:
+            self.lock = lock.upper()
+        assert self.algorithm in [None] + ALTER_ALGORITHMS, \
+            'algorithm must be one of %s' % ', '.join(ALTER_ALGORITHMS)
+
+    def alter_options(self):
+        return (self.algorithm, self.lock)
+
+    def execute_alter(self, sql):
+        """
+        Run ALTER TABLE statement sql with the cheapest algorithm allowed
+        that MySQL accepts.
+        """
+        if self.algorithm is None and self.lock is None:
+            self.execute_sql([sql])
+            return
+        sql = sql.rstrip().rstrip(';')
+        if self.algorithm is None:
+            algorithms = [None]
+        else:
+            algorithms = ALTER_ALGORITHMS[
+                :ALTER_ALGORITHMS.index(self.algorithm) + 1
+            ]
+        for (i, algorithm) in enumerate(algorithms):
+            options = []
+            if algorithm is not None:
+                options.append('ALGORITHM=%s' % algorithm)
+            # INSTANT doesn't take any lock to speak of
+            if self.lock is not None and algorithm != 'INSTANT':
+                options.append('LOCK=%s' % self.lock)
+            try:
+                self.execute_sql([', '.join([sql] + options)])
+            except Exception, e:
+                if i + 1 == len(algorithms) or not _algorithm_not_supported(e):
+                    raise
+                print "ALGORITHM=%s can't be used, trying ALGORITHM=%s" % (
+                    algorithm, algorithms[i + 1]
+                )
+                continue
+            if algorithm is not None:
+                self.algorithm_used = algorithm
+                print "Used ALGORITHM=%s" % algorithm
+            return
 
-    def __init__(self, table_name, changes):
+class AlterTable(AlterMigration):
+    """
+    ALTER TABLE with a list of TableAlterations. An online migration
+    rebuilds the table in the background (see dmigrations.mysql.online)
+    instead of locking it for the whole ALTER, so it can run as a soft
+    migration. online_chunk_size and online_sleep default to the
+    DMIGRATIONS_ONLINE_CHUNK_SIZE and DMIGRATIONS_ONLINE_SLEEP settings.
+    algorithm and lock don't apply to online migrations.
+    """
+    reverse = False
+    online = False
+    online_chunk_size = None
+    online_sleep = None
+
+    def __init__(self, table_name, changes, online=None, algorithm=None,
+                 lock=None):
+        if online is not None:
+            self.online = online
+        self.set_alter_options(algorithm, lock)
         if self.reverse:
             self.changes = list(reversed(changes))
         else:
@@ -107,16 +229,91 @@ class AlterTable(BaseMigration):
         super(AlterTable, self).__init__()
 
     def up(self):
-        clauses = ',\n  '.join(c.clause_up for c in self.changes)
-        sql = "ALTER TABLE `%s` %s;" % (self.table_name, clauses)
-        self.execute_sql([sql])
+        self.alter(',\n  '.join(c.clause_up for c in self.changes))
 
     def down(self):
-        clauses = ',\n  '.join(c.clause_down for c in reversed(self.changes))
-        sql = "ALTER TABLE `%s` %s;" % (self.table_name, clauses)
-        self.execute_sql([sql])
+        self.alter(',\n  '.join(c.clause_down for c in reversed(self.changes)))
+
+    def alter(self, clauses):
+        if self.online:
+            from dmigrations.mysql.online import OnlineAlter
+            OnlineAlter(self.table_name, clauses,
+                chunk_size = self.online_chunk_size,
+                sleep = self.online_sleep,
+            ).run()
+        else:
+            self.execute_alter(
+                "ALTER TABLE `%s` %s;" % (self.table_name, clauses)
+            )
+
+    def touched_tables(self):
+        # Foreign keys lock the referenced tables too
+        return [self.table_name] + [
+            c.remote_table for c in self.changes if hasattr(c, 'remote_table')
+        ]
 
 
+class CoalescedAlterTable(AlterTable):
+    """
+    Several AlterTable migrations on the same table, run as a single
+    ALTER TABLE statement, so the table is rebuilt only once.
+    """
+
+    def __init__(self, migrations):
+        self.migrations = migrations
+        changes = []
+        for migration in migrations:
+            assert self.can_coalesce(migration, migrations[0])
+            changes += migration.changes
+        algorithm, lock = migrations[0].alter_options()
+        super(CoalescedAlterTable, self).__init__(
+            migrations[0].table_name, changes,
+            algorithm = algorithm, lock = lock,
+        )
+
+    @classmethod
+    def can_coalesce(cls, migration, first=None):
+        """
+        Only plain AlterTable migrations (not ones with custom up()) can be
+        coalesced, and only with migrations on the same table asking for
+        the same algorithm and lock as the first one. Online migrations
+        copy the table anyway, so they're left alone.
+        """
+        if not isinstance(migration, AlterTable) or migration.online:
+            return False
+        if type(migration).up.im_func is not AlterTable.up.im_func:
+            return False
+        return first is None or (
+            migration.table_name == first.table_name and
+            migration.alter_options() == first.alter_options()
+        )
+
+    def __str__(self):
+        return 'CoalescedAlterTable: %s' % self.migrations
+
+def coalesce_alters(plan, migration_db):
+    """
+    Split plan into steps, lists of plan entries. Adjacent pending
+    AlterTable migrations on the same table, with the same algorithm and
+    lock, are in the same step and can be run together as
+    CoalescedAlterTable, every other entry is a step of its own.
+    """
+    steps = []
+    first = None
+    for (name, action) in plan:
+        migration = None
+        if action == 'up':
+            migration = migration_db.load_migration_object(name)
+            if not CoalescedAlterTable.can_coalesce(migration):
+                migration = None
+        if migration is not None and first is not None and \
+            CoalescedAlterTable.can_coalesce(migration, first):
+            steps[-1].append((name, action))
+        else:
+            steps.append([(name, action)])
+            first = migration
+    return steps
+
 class AddColumn(AlterTable):
     "A migration that adds a database column"
 
@@ -146,6 +343,7 @@ class AddColumn(AlterTable):
 
         def __init__(self, column, remote_table, constraint_name, remote_col='id', ondelete=''):
             self.column = column
+            self.remote_table = remote_table
             args = {
                 'colname': column,
                 'constraint': constraint_name,
@@ -159,7 +357,8 @@ class AddColumn(AlterTable):
 
             super(AddColumn.ConstraintAlteration, self).__init__(clause_up, clause_down)
 
-    def __init__(self, app, model, column, spec, constrain_to_table=None, ondelete=''):
+    def __init__(self, app, model, column, spec, constrain_to_table=None, ondelete='', online=None,
+                 algorithm=None, lock=None):
         model = model.lower()
         self.app, self.model = app, model
         table_name = '%s_%s' % (app.lower(), model)
@@ -187,7 +386,7 @@ class AddColumn(AlterTable):
             changes = [self.Alteration(column, spec)]
 
         super(AddColumn, self).__init__(
-            table_name, changes
+            table_name, changes, online, algorithm, lock
         )
     
     def __str__(self):
@@ -229,7 +428,7 @@ class AddIndex(AlterTable):
                 self.drop_index_sql % args,
                 )
 
-    def __init__(self, app, model, column, name=None):
+    def __init__(self, app, model, column, name=None, online=None, algorithm=None, lock=None):
         model = model.lower()
         app = app.lower()
         self.app, self.model = app, model
@@ -242,7 +441,7 @@ class AddIndex(AlterTable):
         index_name = name if name else '%s_%s' % (table, '_'.join(self.columns))
 
         changes = [self.Alteration(self.columns, index_name)]
-        super(AddIndex, self).__init__(table, changes)
+        super(AddIndex, self).__init__(table, changes, online, algorithm, lock)
 
     def __str__(self):
         return "AddIndex: app: %s, model: %s, column: %s" % (
@@ -312,6 +511,9 @@ class AddDjangoKey(Migration):
     def down(self):
         self.run('down')
 
+    def touched_tables(self):
+        return [self.table, self.f_table]
+
     def __repr__(self):
         return "%sDjangoKey(*%r)" % (
             "Drop" if self.reverse else "Add",
@@ -326,6 +528,8 @@ class DropDjangoKey(AddDjangoKey):
 class InsertRows(Migration):
     "Inserts some rows in to a table"
     
+    atomic = True
+    
     insert_row_sql = 'INSERT INTO `%s` (%s) VALUES (%s)'
     delete_rows_sql = 'DELETE FROM `%s` WHERE id IN (%s)'
     
@@ -358,10 +562,15 @@ class InsertRows(Migration):
         else:
             sql_down = ["SELECT 1"]
         
-        super(InsertRows, self).__init__(
-            sql_up = ["BEGIN"] + sql_up + ["COMMIT"],
-            sql_down = ["BEGIN"] + sql_down + ["COMMIT"],
-        )
+        super(InsertRows, self).__init__(sql_up, sql_down)
+
+    def execute_sql(self, sql, return_rows=False):
+        if not self.in_transaction:
+            sql = ["BEGIN"] + list(sql) + ["COMMIT"]
+        return super(InsertRows, self).execute_sql(sql, return_rows)
+
+    def touched_tables(self):
+        return [self.table_name]
 
 class RenameTable(Migration):
     def __init__(self, oldname, newname):
@@ -378,8 +587,13 @@ class RenameTable(Migration):
     def __repr__(self):
         return 'RenameTable(%s, %s)' % (self.oldname, self.newname)
 
-class ChangeColumn(BaseMigration):
-    def __init__(self, table, oldname, newname=None, old_def=None, new_def=None):
+    def touched_tables(self):
+        return [self.oldname, self.newname]
+
+class ChangeColumn(AlterMigration):
+    def __init__(self, table, oldname, newname=None, old_def=None, new_def=None,
+                 algorithm=None, lock=None):
+        self.set_alter_options(algorithm, lock)
         self.table = table
         self.oldname = oldname
         self.newname = newname
@@ -392,6 +606,9 @@ class ChangeColumn(BaseMigration):
 
         super(ChangeColumn, self).__init__()
 
+    def touched_tables(self):
+        return [self.table]
+
     class AlreadyDone(Exception):
         pass
 
@@ -452,7 +669,7 @@ class ChangeColumn(BaseMigration):
             print e
             return
 
-        self.execute_sql(sql)
+        self.execute_alter(sql)
 
     def down(self):
         try:
@@ -461,4 +678,4 @@ class ChangeColumn(BaseMigration):
             print e
             return
 
-        self.execute_sql(sql)
+        self.execute_alter(sql)
@@ -0,0 +1,256 @@
+"""
+Online schema changes: ALTER TABLE without blocking writes to the table
+for the whole time it's rebuilt.
+
+The ALTER is applied to an empty shadow copy of the table. Rows are then
+copied over in primary key chunks, while triggers replay writes to the
+original table on the shadow one. Finally both tables are swapped with an
+atomic RENAME TABLE.
+"""
+from dmigrations.ddl_guard import DDLGuard, is_ddl, ddl_tables
+from dmigrations.exceptions import MigrationError
+
+import hashlib
+import re
+import sys
+import time
+
+# Defaults, overridden by DMIGRATIONS_ONLINE_CHUNK_SIZE and
+# DMIGRATIONS_ONLINE_SLEEP settings, and by migrations themselves
+DEFAULT_CHUNK_SIZE = 1000
+DEFAULT_SLEEP = 0
+
+# Seconds between progress reports while copying
+REPORT_INTERVAL = 10
+
+# Longest identifier MySQL accepts
+MAX_NAME_LENGTH = 64
+
+# Columns are copied by name, so renamed ones would lose their data
+rename_re = re.compile(r'\bCHANGE\b|\bRENAME\s+COLUMN\b', re.I)
+
+class OnlineAlterError(MigrationError):
+    pass
+
+def _execute(sql, params=None):
+    from django.db import connection
+    cursor = connection.cursor()
+    if is_ddl(sql):
+        # Above all RENAME TABLE, which needs metadata locks of both tables
+        DDLGuard.from_settings().run(cursor,
+            lambda: cursor.execute(sql, params), ddl_tables(sql)
+        )
+    else:
+        cursor.execute(sql, params)
+    return cursor
+
+def _quote(name):
+    return '`%s`' % name.replace('`', '``')
+
+def _helper_name(format, table_name):
+    """
+    Return format % table_name, with table_name shortened and followed by
+    its digest if the name would be too long for MySQL.
+    """
+    name = format % table_name
+    if len(name) <= MAX_NAME_LENGTH:
+        return name
+    digest = hashlib.md5(table_name).hexdigest()[:8]
+    keep = MAX_NAME_LENGTH - len(format % '') - len(digest) - 1
+    return format % ('%s_%s' % (table_name[:keep], digest))
+
+class OnlineAlter(object):
+    """
+    Applies ALTER TABLE clauses to table_name online. chunk_size rows are
+    copied at a time, with a pause of sleep seconds between chunks.
+
+    Only tables with a single column primary key, and without foreign
+    keys or triggers, can be altered this way.
+    """
+
+    def __init__(self, table_name, clauses, chunk_size=None, sleep=None,
+                 execute=_execute):
+        self.table = table_name
+        self.clauses = clauses
+        self.chunk_size = chunk_size or self.setting(
+            'DMIGRATIONS_ONLINE_CHUNK_SIZE', DEFAULT_CHUNK_SIZE
+        )
+        if sleep is None:
+            sleep = self.setting('DMIGRATIONS_ONLINE_SLEEP', DEFAULT_SLEEP)
+        self.sleep = sleep
+        self.execute = execute
+        self.shadow = _helper_name('_%s_new', table_name)
+        self.old = _helper_name('_%s_old', table_name)
+        self.triggers = [
+            _helper_name('%%s_online_%s' % event, table_name)
+            for event in ('ins', 'upd', 'del')
+        ]
+
+    def setting(self, name, default):
+        from django.conf import settings
+        return getattr(settings, name, default)
+
+    def run(self):
+        self.check()
+        self.primary_key = self.find_primary_key()
+        self.clean_up()
+        self.execute("DROP TABLE IF EXISTS %s" % _quote(self.old))
+        try:
+            self.create_shadow()
+            self.create_triggers()
+            self.copy_rows()
+            self.execute("RENAME TABLE %s TO %s, %s TO %s" % (
+                _quote(self.table), _quote(self.old),
+                _quote(self.shadow), _quote(self.table),
+            ))
+        except:
+            exc_info = sys.exc_info()
+            self.clean_up()
+            raise exc_info[0], exc_info[1], exc_info[2]
+        # Triggers moved with the old table
+        self.drop_triggers()
+        self.execute("DROP TABLE %s" % _quote(self.old))
+
+    def check(self):
+        if 'FOREIGN KEY' in self.clauses.upper():
+            raise OnlineAlterError(
+                "Foreign keys can't be added or dropped online"
+            )
+        if rename_re.search(self.clauses):
+            raise OnlineAlterError(
+                "Columns can't be changed or renamed online, only added, "
+                "dropped or modified"
+            )
+        foreign_keys = self.execute("""
+            SELECT COUNT(*) FROM information_schema.KEY_COLUMN_USAGE
+            WHERE TABLE_SCHEMA = DATABASE()
+            AND REFERENCED_TABLE_NAME IS NOT NULL
+            AND (TABLE_NAME = %s OR REFERENCED_TABLE_NAME = %s)
+        """, [self.table, self.table]).fetchone()[0]
+        if foreign_keys:
+            raise OnlineAlterError(
+                "Table %s has foreign keys, it can't be altered online"
+                % self.table
+            )
+        triggers = [
+            row for row in
+                self.execute("SHOW TRIGGERS LIKE %s", [self.table]).fetchall()
+            if row[0] not in self.triggers
+        ]
+        if triggers:
+            raise OnlineAlterError(
+                "Table %s has triggers, it can't be altered online"
+                % self.table
+            )
+
+    def find_primary_key(self):
+        # Column_name is the 5th column of SHOW KEYS
+        columns = [
+            row[4] for row in self.execute(
+                "SHOW KEYS FROM %s WHERE Key_name = 'PRIMARY'"
+                    % _quote(self.table)
+            ).fetchall()
+        ]
+        if len(columns) != 1:
+            raise OnlineAlterError(
+                "Table %s needs a single column primary key to be altered "
+                "online" % self.table
+            )
+        return columns[0]
+
+    def columns(self, table):
+        return [row[0] for row in self.execute(
+            "SHOW COLUMNS FROM %s" % _quote(table)
+        ).fetchall()]
+
+    def create_shadow(self):
+        self.execute("CREATE TABLE %s LIKE %s" % (
+            _quote(self.shadow), _quote(self.table)
+        ))
+        self.execute("ALTER TABLE %s %s" % (_quote(self.shadow), self.clauses))
+        # Columns dropped by the ALTER aren't copied, added ones get
+        # their defaults
+        old_columns = set(self.columns(self.table))
+        self.copied_columns = [
+            c for c in self.columns(self.shadow) if c in old_columns
+        ]
+
+    def create_triggers(self):
+        columns = ", ".join([_quote(c) for c in self.copied_columns])
+        new_values = ", ".join(["NEW.%s" % _quote(c) for c in self.copied_columns])
+        replace = "REPLACE INTO %s (%s) VALUES (%s)" % (
+            _quote(self.shadow), columns, new_values
+        )
+        delete = "DELETE IGNORE FROM %s WHERE %s = OLD.%s" % (
+            _quote(self.shadow), _quote(self.primary_key),
+            _quote(self.primary_key),
+        )
+        insert_trigger, update_trigger, delete_trigger = self.triggers
+        for (name, event, body) in [
+            (insert_trigger, 'INSERT', replace),
+            # Primary key itself may be updated
+            (update_trigger, 'UPDATE', "BEGIN %s; %s; END" % (delete, replace)),
+            (delete_trigger, 'DELETE', delete),
+        ]:
+            self.execute("CREATE TRIGGER %s AFTER %s ON %s FOR EACH ROW %s" % (
+                _quote(name), event, _quote(self.table), body
+            ))
+
+    def copy_rows(self):
+        """
+        Copy rows in primary key order, chunk_size at a time. Rows already
+        written by triggers are newer than the copied ones, so they're kept.
+        Each chunk is committed right away, so its row locks are released
+        before the next one is copied. Return number of rows copied.
+        """
+        pk = _quote(self.primary_key)
+        columns = ", ".join([_quote(c) for c in self.copied_columns])
+        copied = 0
+        reported_at = time.time()
+        lower = None
+        while True:
+            conditions, params = [], []
+            if lower is not None:
+                conditions.append("%s > %%s" % pk)
+                params.append(lower)
+            where = conditions and "WHERE " + " AND ".join(conditions) or ""
+            # Last key of this chunk, None if this is the last chunk
+            rows = self.execute("SELECT %s FROM %s %s ORDER BY %s LIMIT %d, 1" % (
+                pk, _quote(self.table), where, pk, self.chunk_size - 1
+            ), params).fetchall()
+            # Keys like 0 are valid too
+            upper = rows[0][0] if rows else None
+            if upper is not None:
+                conditions.append("%s <= %%s" % pk)
+                params.append(upper)
+                where = "WHERE " + " AND ".join(conditions)
+
+            cursor = self.execute("""
+                INSERT LOW_PRIORITY IGNORE INTO %s (%s)
+                SELECT %s FROM %s %s LOCK IN SHARE MODE
+            """ % (
+                _quote(self.shadow), columns, columns, _quote(self.table),
+                where,
+            ), params)
+            copied += cursor.rowcount
+            self.execute("COMMIT")
+
+            if upper is None:
+                return copied
+            lower = upper
+            if time.time() - reported_at >= REPORT_INTERVAL:
+                print "Copied %d rows of %s" % (copied, self.table)
+                reported_at = time.time()
+            if self.sleep:
+                time.sleep(self.sleep)
+
+    def drop_triggers(self):
+        for name in self.triggers:
+            self.execute("DROP TRIGGER IF EXISTS %s" % _quote(name))
+
+    def clean_up(self):
+        """
+        Remove whatever an interrupted or failed run left behind.
+        """
+        self.drop_triggers()
+        self.execute("DROP TABLE IF EXISTS %s" % _quote(self.shadow))
@@ -0,0 +1,122 @@
+"""
+Progress of long running DDL statements, read from performance_schema
+stage events while they run.
+
+InnoDB reports WORK_COMPLETED and WORK_ESTIMATED of ALTER TABLE stages
+only with the stage/innodb/alter% instruments and the
+events_stages_current consumer enabled, for example:
+
+    UPDATE performance_schema.setup_instruments
+    SET ENABLED = 'YES', TIMED = 'YES' WHERE NAME LIKE 'stage/innodb/alter%';
+    UPDATE performance_schema.setup_consumers
+    SET ENABLED = 'YES' WHERE NAME LIKE '%stages%';
+
+Without them, or without performance_schema, nothing is reported.
+"""
+import sys
+import threading
+import time
+
+# Seconds between polls, DMIGRATIONS_PROGRESS_INTERVAL setting overrides it
+DEFAULT_INTERVAL = 5
+
+STAGE_SQL = """
+    SELECT s.EVENT_NAME, s.WORK_COMPLETED, s.WORK_ESTIMATED
+    FROM performance_schema.events_stages_current s
+    JOIN performance_schema.threads t ON t.THREAD_ID = s.THREAD_ID
+    WHERE t.PROCESSLIST_ID = %s
+"""
+
+def _execute(sql, params=None):
+    from django.db import connection
+    cursor = connection.cursor()
+    cursor.execute(sql, params)
+    return cursor.fetchall()
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    if seconds < 60:
+        return '%ds' % seconds
+    if seconds < 3600:
+        return '%dm %02ds' % (seconds / 60, seconds % 60)
+    return '%dh %02dm' % (seconds / 3600, seconds % 3600 / 60)
+
+def print_progress(stage, percent, eta):
+    """
+    Progress callback printing progress to stdout.
+    """
+    if eta is None:
+        print "%s: %.1f%% done" % (stage, percent)
+    else:
+        print "%s: %.1f%% done, about %s left" % (
+            stage, percent, format_duration(eta)
+        )
+    sys.stdout.flush()
+
+class ProgressMonitor(threading.Thread):
+    """
+    Thread polling stage events of connection connection_id every
+    interval seconds, and calling callback(stage, percent, eta) when
+    there's progress to report. eta is in seconds, or None until it can
+    be estimated. Polls use the thread's own database connection.
+    """
+
+    def __init__(self, connection_id, callback=print_progress,
+                 interval=None, execute=_execute, now=time.time):
+        super(ProgressMonitor, self).__init__()
+        self.daemon = True
+        self.connection_id = connection_id
+        self.callback = callback
+        if interval is None:
+            from django.conf import settings
+            interval = getattr(settings, 'DMIGRATIONS_PROGRESS_INTERVAL',
+                DEFAULT_INTERVAL)
+        self.interval = interval
+        self.execute = execute
+        self.now = now
+        self.started_at = None
+        self.stopped = threading.Event()
+
+    def run(self):
+        try:
+            while True:
+                self.stopped.wait(self.interval)
+                if self.stopped.isSet():
+                    break
+                try:
+                    self.poll()
+                except Exception, e:
+                    # Most likely performance_schema isn't available
+                    print >>sys.stderr, u"Can't monitor progress: %s" % e
+                    break
+        finally:
+            if self.execute is _execute:
+                from django.db import connection
+                connection.close()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+    def poll(self):
+        """
+        Report progress of the current stage, if it has any.
+        """
+        rows = self.execute(STAGE_SQL, [self.connection_id])
+        if not rows:
+            return
+        stage, completed, estimated = rows[0]
+        if not estimated:
+            return
+        now = self.now()
+        fraction = min(float(completed) / estimated, 1.0)
+        if self.started_at is None:
+            # Time of the first progress seen, as work done before it
+            # can't be timed
+            self.started_at = now
+            self.started_fraction = fraction
+        eta = None
+        done_since = fraction - self.started_fraction
+        if done_since > 0:
+            eta = (now - self.started_at) / done_since * (1 - fraction)
+        self.callback(stage.split('/')[-1], fraction * 100, eta)
@@ -0,0 +1,201 @@
+"""
+Scheduler running independent migrations of a plan at the same time.
+"""
+import heapq
+import sys
+import threading
+import Queue
+
+# Result of migrations already recorded by MigrationState
+RECORDED = object()
+
+class ParallelScheduler(object):
+    """
+    Runs a plan with up to jobs migrations at a time. Each migration runs
+    in its own thread, and so on its own database connection.
+
+    Migrations touching the same table keep their plan order. A migration
+    whose tables are unknown waits for all earlier migrations, and all
+    later migrations wait for it. Results are recorded through
+    MigrationState in plan order, so state stays consistent when some
+    migration fails.
+
+    Atomic migrations record their results in their own transaction, so
+    they're applied through MigrationState like without jobs, alone and
+    in the calling thread.
+    """
+
+    def __init__(self, migration_state, jobs, verbosity=1, print_time=False):
+        self.migration_state = migration_state
+        self.jobs = jobs
+        self.verbosity = verbosity
+        self.print_time = print_time
+
+    def report(self, message):
+        if self.verbosity >= 1:
+            print message
+
+    def touched_tables(self, name, migration):
+        """
+        Return tables from migration header, or from migration itself.
+        Atomic migrations don't run together with any others.
+        """
+        if getattr(migration, 'atomic', False):
+            return None
+        header = self.migration_state.migration_db.migration_header(name)
+        if header.tables is not None:
+            return header.tables
+        return migration.touched_tables()
+
+    def dependencies(self, tables):
+        """
+        Given list of tables touched by each plan entry (or None if
+        unknown), return list of sets of entries each entry depends on.
+        """
+        dependencies = []
+        last_by_table = {}
+        last_barrier = None
+        since_barrier = []
+        for (i, entry_tables) in enumerate(tables):
+            depends_on = set()
+            if last_barrier is not None:
+                depends_on.add(last_barrier)
+            if entry_tables is None:
+                depends_on.update(since_barrier)
+                last_barrier = i
+                since_barrier = []
+                last_by_table = {}
+            else:
+                for table in entry_tables:
+                    if table in last_by_table:
+                        depends_on.add(last_by_table[table])
+                    last_by_table[table] = i
+                since_barrier.append(i)
+            dependencies.append(depends_on)
+        return dependencies
+
+    def run(self, plan):
+        """
+        Run plan, a list of (migration name, direction) pairs. If any
+        migration fails, no new migrations are started, and the first
+        error is raised once the running ones are finished and recorded.
+        """
+        migration_db = self.migration_state.migration_db
+        # Loading isn't thread safe, so all migrations are loaded up front
+        migrations = [
+            migration_db.load_migration_object(name) for (name, _) in plan
+        ]
+        dependencies = self.dependencies([
+            self.touched_tables(name, migration)
+            for ((name, _), migration) in zip(plan, migrations)
+        ])
+        # The calling thread's connection would otherwise sit in a long
+        # transaction, which DDL of the migration threads waits for
+        self.migration_state.commit()
+
+        waiting_for = [len(d) for d in dependencies]
+        dependents = [[] for _ in plan]
+        for (i, depends_on) in enumerate(dependencies):
+            for j in depends_on:
+                dependents[j].append(i)
+        ready = [i for i in range(len(plan)) if not waiting_for[i]]
+        heapq.heapify(ready)
+
+        results = Queue.Queue()
+        started = set()
+        finished = {}
+        running = 0
+        next_to_record = 0
+        first_error = None
+
+        while next_to_record < len(plan):
+            while first_error is None and ready and running < self.jobs:
+                i = heapq.heappop(ready)
+                name, direction = plan[i]
+                if direction == 'up':
+                    self.report("Applying migration %s" % name)
+                else:
+                    self.report("Unapplying migration %s" % name)
+                started.add(i)
+                running += 1
+                if getattr(migrations[i], 'atomic', False):
+                    # Nothing else is running, as it depends on everything
+                    # before it and everything after it depends on it
+                    self.run_atomic(i, name, direction, results)
+                    continue
+                thread = threading.Thread(
+                    target = self.run_in_thread,
+                    args = (i, migrations[i], direction, results)
+                )
+                thread.start()
+
+            if running:
+                i, duration_ms, exc_info = results.get()
+                running -= 1
+                finished[i] = (duration_ms, exc_info)
+                if exc_info is not None:
+                    if first_error is None:
+                        first_error = exc_info
+                else:
+                    for j in dependents[i]:
+                        waiting_for[j] -= 1
+                        if not waiting_for[j]:
+                            heapq.heappush(ready, j)
+            else:
+                # Nothing more will start, skip whatever is left
+                for i in range(len(plan)):
+                    if i not in started:
+                        finished[i] = None
+
+            while next_to_record in finished:
+                self.record(plan[next_to_record], finished[next_to_record])
+                next_to_record += 1
+
+        if first_error is not None:
+            raise first_error[0], first_error[1], first_error[2]
+
+    def run_in_thread(self, i, migration, direction, results):
+        from django.db import connection
+        try:
+            duration_ms = self.migration_state.run_migration(
+                migration, direction
+            )
+            result = (i, duration_ms, None)
+        except Exception:
+            result = (i, None, sys.exc_info())
+        # Every thread has its own connection
+        try:
+            connection.close()
+        except Exception:
+            pass
+        results.put(result)
+
+    def run_atomic(self, i, name, direction, results):
+        try:
+            if direction == 'up':
+                self.migration_state.apply(name)
+            else:
+                self.migration_state.unapply(name)
+            result = (i, RECORDED, None)
+        except Exception:
+            result = (i, RECORDED, sys.exc_info())
+        results.put(result)
+
+    def record(self, plan_entry, result):
+        name, direction = plan_entry
+        if result is None:
+            self.report("Skipped migration %s" % name)
+            return
+        duration_ms, exc_info = result
+        if duration_ms is RECORDED:
+            return
+        if exc_info is None:
+            self.migration_state.record_result(name, direction, duration_ms)
+            if self.print_time:
+                print "Migration %s ran %.1f seconds" % (
+                    name, duration_ms / 1000.0
+                )
+        else:
+            self.migration_state.record_result(
+                name, direction, error=exc_info[1]
+            )
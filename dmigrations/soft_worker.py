@@ -0,0 +1,224 @@
+"""
+Background worker applying pending SOFT migrations, those which don't
+require the site to be down, after a deploy ran the hard ones.
+
+The worker reports its progress to the dmigrations_worker table, and
+can be paused and resumed through it from any host.
+"""
+from migration_state import _execute, _execute_in_transaction, table_present
+from migration_lock import acquire_lock, release_lock, acquire_soft_lock, \
+    DEFAULT_LOCK_TIMEOUT
+from scheduler import ParallelScheduler
+
+import os, sys
+import socket
+import time
+import traceback
+
+WORKER_TABLE_SQL = """
+    CREATE TABLE `dmigrations_worker` (
+     `name` VARCHAR(64) NOT NULL,
+     `state` VARCHAR(16) NOT NULL,
+     `paused` tinyint(1) NOT NULL DEFAULT 0,
+     `pid` int(11) NULL,
+     `host` VARCHAR(255) NULL,
+     `running` TEXT NULL,
+     `done` int(11) NOT NULL DEFAULT 0,
+     `total` int(11) NOT NULL DEFAULT 0,
+     `error` TEXT NULL,
+     `updated_at` DATETIME NULL,
+      PRIMARY KEY (`name`)
+    ) ENGINE=InnoDB DEFAULT CHARSET=utf8
+"""
+
+STATUS_FIELDS = [
+    'state', 'paused', 'pid', 'host', 'running', 'done', 'total', 'error',
+    'updated_at',
+]
+
+class WorkerStatus(object):
+    """
+    Row of dmigrations_worker describing a worker. state is one of
+    running, paused, finished and failed. paused is set by pause requests,
+    the worker pauses once its running migrations finish.
+    """
+
+    def __init__(self, name='soft'):
+        self.name = name
+
+    def init(self):
+        if not table_present('dmigrations_worker'):
+            _execute(WORKER_TABLE_SQL)
+
+    def start(self, pid, host):
+        _execute_in_transaction("""
+            INSERT INTO dmigrations_worker
+                (name, state, pid, host, done, total, updated_at)
+            VALUES (%s, 'running', %s, %s, 0, 0, NOW())
+            ON DUPLICATE KEY UPDATE state = 'running', pid = VALUES(pid),
+                host = VALUES(host), running = NULL, done = 0, total = 0,
+                error = NULL, updated_at = NOW()
+        """, [self.name, pid, host])
+
+    def update(self, **fields):
+        names = sorted(fields)
+        _execute_in_transaction("""
+            UPDATE dmigrations_worker SET %s, updated_at = NOW()
+            WHERE name = %%s
+        """ % ", ".join(["%s = %%s" % name for name in names]),
+            [fields[name] for name in names] + [self.name]
+        )
+
+    def set_paused(self, paused):
+        """
+        Request worker to pause or resume. Return False if there's no
+        such worker.
+        """
+        self.init()
+        _execute_in_transaction(
+            "UPDATE dmigrations_worker SET paused = %s WHERE name = %s",
+            [int(paused), self.name]
+        )
+        return self.get() is not None
+
+    def is_paused(self):
+        row = _execute(
+            "SELECT paused FROM dmigrations_worker WHERE name = %s",
+            [self.name]
+        ).fetchone()
+        return bool(row and row[0])
+
+    def get(self):
+        """
+        Return dict of status fields, or None if worker never ran.
+        """
+        row = _execute(
+            "SELECT %s FROM dmigrations_worker WHERE name = %%s"
+                % ", ".join(STATUS_FIELDS),
+            [self.name]
+        ).fetchone()
+        if row is None:
+            return None
+        return dict(zip(STATUS_FIELDS, row))
+
+class SoftMigrationWorker(object):
+    """
+    Applies pending soft migrations, up to jobs at a time.
+
+    Migrations run in groups of up to jobs migrations. The worker holds
+    the soft lock while it runs, and the migration lock only while it
+    plans each group and records state after it, so deploys applying hard
+    migrations don't wait for soft ones. Pause requests are checked between groups.
+    """
+
+    def __init__(self, migration_state, jobs=1,
+                 lock_timeout=DEFAULT_LOCK_TIMEOUT, poll_interval=10,
+                 verbosity=1):
+        self.migration_state = migration_state
+        self.jobs = jobs
+        self.lock_timeout = lock_timeout
+        self.poll_interval = poll_interval
+        self.verbosity = verbosity
+        self.status = WorkerStatus()
+
+    def run(self):
+        status = self.status
+        status.init()
+        # Taken before touching the status, which belongs to the worker
+        # already running if there's one
+        soft_lock = acquire_soft_lock(self.lock_timeout)
+        try:
+            status.start(os.getpid(), socket.gethostname())
+            done = 0
+            try:
+                while True:
+                    self.wait_while_paused()
+                    plan = self.plan()
+                    if not plan:
+                        break
+                    group = plan[:self.jobs]
+                    status.update(
+                        total = done + len(plan),
+                        running = ", ".join([name for (name, _) in group]),
+                    )
+                    try:
+                        ParallelScheduler(self.migration_state, self.jobs,
+                            verbosity = self.verbosity,
+                        ).run(group)
+                    finally:
+                        self.record_state()
+                    done += len(group)
+                    status.update(done = done, running = None)
+            except Exception, e:
+                status.update(state = 'failed', running = None, error = str(e))
+                raise
+            status.update(state = 'finished', total = done)
+        finally:
+            soft_lock.release()
+
+    def plan(self):
+        """
+        Return plan of soft migrations left, made holding the migration
+        lock, so it's consistent with what other hosts apply.
+        """
+        acquire_lock(self.lock_timeout)
+        try:
+            # Others may have applied some meanwhile
+            self.migration_state.invalidate_snapshot()
+            return self.migration_state.plan('all_soft')
+        finally:
+            release_lock()
+
+    def record_state(self):
+        """
+        Record state like dmigrate runs do, holding the migration lock.
+        """
+        acquire_lock(self.lock_timeout)
+        try:
+            self.migration_state.record_state()
+        finally:
+            release_lock()
+
+    def wait_while_paused(self):
+        if not self.status.is_paused():
+            return
+        self.status.update(state = 'paused')
+        while self.status.is_paused():
+            time.sleep(self.poll_interval)
+        self.status.update(state = 'running')
+
+def run_in_background(worker, log_path=None):
+    """
+    Run worker in a detached process, with output going to log_path.
+    Returns right away in the calling process.
+    """
+    from django.db import connection
+    # A connection can't be shared by two processes, as the first one to
+    # close it would close it for the other too. Both open new ones when
+    # needed.
+    connection.close()
+    pid = os.fork()
+    if pid:
+        os.waitpid(pid, 0)
+        return
+    # Detach from the terminal, and make sure the first child exits,
+    # so the worker isn't left as a zombie of the calling process
+    os.setsid()
+    if os.fork():
+        os._exit(0)
+
+    null_input = open(os.devnull)
+    output = open(log_path or os.devnull, 'a')
+    os.dup2(null_input.fileno(), sys.stdin.fileno())
+    os.dup2(output.fileno(), sys.stdout.fileno())
+    os.dup2(output.fileno(), sys.stderr.fileno())
+
+    exit_status = 0
+    try:
+        worker.run()
+    except Exception:
+        traceback.print_exc()
+        exit_status = 1
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os._exit(exit_status)
@@ -0,0 +1,145 @@
+"""
+Streaming splitter of SQL text into statements.
+
+Understands quoted strings and identifiers, comments and DELIMITER
+commands of the mysql client, and reads its input line by line, so
+big SQL files can be run without loading them into memory.
+"""
+import re
+
+DEFAULT_DELIMITER = ';'
+CHUNK_SIZE = 64 * 1024
+
+delimiter_command_re = re.compile(r'^\s*DELIMITER\s+(\S+)\s*$', re.I)
+
+def _token_re(delimiter):
+    # Delimiter goes first, so it wins over any token it starts like
+    return re.compile(r"%s|['\"`#]|--(?=\s|$)|/\*" % re.escape(delimiter))
+
+def _lines(source, chunk_size):
+    """
+    Yield lines of a string or a file-like object, with line endings.
+    """
+    if isinstance(source, basestring):
+        read = iter([source]).next
+        def read_chunk():
+            try:
+                return read()
+            except StopIteration:
+                return ''
+    else:
+        read_chunk = lambda: source.read(chunk_size)
+
+    rest = ''
+    while True:
+        chunk = read_chunk()
+        if not chunk:
+            break
+        lines = (rest + chunk).split('\n')
+        rest = lines.pop()
+        for line in lines:
+            yield line + '\n'
+    if rest:
+        yield rest
+
+def iter_statements(source, chunk_size=CHUNK_SIZE):
+    """
+    Yield statements of SQL source, a string or a file-like object, one
+    by one. Statements are stripped and don't include the delimiter.
+    Comments are dropped, except for /*! ... */ and /*+ ... */ ones,
+    which MySQL executes. Statements consisting only of comments and
+    whitespace are skipped.
+    """
+    delimiter = DEFAULT_DELIMITER
+    token_re = _token_re(delimiter)
+    statement = []
+    has_code = False
+    # Quote character of the string we're in, '/*' in a dropped comment,
+    # or '/*!' in a kept one
+    inside = None
+
+    for line in _lines(source, chunk_size):
+        if inside is None and not has_code:
+            m = delimiter_command_re.match(line)
+            if m:
+                delimiter = m.group(1)
+                token_re = _token_re(delimiter)
+                statement = []
+                continue
+
+        i = 0
+        while i < len(line):
+            if inside in ("'", '"', '`'):
+                j = i
+                while True:
+                    j = line.find(inside, j)
+                    if j == -1:
+                        break
+                    # Backslash escapes only work in strings, a doubled
+                    # quote is just two strings in a row
+                    backslashes = 0
+                    while inside != '`' and j - backslashes > i and \
+                        line[j - backslashes - 1] == '\\':
+                        backslashes += 1
+                    if backslashes % 2 == 0:
+                        break
+                    j += 1
+                if j == -1:
+                    statement.append(line[i:])
+                    i = len(line)
+                else:
+                    statement.append(line[i:j + 1])
+                    inside = None
+                    i = j + 1
+                continue
+
+            if inside in ('/*', '/*!'):
+                j = line.find('*/', i)
+                end = len(line) if j == -1 else j + 2
+                if inside == '/*!':
+                    statement.append(line[i:end])
+                if j != -1:
+                    inside = None
+                i = end
+                continue
+
+            m = token_re.search(line, i)
+            if not m:
+                chunk = line[i:]
+                statement.append(chunk)
+                has_code = has_code or bool(chunk.strip())
+                break
+
+            before = line[i:m.start()]
+            statement.append(before)
+            has_code = has_code or bool(before.strip())
+            token = m.group(0)
+
+            if token == delimiter:
+                if has_code:
+                    yield ''.join(statement).strip()
+                statement = []
+                has_code = False
+                i = m.end()
+            elif token in ("'", '"', '`'):
+                statement.append(token)
+                has_code = True
+                inside = token
+                i = m.end()
+            elif token == '/*':
+                if line[m.end():m.end() + 1] in ('!', '+'):
+                    statement.append(token)
+                    has_code = True
+                    inside = '/*!'
+                else:
+                    # Dropped comment still separates tokens
+                    statement.append(' ')
+                    inside = '/*'
+                i = m.end()
+            else:
+                # -- and # comments last until end of line
+                statement.append('\n')
+                break
+
+    if has_code:
+        yield ''.join(statement).strip()
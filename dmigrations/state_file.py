@@ -0,0 +1,104 @@
+"""
+Compact text format for snapshots of migration state, used to export and
+import the dmigrations table (and optionally dmigrations_log).
+
+The first line is a format marker, every following line is a record with
+tab-separated, string_escape encoded fields:
+
+    dmigrations-state 1
+    A <migration> <applied_at> <duration_ms> <content_hash>
+    L <action> <migration> <status> <datetime>
+
+Missing values are written as empty fields.
+"""
+from exceptions import *
+
+import datetime
+import gzip
+
+STATE_FILE_MARKER = 'dmigrations-state 1'
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+def open_state_file(path, mode='r'):
+    """
+    Open state file, gzipped if its name ends with .gz.
+    """
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 'b')
+    return open(path, mode)
+
+def _encode(value):
+    if value is None:
+        return ''
+    if isinstance(value, datetime.datetime):
+        return value.strftime(DATETIME_FORMAT)
+    if isinstance(value, unicode):
+        value = value.encode('utf8')
+    return str(value).encode('string_escape')
+
+def _decode(value):
+    if value == '':
+        return None
+    return value.decode('string_escape').decode('utf8')
+
+def _decode_datetime(value):
+    if value == '':
+        return None
+    return datetime.datetime.strptime(value, DATETIME_FORMAT)
+
+def _decode_int(value):
+    if value == '':
+        return None
+    return int(value)
+
+class StateFile(object):
+    """
+    Contents of a state file. applied is a list of
+    (migration, applied_at, duration_ms, content_hash) tuples,
+    log is a list of (action, migration, status, datetime) tuples.
+    """
+
+    def __init__(self, applied=None, log=None):
+        self.applied = applied or []
+        self.log = log or []
+
+    def applied_names(self):
+        return [row[0] for row in self.applied]
+
+    def write(self, output):
+        output.write(STATE_FILE_MARKER + '\n')
+        for row in self.applied:
+            output.write('\t'.join(['A'] + [_encode(v) for v in row]) + '\n')
+        for row in self.log:
+            output.write('\t'.join(['L'] + [_encode(v) for v in row]) + '\n')
+
+    @classmethod
+    def read(cls, input):
+        state = cls()
+        lines = iter(input)
+        try:
+            marker = lines.next().rstrip('\r\n')
+        except StopIteration:
+            marker = None
+        if marker != STATE_FILE_MARKER:
+            raise MigrationError(u"Not a dmigrations state file")
+
+        for line in lines:
+            fields = line.rstrip('\r\n').split('\t')
+            if fields[0] == 'A' and len(fields) == 5:
+                state.applied.append((
+                    _decode(fields[1]),
+                    _decode_datetime(fields[2]),
+                    _decode_int(fields[3]),
+                    _decode(fields[4]),
+                ))
+            elif fields[0] == 'L' and len(fields) == 5:
+                state.log.append((
+                    _decode(fields[1]),
+                    _decode(fields[2]),
+                    _decode(fields[3]) or '',
+                    _decode_datetime(fields[4]),
+                ))
+            elif fields != ['']:
+                raise MigrationError(u"Bad state file line: %r" % line)
+        return state
@@ -3,6 +3,7 @@ import unittest
 TC = unittest.TestCase
 
 import mysql.migrations as m
+import mysql.online as online
 
 class Behavior(object):
     def __call__(self, statements, return_rows):
@@ -12,8 +13,11 @@ class StatementLogger(Behavior):
     def __init__(self):
         self.log = []
 
-    def __call__(self, statements, return_rows):
-        self.log.extend(statements)
+    def __call__(self, statements, return_rows=False, progress=None):
+        for statement in statements:
+            self.log.append(statement)
+            if progress is not None:
+                progress(len(self.log))
 
 class StatementFaker(StatementLogger):
     def __init__(self, handler):
@@ -26,11 +30,24 @@ class StatementFaker(StatementLogger):
             return self.handler(statements)
 
 class StatementFailer(StatementLogger):
-    def __call__(self, statements, return_rows):
+    def __call__(self, statements, return_rows=False, progress=None):
         super(StatementFailer, self).__call__(statements, return_rows)
         from MySQLdb import OperationalError
         raise OperationalError(9999, 'This is a fake error')
 
+class FakeJournal(object):
+    def __init__(self, steps_done=0):
+        self.steps_done = steps_done
+        self.recorded = []
+        self.children = {}
+
+    def child(self, i):
+        return self.children.setdefault(i, FakeJournal())
+
+    def record(self, steps_done):
+        self.steps_done = steps_done
+        self.recorded.append(steps_done)
+
 class DualTest(TC):
     def check(self, mig, up_sql, down_sql, up_behavior=StatementLogger, down_behavior=StatementLogger):
         def instance(cls_or_obj):
@@ -111,6 +128,362 @@ class TestAddDropIndex(DualTest):
         self.check(mig, drop_sql, add_sql)
 
 
+class TestJournal(TC):
+    def test_migration_resumes(self):
+        mig = m.Migration(['a', 'b', 'c', 'd'])
+        mig.run_statements = StatementLogger()
+        mig.journal = FakeJournal(2)
+        mig.up()
+        self.failUnlessEqual(mig.run_statements.log, ['c', 'd'])
+        self.failUnlessEqual(mig.journal.recorded, [3, 4])
+
+    def test_compound_keeps_finished_children(self):
+        first = m.Migration(['a'])
+        first.run_statements = StatementLogger()
+        second = m.Migration(['b', 'c'])
+        second.run_statements = StatementFailer()
+        mig = m.Compound([first, second])
+        mig.journal = FakeJournal()
+
+        from MySQLdb import OperationalError
+        self.assertRaises(OperationalError, mig.up)
+        self.failUnlessEqual(first.run_statements.log, ['a'])
+        self.failUnlessEqual(mig.journal.recorded, [1])
+        self.failUnlessEqual(mig.journal.children[0].recorded, [1])
+
+        second.run_statements = StatementLogger()
+        first.run_statements = StatementLogger()
+        mig.up()
+        self.failUnlessEqual(first.run_statements.log, [])
+        self.failUnlessEqual(second.run_statements.log, ['b', 'c'])
+        self.failUnlessEqual(mig.journal.recorded, [1, 2])
+        self.failUnlessEqual(None, first.journal)
+
+    def test_compound_without_journal_rolls_back(self):
+        first = m.Migration(['a'], ['undo a'])
+        first.run_statements = StatementLogger()
+        second = m.Migration(['b'])
+        second.run_statements = StatementFailer()
+        mig = m.Compound([first, second])
+
+        from MySQLdb import OperationalError
+        self.assertRaises(OperationalError, mig.up)
+        self.failUnlessEqual(first.run_statements.log, ['a', 'undo a'])
+
+
+class TestCoalescedAlterTable(DualTest):
+    def test_plain(self):
+        up_sql = ['ALTER TABLE `quiz_answer` ADD COLUMN `text` VARCHAR(50),'
+                  '\n  ADD INDEX `foobar` (`text`),'
+                  '\n  DROP COLUMN `old`;']
+
+        mig = m.CoalescedAlterTable([
+            m.AddColumn('quiz', 'answer', 'text', 'VARCHAR(50)'),
+            m.AddIndex('quiz', 'answer', 'text', 'foobar'),
+            m.DropColumn('quiz', 'answer', 'old', 'INT'),
+        ])
+        mig.run_statements = StatementLogger()
+        mig.up()
+        self.failUnlessEqual(mig.run_statements.log, up_sql)
+
+    def test_coalesce_alters(self):
+        class CustomAlter(m.AddColumn):
+            def up(self):
+                pass
+
+        migrations = {
+            '001_a': m.AddColumn('quiz', 'answer', 'a', 'INT'),
+            '002_b': m.AddIndex('quiz', 'answer', 'a'),
+            '003_c': m.AddColumn('quiz', 'question', 'c', 'INT'),
+            '004_d': m.AddColumn('quiz', 'question', 'd', 'INT'),
+            '005_e': m.Migration('sql up', 'sql down'),
+            '006_f': m.AddColumn('quiz', 'question', 'f', 'INT'),
+            '007_g': CustomAlter('quiz', 'question', 'g', 'INT'),
+            '008_h': m.AddColumn('quiz', 'question', 'h', 'INT'),
+            '009_i': m.AddColumn('quiz', 'question', 'i', 'INT', algorithm='INSTANT'),
+        }
+        class FakeMigrationDb(object):
+            def load_migration_object(self, name):
+                return migrations[name]
+
+        plan = [(name, 'up') for name in sorted(migrations)]
+        self.failUnlessEqual(m.coalesce_alters(plan, FakeMigrationDb()), [
+            [('001_a', 'up'), ('002_b', 'up')],
+            [('003_c', 'up'), ('004_d', 'up')],
+            [('005_e', 'up')],
+            [('006_f', 'up')],
+            [('007_g', 'up')],
+            [('008_h', 'up')],
+            [('009_i', 'up')],
+        ])
+
+        plan = [('004_d', 'down'), ('003_c', 'down')]
+        self.failUnlessEqual(m.coalesce_alters(plan, FakeMigrationDb()), [
+            [('004_d', 'down')],
+            [('003_c', 'down')],
+        ])
+
+
+class AlgorithmRefuser(StatementLogger):
+    "Fails statements asking for one of algorithms like MySQL would"
+    def __init__(self, algorithms, code=1846):
+        super(AlgorithmRefuser, self).__init__()
+        self.algorithms = algorithms
+        self.code = code
+
+    def __call__(self, statements, return_rows=False, progress=None):
+        statements = list(statements)
+        super(AlgorithmRefuser, self).__call__(statements, return_rows)
+        for algorithm in self.algorithms:
+            if 'ALGORITHM=%s' % algorithm in statements[-1]:
+                raise Exception(self.code, 'ALGORITHM=%s is not supported' % algorithm)
+
+class TestAlterAlgorithm(TC):
+    add_sql = 'ALTER TABLE `quiz_answer` ADD COLUMN `text` VARCHAR(50)'
+
+    def test_cheapest_first(self):
+        mig = m.AddColumn('quiz', 'answer', 'text', 'VARCHAR(50)',
+                          algorithm='inplace', lock='none')
+        mig.run_statements = StatementLogger()
+        mig.up()
+        self.failUnlessEqual(mig.run_statements.log, [
+            self.add_sql + ', ALGORITHM=INSTANT',
+        ])
+        self.failUnlessEqual(mig.algorithm_used, 'INSTANT')
+
+    def test_fallback(self):
+        mig = m.AddColumn('quiz', 'answer', 'text', 'VARCHAR(50)',
+                          algorithm='COPY', lock='SHARED')
+        mig.run_statements = AlgorithmRefuser(['INSTANT', 'INPLACE'])
+        mig.up()
+        self.failUnlessEqual(mig.run_statements.log, [
+            self.add_sql + ', ALGORITHM=INSTANT',
+            self.add_sql + ', ALGORITHM=INPLACE, LOCK=SHARED',
+            self.add_sql + ', ALGORITHM=COPY, LOCK=SHARED',
+        ])
+        self.failUnlessEqual(mig.algorithm_used, 'COPY')
+
+    def test_no_slower_than_allowed(self):
+        mig = m.AddColumn('quiz', 'answer', 'text', 'VARCHAR(50)',
+                          algorithm='INSTANT')
+        mig.run_statements = AlgorithmRefuser(['INSTANT'])
+        self.assertRaises(Exception, lambda: mig.up())
+        self.failUnlessEqual(mig.run_statements.log, [
+            self.add_sql + ', ALGORITHM=INSTANT',
+        ])
+        self.failUnlessEqual(mig.algorithm_used, None)
+
+        # Other errors don't fall back
+        mig = m.AddIndex('quiz', 'answer', 'text', algorithm='INPLACE')
+        mig.run_statements = AlgorithmRefuser(['INSTANT'], code=1072)
+        self.assertRaises(Exception, lambda: mig.up())
+        self.failUnlessEqual(len(mig.run_statements.log), 1)
+
+    def test_lock_only(self):
+        mig = m.DropIndex('quiz', 'answer', 'text', lock='NONE')
+        mig.run_statements = StatementLogger()
+        mig.up()
+        self.failUnlessEqual(mig.run_statements.log, [
+            'ALTER TABLE `quiz_answer` DROP INDEX `quiz_answer_text`, LOCK=NONE',
+        ])
+
+    def test_change_column(self):
+        mig = m.ChangeColumn('site_userip', oldname='ip', newname='ipe',
+                             algorithm='INPLACE', lock='NONE')
+        def handler(statements):
+            return [(u'ip', u'char(15)', u'NO', u'', u'', u'')]
+        mig.run_statements = StatementFaker(handler)
+        mig.up()
+        self.failUnlessEqual(mig.run_statements.log, [
+            'DESC `site_userip`',
+            'ALTER TABLE `site_userip` CHANGE `ip` `ipe` char(15) NOT NULL, '
+                'ALGORITHM=INSTANT',
+        ])
+
+    def test_coalescing(self):
+        first = m.AddColumn('quiz', 'answer', 'a', 'INT', algorithm='INSTANT')
+        same = m.AddIndex('quiz', 'answer', 'a', algorithm='INSTANT')
+        other = m.AddIndex('quiz', 'answer', 'a', algorithm='INPLACE')
+        self.failUnless(m.CoalescedAlterTable.can_coalesce(same, first))
+        self.failIf(m.CoalescedAlterTable.can_coalesce(other, first))
+        self.failUnlessEqual(m.CoalescedAlterTable([first, same]).algorithm, 'INSTANT')
+
+class FakeCursor(object):
+    def __init__(self, rows=[], rowcount=0):
+        self.rows = rows
+        self.rowcount = rowcount
+
+    def fetchone(self):
+        return self.rows[0]
+
+    def fetchall(self):
+        return self.rows
+
+class FakeTable(object):
+    """
+    Answers the queries OnlineAlter runs against table `t` with columns
+    id, a and b, and primary keys keys. Logs all other statements.
+    """
+    def __init__(self, primary_key=['id'], foreign_keys=0, triggers=[],
+                 keys=range(1, 6)):
+        self.primary_key = primary_key
+        self.foreign_keys = foreign_keys
+        self.triggers = triggers
+        self.keys = keys
+        self.log = []
+
+    def keys_after(self, params):
+        if params:
+            return [k for k in self.keys if k > params[0]]
+        return self.keys
+
+    def __call__(self, sql, params=None):
+        sql = ' '.join(sql.split())
+        if 'information_schema.KEY_COLUMN_USAGE' in sql:
+            return FakeCursor([(self.foreign_keys,)])
+        if sql.startswith('SHOW TRIGGERS'):
+            return FakeCursor([(name,) for name in self.triggers])
+        if sql.startswith('SHOW KEYS'):
+            return FakeCursor([('t', 0, 'PRIMARY', 1, c) for c in self.primary_key])
+        if sql == 'SHOW COLUMNS FROM `t`':
+            return FakeCursor([('id',), ('a',), ('b',)])
+        if sql == 'SHOW COLUMNS FROM `_t_new`':
+            return FakeCursor([('id',), ('a',), ('c',)])
+        if sql.startswith('SELECT `id`'):
+            offset = int(sql.split('LIMIT ')[1].split(',')[0])
+            keys = self.keys_after(params)
+            return FakeCursor([(k,) for k in keys[offset:offset + 1]])
+        self.log.append((sql, params))
+        if sql.startswith('INSERT'):
+            keys = self.keys
+            if '>' in sql.replace('<=', ''):
+                keys = self.keys_after(params)
+            if '<=' in sql:
+                keys = [k for k in keys if k <= params[-1]]
+            return FakeCursor(rowcount=len(keys))
+        return FakeCursor()
+
+class TestOnlineAlter(TC):
+    def test_run(self):
+        table = FakeTable()
+        online.OnlineAlter('t', 'DROP COLUMN `b`, ADD COLUMN `c` INT',
+            chunk_size=2, sleep=0, execute=table,
+        ).run()
+        copy = 'INSERT LOW_PRIORITY IGNORE INTO `_t_new` (`id`, `a`) ' \
+            'SELECT `id`, `a` FROM `t` %s LOCK IN SHARE MODE'
+        replace = 'REPLACE INTO `_t_new` (`id`, `a`) VALUES (NEW.`id`, NEW.`a`)'
+        delete = 'DELETE IGNORE FROM `_t_new` WHERE `id` = OLD.`id`'
+        drop_triggers = [
+            ('DROP TRIGGER IF EXISTS `t_online_%s`' % event, None)
+            for event in ('ins', 'upd', 'del')
+        ]
+        self.failUnlessEqual(table.log, drop_triggers + [
+            ('DROP TABLE IF EXISTS `_t_new`', None),
+            ('DROP TABLE IF EXISTS `_t_old`', None),
+            ('CREATE TABLE `_t_new` LIKE `t`', None),
+            ('ALTER TABLE `_t_new` DROP COLUMN `b`, ADD COLUMN `c` INT', None),
+            ('CREATE TRIGGER `t_online_ins` AFTER INSERT ON `t` '
+                'FOR EACH ROW ' + replace, None),
+            ('CREATE TRIGGER `t_online_upd` AFTER UPDATE ON `t` '
+                'FOR EACH ROW BEGIN %s; %s; END' % (delete, replace), None),
+            ('CREATE TRIGGER `t_online_del` AFTER DELETE ON `t` '
+                'FOR EACH ROW ' + delete, None),
+            (copy % 'WHERE `id` <= %s', [2]),
+            ('COMMIT', None),
+            (copy % 'WHERE `id` > %s AND `id` <= %s', [2, 4]),
+            ('COMMIT', None),
+            (copy % 'WHERE `id` > %s', [4]),
+            ('COMMIT', None),
+            ('RENAME TABLE `t` TO `_t_old`, `_t_new` TO `t`', None),
+        ] + drop_triggers + [
+            ('DROP TABLE `_t_old`', None),
+        ])
+
+    def test_commits_every_chunk(self):
+        table = FakeTable()
+        online.OnlineAlter('t', 'ADD COLUMN `c` INT',
+            chunk_size=1, sleep=0, execute=table,
+        ).run()
+        statements = [sql.split()[0] for (sql, params) in table.log]
+        start = statements.index('INSERT')
+        # Keys 1..5 and the empty chunk after them
+        self.failUnlessEqual(statements[start:start + 12], ['INSERT', 'COMMIT'] * 6)
+
+    def test_zero_key(self):
+        table = FakeTable(keys=range(0, 5))
+        alter = online.OnlineAlter('t', 'ADD COLUMN `c` INT',
+            chunk_size=1, sleep=0, execute=table,
+        )
+        alter.primary_key = 'id'
+        alter.copied_columns = ['id', 'a']
+        self.failUnlessEqual(alter.copy_rows(), 5)
+        copies = [params for (sql, params) in table.log if sql.startswith('INSERT')]
+        self.failUnlessEqual(copies, [[0], [0, 1], [1, 2], [2, 3], [3, 4], [4]])
+
+    def test_failure_cleans_up(self):
+        class FailingTable(FakeTable):
+            def __call__(self, sql, params=None):
+                if sql.startswith('RENAME'):
+                    raise ValueError('fake error')
+                return super(FailingTable, self).__call__(sql, params)
+
+        table = FailingTable()
+        self.assertRaises(ValueError, lambda: online.OnlineAlter(
+            't', 'ADD COLUMN `c` INT', chunk_size=10, sleep=0, execute=table,
+        ).run())
+        self.failUnlessEqual(table.log[-4:], [
+            ('DROP TRIGGER IF EXISTS `t_online_ins`', None),
+            ('DROP TRIGGER IF EXISTS `t_online_upd`', None),
+            ('DROP TRIGGER IF EXISTS `t_online_del`', None),
+            ('DROP TABLE IF EXISTS `_t_new`', None),
+        ])
+
+    def test_unsupported_tables(self):
+        def alter(table, clauses='ADD COLUMN `c` INT'):
+            return lambda: online.OnlineAlter(
+                't', clauses, chunk_size=10, sleep=0, execute=table,
+            ).run()
+
+        for table in [
+            FakeTable(primary_key=[]),
+            FakeTable(primary_key=['id', 'a']),
+            FakeTable(foreign_keys=1),
+            FakeTable(triggers=['t_audit']),
+        ]:
+            self.assertRaises(online.OnlineAlterError, alter(table))
+            self.failUnlessEqual(table.log, [])
+
+        for clauses in [
+            'ADD CONSTRAINT `fk` FOREIGN KEY (`a`) REFERENCES `u` (`id`)',
+            'CHANGE COLUMN `a` `b` INT',
+            'change `a` `b` INT',
+            'RENAME COLUMN `a` TO `b`',
+        ]:
+            table = FakeTable()
+            self.assertRaises(online.OnlineAlterError, alter(table, clauses))
+            self.failUnlessEqual(table.log, [])
+        # Leftovers of an interrupted online alter don't count
+        table = FakeTable(triggers=['t_online_ins'])
+        alter(table)()
+        self.failUnless(table.log)
+
+    def test_long_table_names(self):
+        name = 'x' * 64
+        alter = online.OnlineAlter(name, 'ADD COLUMN `c` INT')
+        for helper in [alter.shadow, alter.old] + alter.triggers:
+            self.failUnlessEqual(len(helper), 64)
+        self.failUnless(alter.shadow.endswith('_new'))
+        self.failIfEqual(alter.shadow,
+            online.OnlineAlter('x' * 63 + 'y', 'ADD COLUMN `c` INT').shadow)
+        self.failUnlessEqual('_t_new', online.OnlineAlter('t', '').shadow)
+
+    def test_online_migrations(self):
+        mig = m.AddColumn('quiz', 'answer', 'text', 'VARCHAR(50)', online=True)
+        self.failUnless(mig.online)
+        self.failIf(m.CoalescedAlterTable.can_coalesce(mig))
+        self.failIf(m.AddColumn('quiz', 'answer', 'text', 'INT').online)
+        self.failUnless(m.DropIndex('quiz', 'answer', 'text', online=True).online)
+
 class TestAddDropDjangoKey(DualTest):
     def test_plain(self):
         m.AddDjangoKey.fk_name = classmethod(lambda cls, *args: 'yomama_123')
@@ -1,5 +1,16 @@
 from commands import CommandsTest
+from base_migration import BaseMigrationTest
 from migration_db import MigrationDbTest
+from migration_cache import MigrationCacheTest
 from migration_loader import MigrationLoaderTest
+from migration_header import MigrationHeaderTest
 from migration_state import MigrationStateTest
 from migration_log import MigrationLogTest
+from migration_journal import MigrationJournalTest
+from migration_lock import MigrationLockTest
+from ddl_guard import DDLGuardTest
+from progress_monitor import ProgressMonitorTest
+from state_file import StateFileTest
+from scheduler import SchedulerTest
+from soft_worker import SoftWorkerTest
+from sql_statements import SqlStatementsTest
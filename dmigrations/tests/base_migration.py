@@ -0,0 +1,80 @@
+from dmigrations.tests.common import *
+from dmigrations.migrations import BaseMigration, statement_batches
+
+class FakeCursor(object):
+  def __init__(self, fail_at=None):
+    self.executed = []
+    self.fail_at = fail_at
+    self.position = 0
+  
+  def execute(self, sql):
+    self.executed.append(sql)
+    self.position = 0
+    self.check()
+  
+  def nextset(self):
+    self.position += 1
+    self.check()
+    return 1
+  
+  def check(self):
+    if self.position == self.fail_at:
+      raise Exception("Failed statement %d" % self.position)
+
+class BaseMigrationTest(TestCase):
+  def test_statement_batches(self):
+    statements = ['a' * 10, 'b' * 10, 'c' * 30, 'd' * 5, 'e' * 100, 'f']
+    self.assert_equal(
+      [['a' * 10, 'b' * 10], ['c' * 30], ['d' * 5], ['e' * 100], ['f']],
+      list(statement_batches(statements, 30))
+    )
+    self.assert_equal([], list(statement_batches([], 30)))
+    self.assert_equal([statements], list(statement_batches(statements, 1000)))
+  
+  def test_execute_batch(self):
+    migration = BaseMigration()
+    
+    cursor = FakeCursor()
+    migration.execute_batch(cursor, ["SELECT 1;", "SELECT '10%' -- comment", " SELECT 3 "])
+    self.assert_equal(["SELECT 1\n;\nSELECT '10%%' -- comment\n;\nSELECT 3"], cursor.executed)
+    
+    cursor = FakeCursor()
+    migration.execute_batch(cursor, ["SELECT '10%';"])
+    self.assert_equal(["SELECT '10%%';"], cursor.executed)
+  
+  def test_execute_batch_failure(self):
+    migration = BaseMigration()
+    for fail_at in [0, 1, 2]:
+      cursor = FakeCursor(fail_at)
+      self.assert_raises(Exception, lambda:
+        migration.execute_batch(cursor, ["SELECT 1", "SELECT 2", "SELECT 3"])
+      )
+      self.assert_equal(fail_at, cursor.position)
+  
+  def test_execute_batch_progress(self):
+    migration = BaseMigration()
+    progress = []
+    migration.execute_batch(FakeCursor(), ["SELECT 1", "SELECT 2"], progress.append)
+    self.assert_equal([2], progress)
+    
+    progress = []
+    self.assert_raises(Exception, lambda:
+      migration.execute_batch(FakeCursor(2), ["SELECT 1", "SELECT 2", "SELECT 3"], progress.append)
+    )
+    self.assert_equal([2], progress)
+    
+    progress = []
+    self.assert_raises(Exception, lambda:
+      migration.execute_batch(FakeCursor(0), ["SELECT 1", "SELECT 2"], progress.append)
+    )
+    self.assert_equal([], progress)
+  
+  def test_opt_out(self):
+    class UnbatchedMigration(BaseMigration):
+      batch_statements = False
+    self.assert_equal(0, UnbatchedMigration().batch_size())
+  
+  def test_batching_is_opt_in(self):
+    from django.conf import settings
+    self.assert_equal(False, hasattr(settings, 'DMIGRATIONS_BATCH_SIZE'))
+    self.assert_equal(0, BaseMigration().batch_size())
@@ -0,0 +1,155 @@
+from dmigrations.tests.common import *
+from dmigrations.ddl_guard import DDLGuard, is_ddl, ddl_tables
+from dmigrations.migrations import statement_batches
+
+class GuardedCursor(object):
+  """
+  Cursor of a connection with lock_wait_timeout 50, where the guarded
+  statement times out fail times. transactions is list of results of
+  long transaction checks, the last one repeats. mdl tells if metadata
+  locks are instrumented, None if performance_schema can't be read.
+  """
+  def __init__(self, fail=0, transactions=[[]], mdl=None):
+    self.executed = []
+    self.params = []
+    self.fail = fail
+    self.transactions = list(transactions)
+    self.mdl = mdl
+    self.result = None
+
+  def execute(self, sql, params=None):
+    self.executed.append(' '.join(sql.split())[:40])
+    self.params.append(params)
+    if sql == "SELECT @@SESSION.lock_wait_timeout":
+      self.result = [(50,)]
+    elif 'setup_instruments' in sql:
+      if self.mdl is None:
+        raise Exception(1142, 'SELECT command denied')
+      self.result = [(self.mdl,)]
+    elif 'INNODB_TRX' in sql:
+      if len(self.transactions) > 1:
+        self.result = self.transactions.pop(0)
+      else:
+        self.result = self.transactions[0]
+    else:
+      self.result = []
+
+  def fetchone(self):
+    return self.result[0]
+
+  def fetchall(self):
+    return self.result
+
+  def ddl(self):
+    self.execute("ALTER TABLE t ADD COLUMN c INT")
+    if self.fail:
+      self.fail -= 1
+      raise Exception(1205, 'Lock wait timeout exceeded')
+
+class Clock(object):
+  def __init__(self):
+    self.time = 0
+    self.sleeps = []
+
+  def now(self):
+    return self.time
+
+  def sleep(self, seconds):
+    self.sleeps.append(seconds)
+    self.time += seconds
+
+class DDLGuardTest(TestCase):
+  def guard(self, **kwargs):
+    self.clock = Clock()
+    return DDLGuard(sleep=self.clock.sleep, now=self.clock.now, **kwargs)
+
+  def test_is_ddl(self):
+    for statement in ["ALTER TABLE t DROP c", " create index i on t (c)",
+                      "DROP TABLE t", "RENAME TABLE a TO b", "TRUNCATE t"]:
+      self.assert_equal(True, is_ddl(statement))
+    for statement in ["SELECT 1", "INSERT INTO t VALUES (1)", "UPDATE drop SET a = 1"]:
+      self.assert_equal(False, is_ddl(statement))
+
+  def test_ddl_tables(self):
+    self.assert_equal(['t'], ddl_tables("ALTER TABLE `db`.`t` ADD COLUMN c INT"))
+    self.assert_equal(['t'], ddl_tables("create unique index i on t (c)"))
+    self.assert_equal(['a', 'b'], ddl_tables("DROP TABLE IF EXISTS a, `b`"))
+    self.assert_equal(['t', '_t_old', '_t_new', 't'],
+      ddl_tables("RENAME TABLE `t` TO `_t_old`, `_t_new` TO `t`"))
+    self.assert_equal(None, ddl_tables("DROP TRIGGER IF EXISTS t_online_ins"))
+
+  def long_transaction_checks(self, cursor):
+    return [
+      params for (sql, params) in zip(cursor.executed, cursor.params)
+      if sql.startswith("SELECT t.trx_mysql_thread_id")
+    ]
+
+  def test_only_transactions_locking_tables_count(self):
+    cursor = GuardedCursor(mdl='YES')
+    self.guard().run(cursor, cursor.ddl, ['t'])
+    self.assert_equal([['t']], self.long_transaction_checks(cursor))
+    # Without metadata locks in performance_schema, every one counts
+    for mdl in ['NO', None]:
+      cursor = GuardedCursor(mdl=mdl)
+      self.guard().run(cursor, cursor.ddl, ['t'])
+      self.assert_equal([None], self.long_transaction_checks(cursor))
+
+  def test_ddl_gets_batch_of_its_own(self):
+    statements = ["INSERT 1", "INSERT 2", "ALTER TABLE t", "INSERT 3"]
+    self.assert_equal(
+      [["INSERT 1", "INSERT 2"], ["ALTER TABLE t"], ["INSERT 3"]],
+      list(statement_batches(statements, 1000))
+    )
+
+  def test_retry(self):
+    cursor = GuardedCursor(fail=2)
+    self.guard(lock_wait_timeout=3).run(cursor, cursor.ddl)
+    self.assert_equal([
+      "SELECT @@SESSION.lock_wait_timeout",
+      "SET SESSION lock_wait_timeout = 3",
+      "SELECT t.trx_mysql_thread_id, TIMESTAMPD",
+      "ALTER TABLE t ADD COLUMN c INT",
+      "SELECT t.trx_mysql_thread_id, TIMESTAMPD",
+      "ALTER TABLE t ADD COLUMN c INT",
+      "SELECT t.trx_mysql_thread_id, TIMESTAMPD",
+      "ALTER TABLE t ADD COLUMN c INT",
+      "SET SESSION lock_wait_timeout = 50",
+    ], cursor.executed)
+    self.assert_equal(2, len(self.clock.sleeps))
+    for delay in self.clock.sleeps:
+      self.assert_(1 <= delay <= 30)
+
+  def test_deadline(self):
+    cursor = GuardedCursor(fail=1000)
+    self.assert_raises(DDLLockTimeoutError, lambda:
+      self.guard(deadline=60).run(cursor, cursor.ddl)
+    )
+    self.assert_(self.clock.time <= 60)
+    self.assert_equal("SET SESSION lock_wait_timeout = 50", cursor.executed[-1])
+
+  def test_other_errors_are_not_retried(self):
+    def fail():
+      raise Exception(1054, 'Unknown column')
+    cursor = GuardedCursor()
+    self.assert_raises(Exception, lambda: self.guard().run(cursor, fail))
+    self.assert_equal([], self.clock.sleeps)
+    self.assert_equal("SET SESSION lock_wait_timeout = 50", cursor.executed[-1])
+
+  def test_long_transactions(self):
+    transaction = (12, 300, 'site', 'web1:4242')
+    cursor = GuardedCursor(transactions=[[transaction], [transaction], []])
+    self.guard().run(cursor, cursor.ddl)
+    self.assert_equal(2, len(self.clock.sleeps))
+    self.assert_equal(1, cursor.executed.count("ALTER TABLE t ADD COLUMN c INT"))
+
+    cursor = GuardedCursor(transactions=[[transaction]])
+    self.assert_raises(DDLLockTimeoutError, lambda:
+      self.guard(abort_on_long_transactions=True).run(cursor, cursor.ddl)
+    )
+    self.assert_equal([], self.clock.sleeps)
+    self.assert_equal(0, cursor.executed.count("ALTER TABLE t ADD COLUMN c INT"))
+
+  def test_disabled(self):
+    cursor = GuardedCursor()
+    self.guard(lock_wait_timeout=0).run(cursor, cursor.ddl)
+    self.assert_equal(["ALTER TABLE t ADD COLUMN c INT"], cursor.executed)
@@ -0,0 +1,127 @@
+from dmigrations.tests.common import *
+from dmigrations.migration_cache import MigrationCache, cache_from_settings
+from dmigrations.migration_db import MigrationDb
+import os
+import shutil
+import tempfile
+import time
+
+class MigrationCacheTest(TestCase):
+  def set_up(self):
+    self.migrations_dir = tempfile.mkdtemp()
+    for file_name in os.listdir(self.mock_migrations_dir):
+      if file_name.endswith('.py'):
+        shutil.copy(
+          os.path.join(self.mock_migrations_dir, file_name),
+          self.migrations_dir
+        )
+    self.cache = MigrationCache.for_migrations_dir(self.migrations_dir)
+  
+  def tear_down(self):
+    shutil.rmtree(self.migrations_dir)
+    if os.path.isdir(self.cache.directory):
+      shutil.rmtree(self.cache.directory)
+  
+  def age_directory(self):
+    "Make directory look like it was last changed long ago"
+    os.mkdir(self.cache.directory)
+    os.utime(self.migrations_dir, (0, 0))
+  
+  def test_cache_is_kept_outside_migrations_dir(self):
+    self.assert_equal(os.path.dirname(self.migrations_dir),
+      os.path.dirname(self.cache.directory))
+  
+  def test_code_is_cached(self):
+    path = os.path.join(self.migrations_dir, '001_foo.py')
+    code = self.cache.code_for(path)
+    self.assert_(os.path.exists(
+      os.path.join(self.cache.directory, '001_foo.py.code')
+    ))
+    self.assert_equal(code.co_filename, self.cache.code_for(path).co_filename)
+  
+  def test_changed_source_is_recompiled(self):
+    db = MigrationDb(directory=self.migrations_dir, cache=self.cache)
+    db.warn = WarningsMocker()
+    self.assert_equal("INSERT INTO mock VALUES (1)",
+      db.load_migration_object('001_foo').sql_up)
+    
+    path = os.path.join(self.migrations_dir, '001_foo.py')
+    open(path, 'w').write(
+      "from dmigrations.mysql import migrations as m\n"
+      "migration = m.Migration(sql_up='INSERT INTO mock VALUES (11)')\n"
+    )
+    db = MigrationDb(directory=self.migrations_dir, cache=self.cache)
+    db.warn = WarningsMocker()
+    self.assert_equal("INSERT INTO mock VALUES (11)",
+      db.load_migration_object('001_foo').sql_up)
+  
+  def test_same_second_edit_is_recompiled(self):
+    path = os.path.join(self.migrations_dir, '001_foo.py')
+    source = open(path).read()
+    now = int(time.time())
+    os.utime(path, (now, now))
+    self.cache.code_for(path)
+    # Same size and mtime, as if edited within the same second
+    open(path, 'w').write(source.replace('(1)', '(2)'))
+    os.utime(path, (now, now))
+    namespace = {}
+    exec self.cache.code_for(path) in namespace
+    self.assert_equal("INSERT INTO mock VALUES (2)",
+      namespace['migration'].sql_up)
+  
+  def test_manifest_is_used_until_directory_changes(self):
+    self.age_directory()
+    db = MigrationDb(directory=self.migrations_dir, cache=self.cache)
+    db.warn = WarningsMocker()
+    expected = db.list()
+    self.assert_equal(db.index.to_manifest(),
+      self.cache.load_manifest(self.migrations_dir))
+    
+    db = MigrationDb(directory=self.migrations_dir, cache=self.cache)
+    db.warn = WarningsMocker()
+    self.assert_equal(expected, db.list())
+    self.assert_equal(1, len(db.warn.warnings))
+    
+    open(os.path.join(self.migrations_dir, '011_new.py'), 'w').write(
+      "from dmigrations.mysql import migrations as m\n"
+      "migration = m.Migration(sql_up='')\n"
+    )
+    self.assert_equal(None, self.cache.load_manifest(self.migrations_dir))
+    db = MigrationDb(directory=self.migrations_dir, cache=self.cache)
+    db.warn = WarningsMocker()
+    self.assert_equal(expected + ['011_new'], db.list())
+  
+  def test_soft_flags_are_kept_in_manifest(self):
+    open(os.path.join(self.migrations_dir, '011_soft_by_header.py'), 'w').write(
+      "# dmigrations: soft = yes\n"
+      "from dmigrations.mysql import migrations as m\n"
+      "migration = m.Migration(sql_up='')\n"
+    )
+    self.age_directory()
+    db = MigrationDb(directory=self.migrations_dir, cache=self.cache)
+    db.warn = WarningsMocker()
+    self.assert_equal(True, db.is_soft_migration('011_soft_by_header'))
+    
+    db = MigrationDb(directory=self.migrations_dir, cache=self.cache)
+    db.warn = WarningsMocker()
+    def fail(name):
+      raise AssertionError("Header of %s read" % name)
+    db.migration_header = fail
+    self.assert_equal(True, db.is_soft_migration('011_soft_by_header'))
+    self.assert_equal(False, db.is_soft_migration('001_foo'))
+  
+  def test_cache_from_settings(self):
+    from django.conf import settings
+    old_setting = getattr(settings, 'DMIGRATIONS_CACHE_DIR', self)
+    try:
+      if old_setting is not self:
+        del settings.DMIGRATIONS_CACHE_DIR
+      self.assert_equal(self.cache.directory,
+        cache_from_settings(self.migrations_dir).directory)
+      settings.DMIGRATIONS_CACHE_DIR = None
+      self.assert_equal(None, cache_from_settings(self.migrations_dir))
+    finally:
+      if old_setting is self:
+        del settings.DMIGRATIONS_CACHE_DIR
+      else:
+        settings.DMIGRATIONS_CACHE_DIR = old_setting
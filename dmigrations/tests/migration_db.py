@@ -68,6 +68,13 @@ class MigrationDbTest(TestCase):
       ], db.list()
     )
 
+  def test_sql_migrations(self):
+    db = MigrationDb()
+    db.warn = WarningsMocker()
+    db.populate_migrations_from_ls(["1_foo.py", "2_seed.up.sql", "2_seed.down.sql", "3_bar.py", "3_bar.up.sql", "4_lonely.down.sql", "5_x.sql"])
+    self.assert_equal(["1_foo", "2_seed", "3_bar"], db.list())
+    self.assert_equal([u'Migration 3_bar has both .py and .up.sql files, using .py'], db.warn.warnings)
+
   def test_dup_warnings(self):
     db = MigrationDb()
     db.warn = WarningsMocker()
@@ -157,3 +164,54 @@ class MigrationDbTest(TestCase):
     db.warn = WarningsMocker()
     
     self.assert_equal(self.mock_migrations_dir + '/010_foo.py', db.migration_path('foo'))
+
+  def test_index(self):
+    db = MigrationDb(migrations = [
+      "8_blah_one",
+      "010_SOFT_gah",
+      "1_foo",
+      "8_DEV_blah",
+    ])
+    index = db.index
+    self.assert_equal(("1_foo", "8_DEV_blah", "8_blah_one", "010_SOFT_gah"), index.names)
+    self.assert_equal((1, 8, 8, 10), index.numbers)
+    self.assert_equal(("8_DEV_blah", "8_blah_one"), index.with_number(8))
+    self.assert_equal((), index.with_number(9))
+    self.assert_equal(0, index.count_upto(0))
+    self.assert_equal(3, index.count_upto(8))
+    self.assert_equal(3, index.count_upto(9))
+    self.assert_equal(4, index.count_upto(10))
+    self.assert_equal(True, db.is_dev_migration("8_DEV_blah"))
+    self.assert_equal(True, db.is_soft_migration("010_SOFT_gah"))
+    self.assert_equal(False, db.is_soft_migration("1_foo"))
+    self.assert_equal(8, db.migration_number("8_blah_one"))
+
+    # Index is rebuilt when migrations are repopulated
+    db.populate_migrations_from_ls(["2_bar.py"])
+    self.assert_equal(("2_bar",), db.index.names)
+
+  def test_load_migration_object_uses_registry(self):
+    db = MigrationDb(directory=self.mock_migrations_dir)
+    db.warn = WarningsMocker()
+
+    migration = db.load_migration_object('001_foo')
+    self.assert_equal(True, migration is db.load_migration_object('1'))
+    self.assert_equal(True, '001_foo' in db.registry)
+
+  def test_registry_evicts_least_recently_used(self):
+    from dmigrations.migration_db import MigrationRegistry
+    registry = MigrationRegistry(max_size=10)
+
+    registry.add('1_foo', 'foo', 4)
+    registry.add('2_bar', 'bar', 4)
+    self.assert_equal('foo', registry.get('1_foo'))
+    registry.add('3_baz', 'baz', 4)
+
+    self.assert_equal(None, registry.get('2_bar'))
+    self.assert_equal('foo', registry.get('1_foo'))
+    self.assert_equal('baz', registry.get('3_baz'))
+    self.assert_equal(8, registry.size)
+
+    registry.add('4_huge', 'huge', 11)
+    self.assert_equal(None, registry.get('4_huge'))
+    self.assert_equal(8, registry.size)
@@ -0,0 +1,42 @@
+from dmigrations.tests.common import *
+from dmigrations.migration_header import *
+import os.path
+
+test_migrations_dir = os.path.join(
+  os.path.realpath(os.path.dirname(__file__)), 'test_migrations'
+)
+
+class MigrationHeaderTest(TestCase):
+  def test_header_is_read_without_importing(self):
+    "Header fields are parsed from the leading comment block only"
+    path = os.path.join(test_migrations_dir, 'valid_migration_with_header.py')
+    self.assert_equal(
+      MigrationHeader(
+        tables=('blog_entry', 'blog_category'),
+        soft=True, cost=600, reversible=False,
+      ),
+      read_migration_header(path)
+    )
+  
+  def test_missing_header_is_empty(self):
+    path = os.path.join(test_migrations_dir, 'valid_migration.py')
+    header = read_migration_header(path)
+    self.assert_(header.is_empty())
+    self.assert_equal("", header.summary())
+  
+  def test_summary(self):
+    header = MigrationHeader(tables=('blog_entry',), soft=True, reversible=False)
+    self.assert_equal("tables: blog_entry; soft; irreversible", header.summary())
+  
+  def test_bad_headers(self):
+    "Unknown fields and bad values are errors"
+    for lines in [
+      ["# dmigrations: colour = blue"],
+      ["# dmigrations: cost = a lot"],
+      ["# dmigrations: soft = maybe"],
+    ]:
+      self.assertRaises(BadMigrationError, parse_migration_header, lines)
+  
+  def test_sql_comments(self):
+    header = parse_migration_header(["-- dmigrations: tables = a", "", "-- dmigrations: soft = no"])
+    self.assert_equal(MigrationHeader(tables=('a',), soft=False), header)
@@ -0,0 +1,40 @@
+from dmigrations.tests.common import *
+from dmigrations.migration_journal import StepJournal, init
+
+class MigrationJournalTest(TestCase):
+  def set_up(self):
+    from django.db import connection
+    self.cursor = connection.cursor()
+    try: self.cursor.execute("DROP TABLE dmigrations_journal")
+    except: pass
+    init()
+  
+  def test_record_and_load(self):
+    journal = StepJournal.load('001_foo', 'up')
+    self.assert_equal(0, journal.steps_done)
+    journal.record(3)
+    journal.record(5)
+    self.assert_equal(5, StepJournal.load('001_foo', 'up').steps_done)
+    self.assert_equal(0, StepJournal.load('001_foo', 'down').steps_done)
+    self.assert_equal(0, StepJournal.load('001_fooo', 'up').steps_done)
+  
+  def test_children_are_cleared_with_parent(self):
+    journal = StepJournal.load('001_foo', 'up')
+    journal.child(2).record(4)
+    StepJournal.load('001xfoo/1', 'up').record(1)
+    self.assert_equal(4, journal.child(2).steps_done)
+    self.assert_equal(True, StepJournal.interrupted('001_foo'))
+    
+    journal.clear()
+    self.assert_equal(False, StepJournal.interrupted('001_foo'))
+    self.assert_equal(0, journal.child(2).steps_done)
+    # _ is a LIKE wildcard, but 001xfoo isn't 001_foo
+    self.assert_equal(True, StepJournal.interrupted('001xfoo'))
+  
+  def test_start(self):
+    StepJournal.load('001_foo', 'up').record(2)
+    StepJournal.load('002_bar', 'down').child(1).record(1)
+    self.assert_equal(2, StepJournal.start('001_foo', 'up').steps_done)
+    self.assert_equal(set(['001_foo', '002_bar']), StepJournal.interrupted_migrations())
+    StepJournal.discard('001_foo')
+    self.assert_equal(False, StepJournal.interrupted('001_foo'))
@@ -36,3 +36,25 @@ class MigrationLoaderTest(TestCase):
         migration = load_migration_from_path(path)
         self.assert_equal(migration.filepath, path)
         self.assert_equal(migration.name, 'valid_migration')
+    
+    def test_sql_migration(self):
+        "SQL migrations run statements of their .up.sql and .down.sql files"
+        path = os.path.join(test_migrations_dir, 'valid_sql_migration.up.sql')
+        migration = load_migration_from_path(path)
+        self.assert_(isinstance(migration, SqlFileMigration))
+        self.assert_equal(migration.name, 'valid_sql_migration')
+        self.assert_equal(migration.down_path,
+            os.path.join(test_migrations_dir, 'valid_sql_migration.down.sql'))
+        
+        executed = []
+        migration.run_statements = \
+            lambda statements, return_rows: executed.extend(statements)
+        migration.up()
+        self.assert_equal([
+            "CREATE TABLE `seed` (`name` VARCHAR(50))",
+            "INSERT INTO `seed` VALUES ('a;b'), ('c')",
+        ], executed)
+        
+        executed[:] = []
+        migration.down()
+        self.assert_equal(["DROP TABLE `seed`"], executed)
@@ -0,0 +1,61 @@
+from dmigrations.tests.common import *
+from dmigrations.migration_lock import acquire_lock, release_lock, \
+  acquire_soft_lock
+import threading
+
+class MigrationLockTest(TestCase):
+  def lock_taken_elsewhere(self, soft=False):
+    """
+    Return True if the lock (or with soft, the soft lock) can't be taken
+    from another connection.
+    """
+    result = []
+    def run():
+      from django.db import connection
+      try:
+        try:
+          if soft:
+            acquire_soft_lock(timeout=0).release()
+          else:
+            acquire_lock(timeout=0)
+            release_lock()
+          result.append(False)
+        except LockTimeoutError:
+          result.append(True)
+      finally:
+        connection.close()
+    thread = threading.Thread(target=run)
+    thread.start()
+    thread.join()
+    return result[0]
+  
+  def test_lock(self):
+    self.assert_equal(False, self.lock_taken_elsewhere())
+    acquire_lock(timeout=0)
+    try:
+      self.assert_equal(True, self.lock_taken_elsewhere())
+    finally:
+      release_lock()
+    self.assert_equal(False, self.lock_taken_elsewhere())
+  
+  def test_soft_lock_leaves_migration_lock_free(self):
+    soft_lock = acquire_soft_lock(timeout=0)
+    try:
+      self.assert_equal(False, self.lock_taken_elsewhere())
+    finally:
+      soft_lock.release()
+    self.assert_equal(False, self.lock_taken_elsewhere(soft=True))
+  
+  def test_soft_lock_is_kept_while_planning(self):
+    # Before MySQL 5.7.5, taking a lock released the one held before
+    soft_lock = acquire_soft_lock(timeout=0)
+    try:
+      acquire_lock(timeout=0)
+      try:
+        self.assert_equal(True, self.lock_taken_elsewhere(soft=True))
+        self.assert_equal(True, self.lock_taken_elsewhere())
+      finally:
+        release_lock()
+      self.assert_equal(True, self.lock_taken_elsewhere(soft=True))
+    finally:
+      soft_lock.release()
@@ -1,7 +1,8 @@
 from dmigrations.tests.common import *
 from dmigrations.migration_state import MigrationState
 from dmigrations.migration_db import MigrationDb
-from dmigrations.migration_log import get_log
+from dmigrations.migration_log import get_log, iter_log, log_actions, archive_log, init, MIGRATION_LOG_VERSION
+from dmigrations.migration_state import table_version
 from datetime import datetime, date, time
 
 class MigrationLogTest(TestCase):
@@ -42,3 +43,57 @@ class MigrationLogTest(TestCase):
       ], [row[:3] for row in get_log()]
     )
     self.assert_equal(True, isinstance(get_log()[0][3], datetime))
+
+  def reset_log(self):
+    for table in ["dmigrations_log", "dmigrations_log_archive"]:
+      try: self.cursor.execute("DROP TABLE %s" % table)
+      except: pass
+    init()
+
+  def test_iter_log(self):
+    self.reset_log()
+    day = lambda d: datetime(2010, 1, d)
+    log_actions([("apply", "001_foo", "success"), ("apply", "002_bar", "failed")], day(1))
+    log_actions([("apply", "002_bar", "success")], day(2))
+    log_actions([("unapply", "001_foo", "success")], day(3))
+
+    entries = [
+      ("apply", "001_foo", "success", day(1)),
+      ("apply", "002_bar", "failed", day(1)),
+      ("apply", "002_bar", "success", day(2)),
+      ("unapply", "001_foo", "success", day(3)),
+    ]
+    for chunk_size in [1, 2, 3, 1000]:
+      self.assert_equal(entries, list(iter_log(chunk_size=chunk_size)))
+    self.assert_equal(entries[1:3], list(iter_log(migration="002_bar", chunk_size=1)))
+    self.assert_equal(entries[2:3], list(iter_log(since=day(2), until=day(3))))
+    self.assert_equal(entries[1:2], list(iter_log(status="failed")))
+
+  def test_archive_log(self):
+    self.reset_log()
+    log_actions([("apply", "001_foo", "success")] * 5, datetime(2010, 1, 1))
+    log_actions([("apply", "002_bar", "success")], datetime(2011, 1, 1))
+
+    self.assert_equal(5, archive_log(datetime(2011, 1, 1), chunk_size=2))
+    self.assert_equal([("apply", "002_bar", "success", datetime(2011, 1, 1))], get_log())
+    self.cursor.execute("SELECT COUNT(*) FROM dmigrations_log_archive")
+    self.assert_equal(5, self.cursor.fetchone()[0])
+    self.assert_equal(0, archive_log(datetime(2011, 1, 1)))
+
+  def test_init_upgrades_old_log_table(self):
+    try: self.cursor.execute("DROP TABLE dmigrations_log")
+    except: pass
+    self.cursor.execute("""
+      CREATE TABLE `dmigrations_log` (
+      `id` int(11) NOT NULL auto_increment,
+      `action` VARCHAR(255) NOT NULL,
+      `migration` VARCHAR(255) NOT NULL,
+      `status` VARCHAR(255) NOT NULL,
+      `datetime` DATETIME NOT NULL,
+       PRIMARY KEY  (`id`)
+      ) ENGINE=InnoDB DEFAULT CHARSET=utf8
+    """)
+    log_actions([("apply", "001_foo", "success")])
+    init()
+    self.assert_equal(MIGRATION_LOG_VERSION, table_version('dmigrations_log', 'dmigrations_log schema'))
+    self.assert_equal(1, len(get_log()))
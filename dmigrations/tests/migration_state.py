@@ -47,12 +47,47 @@ class MigrationStateTest(TestCase):
 
     self.assert_equal(True, si.migration_table_present())
 
+  def test_init_on_fresh_db_creates_current_table_version(self):
+    from dmigrations.migration_state import MIGRATION_TABLE_VERSION
+    si = MigrationState()
+    si.init()
+
+    self.assert_equal(MIGRATION_TABLE_VERSION, si.migration_table_version())
+
+  def test_init_upgrades_old_table_in_place(self):
+    from dmigrations.migration_state import MIGRATION_TABLE_VERSION
+    self.cursor.execute(create_new)
+    self.cursor.execute("INSERT INTO dmigrations (migration) VALUES ('001_foo')")
+    self.cursor.execute("INSERT INTO dmigrations (migration) VALUES ('001_foo')")
+    self.cursor.execute("INSERT INTO dmigrations (migration) VALUES ('002_bar')")
+
+    si = MigrationState()
+    self.assert_equal(1, si.migration_table_version())
+
+    si.init()
+
+    self.assert_equal(MIGRATION_TABLE_VERSION, si.migration_table_version())
+    self.cursor.execute("SELECT migration, applied_at, duration_ms, content_hash FROM dmigrations ORDER BY id")
+    self.assert_equal([('001_foo', None, None, None), ('002_bar', None, None, None)], list(self.cursor.fetchall()))
+
+    # Running init again on an upgraded table does nothing
+    si.init()
+    self.assert_equal(MIGRATION_TABLE_VERSION, si.migration_table_version())
+
+  def test_mark_as_applied_records_metadata(self):
+    si = MigrationState()
+    si.init()
+
+    si.mark_as_applied('001_foo', log=False, duration_ms=1500, content_hash='a' * 40)
+    self.cursor.execute("SELECT duration_ms, content_hash, applied_at IS NOT NULL FROM dmigrations WHERE migration = '001_foo'")
+    self.assert_equal((1500, 'a' * 40, 1), self.cursor.fetchone())
+
   def test_applying_and_unapplying(self):
     def assert_applied(f, b, h):
       self.assert_equal([f, b, h], [si.is_applied('001_foo'), si.is_applied('002_bar'), si.is_applied('005_hello')])
   
     si = MigrationState()
-    self.cursor.execute(create_new)
+    si.init()
     
     assert_applied(False, False, False)
     
@@ -297,3 +332,227 @@ class MigrationStateTest(TestCase):
     si.mark_as_applied('009_bogus')
 
     self.assert_equal(['001_foo', '005_omg', '009_bogus'], si.all_migrations_applied())
+
+  def test_snapshot_is_kept_up_to_date(self):
+    db = MigrationDb(migrations = ['001_foo', '002_bar', '005_omg'])
+    si = MigrationState(migration_db=db)
+    si.init()
+
+    si.mark_as_applied('001_foo')
+    snapshot = si.snapshot
+    self.assert_equal(set(['001_foo']), snapshot.applied)
+
+    si.mark_as_applied('005_omg')
+    si.mark_as_unapplied('001_foo')
+    self.assert_equal(True, snapshot is si.snapshot)
+    self.assert_equal(set(['005_omg']), snapshot.applied)
+    self.assert_equal([('002_bar', 'up')], si.plan('all'))
+
+    # Writes made behind the state's back are only seen after invalidation
+    self.cursor.execute("INSERT INTO dmigrations (migration) VALUES ('002_bar')")
+    self.assert_equal([('002_bar', 'up')], si.plan('all'))
+    si.invalidate_snapshot()
+    self.assert_equal([], si.plan('all'))
+
+  def test_bulk_marking(self):
+    from dmigrations.migration_log import get_log
+    db = MigrationDb(migrations = ['001_foo', '002_bar', '005_omg', '006_DEV_hello'])
+    si = MigrationState(migration_db=db)
+    si.init()
+    log_length = len(get_log())
+
+    si.mark_as_applied('002_bar')
+    si.mark_many_as_applied(si.list_upto('5') + ['002_bar'])
+    self.assert_equal(['001_foo', '002_bar', '005_omg'], si.all_migrations_applied())
+    self.assert_equal([], si.plan('all'))
+
+    si.mark_many_as_unapplied(['001_foo', '005_omg', '006_DEV_hello'])
+    self.assert_equal(['002_bar'], si.all_migrations_applied())
+    self.assert_equal(False, si.is_applied('005_omg'))
+
+    self.assert_equal(
+      [
+        ('mark_as_applied', '002_bar', 'success'),
+        ('mark_as_applied', '001_foo', 'success'),
+        ('mark_as_applied', '002_bar', 'success'),
+        ('mark_as_applied', '005_omg', 'success'),
+        ('mark_as_unapplied', '001_foo', 'success'),
+        ('mark_as_unapplied', '005_omg', 'success'),
+        ('mark_as_unapplied', '006_DEV_hello', 'success'),
+      ], [row[:3] for row in get_log()[log_length:]]
+    )
+
+  def test_list_upto(self):
+    db = MigrationDb(migrations = ['001_foo', '002_DEV_bar', '005_omg', '006_DEV_hello'])
+    si = MigrationState(migration_db=db)
+    self.assert_equal(['001_foo', '005_omg'], si.list_upto('6'))
+    self.assert_equal(['001_foo'], si.list_upto('001_foo'))
+    self.assert_raises(NoSuchMigrationError, lambda: si.list_upto('002_DEV_bar'))
+
+    si = MigrationState(migration_db=db, dev=True)
+    self.assert_equal(['001_foo', '002_DEV_bar'], si.list_upto('002_DEV_bar'))
+
+  def test_export_and_import_state(self):
+    db = MigrationDb(migrations = ['001_foo', '002_bar', '005_omg'])
+    si = MigrationState(migration_db=db)
+    si.init()
+    si.mark_many_as_applied(['001_foo', '005_omg'])
+    state = si.export_state()
+    self.assert_equal(['001_foo', '005_omg'], state.applied_names())
+
+    si.mark_many_as_unapplied(['001_foo', '005_omg'])
+    si.mark_as_applied('002_bar')
+    si.import_state(state)
+    self.assert_equal(['001_foo', '002_bar', '005_omg'], si.all_migrations_applied())
+
+    si.import_state(state, replace=True)
+    self.assert_equal(['001_foo', '005_omg'], si.all_migrations_applied())
+
+    state.applied.append(('009_bogus', None, None, None))
+    self.assert_raises(InconsistentStateError, lambda: si.import_state(state))
+    si.import_state(state, force=True)
+    self.assert_equal(['001_foo', '005_omg', '009_bogus'], si.all_migrations_applied())
+
+  def test_is_up_to_date(self):
+    db = MigrationDb(migrations = ['001_foo', '002_bar', '003_DEV_baz'])
+    si = MigrationState(migration_db=db)
+    si.init()
+    self.assert_equal(False, si.is_up_to_date())
+    self.assert_equal(None, si.high_water())
+
+    si.mark_many_as_applied(['001_foo', '002_bar'])
+    self.assert_equal(None, si.high_water())
+    self.assert_equal(True, si.is_up_to_date())
+    # Checking doesn't record high water
+    self.assert_equal(None, si.high_water())
+    si.record_high_water()
+    self.assert_equal(db.index.digest(), si.high_water())
+    self.assert_equal(True, si.is_up_to_date())
+    self.assert_equal(False, MigrationState(migration_db=db, dev=True).is_up_to_date())
+
+    si.mark_as_unapplied('002_bar')
+    self.assert_equal(None, si.high_water())
+    self.assert_equal(False, si.is_up_to_date())
+
+    si.mark_as_applied('002_bar')
+    si.record_high_water()
+    self.assert_equal(db.index.digest(), si.high_water())
+
+    # New migrations change the digest
+    db = MigrationDb(migrations = ['001_foo', '002_bar', '003_DEV_baz', '004_new'])
+    si = MigrationState(migration_db=db)
+    self.assert_equal(False, si.is_up_to_date())
+
+  def test_offline_planning(self):
+    import os, tempfile
+    from dmigrations.state_file import StateFile
+    fd, path = tempfile.mkstemp()
+    output = os.fdopen(fd, 'w')
+    StateFile(applied=[('001_foo', None, None, None), ('009_bogus', None, None, None)]).write(output)
+    output.close()
+
+    db = MigrationDb(migrations = ['001_foo', '002_bar', '005_omg'])
+    si = MigrationState(migration_db=db, state_file=path)
+    try:
+      si.init()
+      self.assert_equal([('002_bar', 'up'), ('005_omg', 'up')], si.plan('all'))
+      self.assert_equal([('001_foo', 'down')], si.plan('to', '0'))
+      self.assert_equal(True, si.is_applied('001_foo'))
+      self.assert_equal(['009_bogus'], si.applied_but_not_in_db())
+      self.assert_raises(MigrationError, lambda: si.mark_as_applied('002_bar'))
+      self.assert_raises(MigrationError, lambda: si.apply('002_bar'))
+    finally:
+      os.remove(path)
+
+  def test_apply_coalesced(self):
+    class FakeMigration(object):
+      def __init__(self, fail=False):
+        self.fail = fail
+        self.ran = 0
+      def up(self):
+        self.ran += 1
+        if self.fail:
+          raise Exception("Failed")
+
+    parts = {'001_foo': FakeMigration(), '002_bar': FakeMigration()}
+    db = MigrationDb(migrations = ['001_foo', '002_bar'])
+    db.load_migration_object = lambda name: parts[name]
+    si = MigrationState(migration_db=db)
+    si.init()
+
+    si.apply_coalesced(['001_foo', '002_bar'], FakeMigration())
+    self.assert_equal([True, True], [si.is_applied('001_foo'), si.is_applied('002_bar')])
+    self.assert_equal([0, 0], [parts['001_foo'].ran, parts['002_bar'].ran])
+
+    si.mark_many_as_unapplied(['001_foo', '002_bar'])
+    si.apply_coalesced(['001_foo', '002_bar'], FakeMigration(fail=True))
+    self.assert_equal([True, True], [si.is_applied('001_foo'), si.is_applied('002_bar')])
+    self.assert_equal([1, 1], [parts['001_foo'].ran, parts['002_bar'].ran])
+
+  def test_atomic_apply(self):
+    from dmigrations.migration_log import get_log
+    from dmigrations.migrations import BaseMigration
+    class AtomicMigration(BaseMigration):
+      atomic = True
+      def __init__(self, fail=False):
+        self.fail = fail
+      def up(self):
+        assert self.in_transaction
+        self.execute_sql(["INSERT INTO dmigrations_atomic_test VALUES (1)"])
+        if self.fail:
+          raise Exception("Failed")
+
+    try: self.cursor.execute("DROP TABLE dmigrations_atomic_test")
+    except: pass
+    self.cursor.execute("CREATE TABLE dmigrations_atomic_test (id int) ENGINE=InnoDB")
+    try:
+      migrations = {'001_foo': AtomicMigration(fail=True), '002_bar': AtomicMigration()}
+      db = MigrationDb(migrations = ['001_foo', '002_bar'])
+      db.load_migration_object = lambda name: migrations[name]
+      si = MigrationState(migration_db=db)
+      si.init()
+      log_length = len(get_log())
+
+      self.assert_raises(Exception, lambda: si.apply('001_foo'))
+      self.assert_equal(False, si.is_applied('001_foo'))
+      self.cursor.execute("SELECT COUNT(*) FROM dmigrations_atomic_test")
+      self.assert_equal(0, self.cursor.fetchone()[0])
+
+      si.apply('002_bar')
+      self.assert_equal(True, si.is_applied('002_bar'))
+      self.assert_equal(False, migrations['002_bar'].in_transaction)
+      self.cursor.execute("SELECT COUNT(*) FROM dmigrations_atomic_test")
+      self.assert_equal(1, self.cursor.fetchone()[0])
+
+      self.assert_equal([
+        ('apply', '001_foo', 'Failed'),
+        ('apply', '002_bar', 'success'),
+      ], [row[:3] for row in get_log()[log_length:]])
+    finally:
+      self.cursor.execute("DROP TABLE dmigrations_atomic_test")
+
+  def test_session_settings(self):
+    from dmigrations.migrations import BaseMigration
+    cursor = self.cursor
+    def sort_buffer_size():
+      cursor.execute("SELECT @@SESSION.sort_buffer_size")
+      return int(cursor.fetchone()[0])
+    seen = []
+    class TunedMigration(BaseMigration):
+      session_settings = {'sort_buffer_size': 1024 * 1024}
+      def __init__(self, fail=False):
+        self.fail = fail
+      def up(self):
+        seen.append(sort_buffer_size())
+        if self.fail:
+          raise Exception("Failed")
+
+    si = MigrationState(migration_db=MigrationDb(migrations = []))
+    before = sort_buffer_size()
+    si.run_migration(TunedMigration(), 'up')
+    self.assert_raises(Exception, lambda: si.run_migration(TunedMigration(fail=True), 'up'))
+    self.assert_equal([1024 * 1024, 1024 * 1024], seen)
+    self.assert_equal(before, sort_buffer_size())
+
+    TunedMigration.session_settings = {'sort_buffer_size; DROP TABLE x': 1}
+    self.assert_raises(MigrationError, lambda: si.run_migration(TunedMigration(), 'up'))
@@ -0,0 +1,55 @@
+from dmigrations.tests.common import *
+from dmigrations.progress_monitor import ProgressMonitor, format_duration
+
+class FakeStages(object):
+  "Returns results of polls in order, the last one repeats"
+  def __init__(self, *results):
+    self.results = list(results)
+    self.params = []
+
+  def __call__(self, sql, params=None):
+    self.params.append(params)
+    if len(self.results) > 1:
+      return self.results.pop(0)
+    return self.results[0]
+
+class ProgressMonitorTest(TestCase):
+  def monitor(self, execute):
+    self.time = [100]
+    self.reports = []
+    return ProgressMonitor(42,
+      callback = lambda *args: self.reports.append(args),
+      interval = 0, execute = execute, now = lambda: self.time[0],
+    )
+
+  def test_poll(self):
+    stage = 'stage/innodb/alter table (read PK and internal sort)'
+    monitor = self.monitor(FakeStages(
+      [],
+      [(stage, 10, 0)],
+      [(stage, 100, 1000)],
+      [(stage, 200, 1000)],
+      [(stage, 1100, 1000)],
+    ))
+    for seconds in [0, 10, 10, 20, 5]:
+      self.time[0] += seconds
+      monitor.poll()
+    self.assert_equal([
+      ('alter table (read PK and internal sort)', 10.0, None),
+      ('alter table (read PK and internal sort)', 20.0, 160.0),
+      ('alter table (read PK and internal sort)', 100.0, 0.0),
+    ], self.reports)
+    self.assert_equal([42], monitor.execute.params[0])
+
+  def test_thread(self):
+    monitor = self.monitor(FakeStages([('stage/sql/altering table', 5, 10)]))
+    monitor.start()
+    monitor.stop()
+    self.assert_equal(False, monitor.isAlive())
+    for report in self.reports:
+      self.assert_equal(('altering table', 50.0, None), report)
+
+  def test_format_duration(self):
+    self.assert_equal('42s', format_duration(42.5))
+    self.assert_equal('3m 05s', format_duration(185))
+    self.assert_equal('2h 01m', format_duration(7290))
@@ -0,0 +1,129 @@
+from dmigrations.tests.common import *
+from dmigrations.migration_db import MigrationDb
+from dmigrations.migration_header import MigrationHeader
+from dmigrations.migrations import BaseMigration
+from dmigrations.scheduler import ParallelScheduler
+import threading
+import time
+
+class MockMigration(BaseMigration):
+  def __init__(self, tables, fail=False, delay=0):
+    self.tables = tables
+    self.fail = fail
+    self.delay = delay
+  
+  def up(self):
+    time.sleep(self.delay)
+    if self.fail:
+      raise Exception("Failed")
+  
+  def touched_tables(self):
+    return self.tables
+
+class MockMigrationDb(MigrationDb):
+  def __init__(self, migrations):
+    super(MockMigrationDb, self).__init__(migrations=sorted(migrations))
+    self.objects = migrations
+  
+  def load_migration_object(self, name):
+    return self.objects[name]
+
+class MockMigrationState(object):
+  def __init__(self, migrations):
+    self.migration_db = MockMigrationDb(migrations)
+    self.recorded = []
+    self.committed = False
+    self.lock = threading.Lock()
+    self.running = 0
+    self.max_running = 0
+  
+  def commit(self):
+    self.committed = True
+  
+  def run_migration(self, migration, direction):
+    if not self.committed:
+      raise Exception("Migration started in the transaction of planning")
+    self.lock.acquire()
+    self.running += 1
+    self.max_running = max(self.running, self.max_running)
+    self.lock.release()
+    try:
+      getattr(migration, direction)()
+    finally:
+      self.lock.acquire()
+      self.running -= 1
+      self.lock.release()
+    return 1
+  
+  def record_result(self, name, direction, duration_ms=None, error=None):
+    self.recorded.append((name, error is None))
+  
+  def apply(self, name):
+    self.recorded.append((name, 'applied'))
+    if self.running:
+      raise Exception("Atomic migration ran together with others")
+
+class SchedulerTest(TestCase):
+  def test_dependencies(self):
+    scheduler = ParallelScheduler(None, 4)
+    self.assert_equal(
+      [set(), set(), set([0]), set([0, 1, 2]), set([3]), set([3, 4])],
+      scheduler.dependencies([['a'], ['b'], ['a', 'c'], None, ['b'], ['b']])
+    )
+  
+  def test_header_tables_are_preferred(self):
+    state = MockMigrationState({'1_foo': MockMigration(None)})
+    state.migration_db.migration_header = lambda name: MigrationHeader(tables=('a',))
+    scheduler = ParallelScheduler(state, 2)
+    self.assert_equal(('a',), scheduler.touched_tables('1_foo', MockMigration(None)))
+  
+  def test_planning_transaction_is_committed(self):
+    # Guarded DDL of migration threads would wait for it otherwise
+    state = MockMigrationState({
+      '1_foo': MockMigration(['a']),
+      '2_bar': MockMigration(['b']),
+    })
+    plan = [(name, 'up') for name in state.migration_db.list()]
+    ParallelScheduler(state, 2, verbosity=0).run(plan)
+    self.assert_equal(True, state.committed)
+    self.assert_equal([('1_foo', True), ('2_bar', True)], state.recorded)
+  
+  def test_run_records_in_plan_order(self):
+    state = MockMigrationState({
+      '1_slow': MockMigration(['a'], delay=0.2),
+      '2_fast': MockMigration(['b'], delay=0.1),
+      '3_fast': MockMigration(['c'], delay=0.1),
+      '4_after_slow': MockMigration(['a']),
+    })
+    plan = [(name, 'up') for name in state.migration_db.list()]
+    ParallelScheduler(state, 3, verbosity=0).run(plan)
+    self.assert_equal([
+      ('1_slow', True), ('2_fast', True), ('3_fast', True), ('4_after_slow', True),
+    ], state.recorded)
+    self.assert_equal(3, state.max_running)
+  
+  def test_atomic_migrations_are_applied_alone(self):
+    atomic = MockMigration(['b'])
+    atomic.atomic = True
+    state = MockMigrationState({
+      '1_slow': MockMigration(['a'], delay=0.1),
+      '2_atomic': atomic,
+      '3_other': MockMigration(['c']),
+    })
+    plan = [(name, 'up') for name in state.migration_db.list()]
+    ParallelScheduler(state, 3, verbosity=0).run(plan)
+    self.assert_equal([
+      ('1_slow', True), ('2_atomic', 'applied'), ('3_other', True),
+    ], state.recorded)
+  
+  def test_failure_stops_new_migrations(self):
+    state = MockMigrationState({
+      '1_fails': MockMigration(['a'], fail=True, delay=0.1),
+      '2_runs': MockMigration(['b']),
+      '3_depends': MockMigration(['a']),
+      '4_unknown': MockMigration(None),
+    })
+    plan = [(name, 'up') for name in state.migration_db.list()]
+    scheduler = ParallelScheduler(state, 2, verbosity=0)
+    self.assertRaises(Exception, scheduler.run, plan)
+    self.assert_equal([('1_fails', False), ('2_runs', True)], state.recorded)
@@ -0,0 +1,56 @@
+from dmigrations.tests.common import *
+from dmigrations.tests.scheduler import MockMigration, MockMigrationDb
+from dmigrations.migration_state import MigrationState
+from dmigrations.soft_worker import SoftMigrationWorker, WorkerStatus
+
+class SoftWorkerTest(TestCase):
+  def set_up(self):
+    from django.db import connection
+    self.cursor = connection.cursor()
+    for table in ["dmigrations", "dmigrations_worker"]:
+      try: self.cursor.execute("DROP TABLE %s" % table)
+      except: pass
+    
+    self.db = MockMigrationDb({
+      '001_foo': MockMigration(['a']),
+      '002_SOFT_bar': MockMigration(['b']),
+      '003_SOFT_baz': MockMigration(['c']),
+      '004_hello': MockMigration(['d']),
+    })
+    self.si = MigrationState(migration_db=self.db)
+    self.si.init()
+  
+  def test_plan(self):
+    self.assert_equal([('002_SOFT_bar', 'up'), ('003_SOFT_baz', 'up')], self.si.plan('all_soft'))
+    self.assert_equal([('001_foo', 'up'), ('004_hello', 'up')], self.si.plan('all_hard'))
+  
+  def test_worker_status(self):
+    status = WorkerStatus()
+    status.init()
+    self.assert_equal(None, status.get())
+    self.assert_equal(False, status.set_paused(True))
+    
+    status.start(123, 'example.com')
+    status.update(total=3, running='001_foo')
+    fields = status.get()
+    self.assert_equal(
+      ('running', 0, 123, 'example.com', '001_foo', 0, 3, None),
+      tuple([fields[k] for k in ['state', 'paused', 'pid', 'host', 'running', 'done', 'total', 'error']])
+    )
+    self.assert_equal(True, status.set_paused(True))
+    self.assert_equal(True, status.is_paused())
+    self.assert_equal(True, status.set_paused(False))
+    self.assert_equal(False, status.is_paused())
+  
+  def test_run(self):
+    worker = SoftMigrationWorker(self.si, jobs=2, lock_timeout=0, verbosity=0)
+    recorded = []
+    self.si.record_state = lambda: recorded.append(self.si.all_migrations_applied())
+    worker.run()
+    self.assert_equal([['002_SOFT_bar', '003_SOFT_baz']], recorded)
+    self.assert_equal(
+      [False, True, True, False],
+      [self.si.is_applied(name) for name in self.db.list()]
+    )
+    fields = worker.status.get()
+    self.assert_equal(('finished', 2, 2, None), (fields['state'], fields['done'], fields['total'], fields['running']))
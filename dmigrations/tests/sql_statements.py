@@ -0,0 +1,51 @@
+from dmigrations.tests.common import *
+from dmigrations.sql_statements import iter_statements
+from StringIO import StringIO
+
+class SqlStatementsTest(TestCase):
+  def assert_statements(self, expected, sql):
+    self.assert_equal(expected, list(iter_statements(sql)))
+    # Tiny chunks, so every token gets split between reads
+    self.assert_equal(expected, list(iter_statements(StringIO(sql), chunk_size=1)))
+  
+  def test_plain(self):
+    self.assert_statements(['SELECT 1', 'SELECT 2'], "SELECT 1;\nSELECT 2;\n")
+    self.assert_statements(['SELECT 1', 'SELECT 2'], "SELECT 1; SELECT 2")
+    self.assert_statements(['SELECT\n  1'], "\n\nSELECT\n  1  ;  \n\n;")
+    self.assert_statements([], "")
+    self.assert_statements([], " ;\n ;")
+  
+  def test_quotes(self):
+    self.assert_statements(
+      ["INSERT INTO t VALUES ('a;b', \"c;\nd\", 'it''s;', 'x\\';y')", "SELECT `we;ird`"],
+      "INSERT INTO t VALUES ('a;b', \"c;\nd\", 'it''s;', 'x\\';y');\nSELECT `we;ird`;"
+    )
+    self.assert_statements(["SELECT '\\\\'", "SELECT 2"], "SELECT '\\\\'; SELECT 2")
+    self.assert_statements(["SELECT '-- not a comment; # nor this'"], "SELECT '-- not a comment; # nor this';")
+  
+  def test_comments(self):
+    self.assert_statements(
+      ['SELECT 1', 'SELECT   2', 'SELECT 3', 'SELECT 4'],
+      "-- Leading comment; with semicolon\n"
+      "SELECT 1; # another; comment\n"
+      "SELECT /* inline; */ 2;\n"
+      "/* multi\n line; comment */\n"
+      "SELECT 3 -- trailing\n;\n"
+      "SELECT 4--\n;"
+    )
+    self.assert_statements(["SELECT 5--1"], "SELECT 5--1;")
+    self.assert_statements(["/*!40101 SET NAMES utf8 */"], "/*!40101 SET NAMES utf8 */;\n-- only a comment;\n")
+  
+  def test_delimiter(self):
+    self.assert_statements(
+      [
+        "DROP TRIGGER IF EXISTS t_ins",
+        "CREATE TRIGGER t_ins BEFORE INSERT ON t FOR EACH ROW BEGIN\n  SET NEW.a = 1;\n  SET NEW.b = 2;\nEND",
+        "SELECT 1",
+      ],
+      "DROP TRIGGER IF EXISTS t_ins;\n"
+      "DELIMITER $$\n"
+      "CREATE TRIGGER t_ins BEFORE INSERT ON t FOR EACH ROW BEGIN\n  SET NEW.a = 1;\n  SET NEW.b = 2;\nEND$$\n"
+      "delimiter ;\n"
+      "SELECT 1;\n"
+    )
@@ -0,0 +1,29 @@
+from dmigrations.tests.common import *
+from dmigrations.state_file import StateFile
+from datetime import datetime
+from StringIO import StringIO
+
+class StateFileTest(TestCase):
+  def test_round_trip(self):
+    state = StateFile(
+      applied = [
+        (u'001_foo', datetime(2009, 1, 2, 3, 4, 5), 1500, 'a' * 40),
+        (u'002_bar', None, None, None),
+      ],
+      log = [
+        (u'apply', u'001_foo', u'success', datetime(2009, 1, 2, 3, 4, 5)),
+        (u'apply', u'002_bar', u'Error:\ttab and\nnewline \u017c', datetime(2009, 1, 2, 3, 4, 6)),
+      ],
+    )
+    output = StringIO()
+    state.write(output)
+    self.assert_equal(5, len(output.getvalue().splitlines()))
+    
+    read_state = StateFile.read(StringIO(output.getvalue()))
+    self.assert_equal(state.applied, read_state.applied)
+    self.assert_equal(state.log, read_state.log)
+    self.assert_equal([u'001_foo', u'002_bar'], read_state.applied_names())
+  
+  def test_bad_files(self):
+    for contents in ["", "something else\n", "dmigrations-state 1\nX\t1\n"]:
+      self.assertRaises(MigrationError, StateFile.read, StringIO(contents))
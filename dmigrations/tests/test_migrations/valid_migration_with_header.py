@@ -0,0 +1,9 @@
+# dmigrations: tables = blog_entry, `blog_category`
+# dmigrations: soft = yes
+# dmigrations: cost = 600
+# dmigrations: reversible = no
+
+from dmigrations.mysql.migrations import Migration
+
+# dmigrations: cost = 1 (not part of the header)
+migration = Migration(sql_up="")
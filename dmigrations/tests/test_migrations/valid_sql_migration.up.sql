@@ -0,0 +1,3 @@
+-- dmigrations: tables = seed
+CREATE TABLE `seed` (`name` VARCHAR(50));
+INSERT INTO `seed` VALUES ('a;b'), ('c');
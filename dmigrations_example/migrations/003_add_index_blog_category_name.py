@@ -1,3 +1,4 @@
+# dmigrations: tables = blog_category
 from dmigrations.mysql import migrations as m
 import datetime
 migration = m.AddIndex('blog', 'category', 'name')